@@ -0,0 +1,108 @@
+"""
+Startup benchmark for the Django entry points.
+
+Runs each entry point in a fresh interpreter with `python -X importtime` and
+reports the total import time plus the heaviest modules, so regressions in
+cold-start time (Render web process, short-lived manage.py runs) show up.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 5 --output startup.json
+    python benchmarks/bench_startup.py --baseline startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+SETUP = "import django; django.setup(); "
+
+# name -> code run in a fresh interpreter
+ENTRY_POINTS = {
+    'wsgi': "import config.wsgi",
+    'views': SETUP + "import emails.views",
+    'services': SETUP + "import emails.services",
+    'send_campaign': SETUP + "import emails.management.commands.send_campaign",
+    'send_cold_emails': SETUP + "import emails.management.commands.send_cold_emails",
+    'export_campaign': SETUP + "import emails.management.commands.export_campaign",
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parses `-X importtime` output into {module: (self_us, cumulative_us)}.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            _, rest = line.split(':', 1)
+            self_us, cumulative_us, name = rest.split('|')
+            modules[name.strip()] = (int(self_us), int(cumulative_us))
+        except ValueError:
+            continue
+    return modules
+
+
+def measure(code):
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    env.setdefault('SECRET_KEY', 'startup-benchmark')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=BASE_DIR, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+    total_us = sum(self_us for self_us, _ in modules.values())
+    return total_us, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='Runs per entry point (median is reported)')
+    parser.add_argument('--top', type=int, default=5, help='Heaviest modules to list per entry point')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare against a JSON file written by --output')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name, code in ENTRY_POINTS.items():
+        totals = []
+        modules = {}
+        for _ in range(args.runs):
+            total_us, modules = measure(code)
+            totals.append(total_us)
+        total_ms = statistics.median(totals) / 1000
+        heaviest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)
+        # Only top-level packages, the cumulative numbers of submodules are already included
+        heaviest = [(mod, cum / 1000) for mod, (_, cum) in heaviest if '.' not in mod][:args.top]
+        results[name] = {'import_ms': round(total_ms, 1), 'modules': len(modules), 'heaviest': heaviest}
+
+        line = f"{name:<18} {total_ms:8.1f} ms  {len(modules):5d} modules"
+        if name in baseline:
+            before = baseline[name]['import_ms']
+            line += f"  (baseline {before:.1f} ms, {total_ms - before:+.1f} ms)"
+        print(line)
+        for mod, cum_ms in heaviest:
+            print(f"    {mod:<30} {cum_ms:8.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Tracking hit benchmark: the full Django stack vs emails.fastpath.
+
+Calls both WSGI applications in-process with synthetic pixel and click
+requests (a fresh tracking id each, like real opens) and reports requests/sec
+and per-request latency, so the cost of the middleware stack on tracking hits
+shows up without network noise. Events are kept in an in-memory buffer that
+is never flushed, so nothing is written to the database.
+
+Usage:
+    python benchmarks/bench_tracking.py
+    python benchmarks/bench_tracking.py --requests 20000 --runs 5
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import quote
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('SECRET_KEY', 'tracking-benchmark')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+
+from emails import tracking  # noqa: E402
+from emails.fastpath import TrackingDispatcher  # noqa: E402
+
+CLICK_URL = 'https://example.com/pricing?ref=mail'
+USER_AGENT = 'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'
+
+
+def make_environ(path, query_string=''):
+    return {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8000',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'HTTP_USER_AGENT': USER_AGENT,
+        'REMOTE_ADDR': '66.249.84.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+
+def requests_for(kind, count):
+    if kind == 'open':
+        return [make_environ(f'/track/open/{uuid.uuid4()}/pixel.png') for _ in range(count)]
+    environs = []
+    for _ in range(count):
+        tracking_id = str(uuid.uuid4())
+        signature = tracking.click_signature(tracking_id, CLICK_URL)
+        environs.append(make_environ(f'/track/click/{tracking_id}/', f"sig={signature}&url={quote(CLICK_URL, safe='')}"))
+    return environs
+
+
+def run(application, environs):
+    """
+    Returns (seconds, per-request latencies) for serving all environs.
+    """
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    latencies = []
+    started = time.perf_counter()
+    for environ in environs:
+        request_started = time.perf_counter()
+        body = application(environ, start_response)
+        for _ in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+        latencies.append(time.perf_counter() - request_started)
+    elapsed = time.perf_counter() - started
+
+    expected = {'200 OK', '302 Found'}
+    if not set(statuses) <= expected:
+        raise RuntimeError(f"Unexpected responses: {sorted(set(statuses) - expected)}")
+    return elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000, help='Requests per run')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per case (median is reported)')
+    args = parser.parse_args()
+
+    # Never flushed, so nothing reaches the database
+    tracking._buffer = tracking.EventBuffer(max_events=10 ** 9, flush_interval=3600)
+
+    django_app = get_wsgi_application()
+    applications = {'django': django_app, 'fastpath': TrackingDispatcher(django_app)}
+
+    for kind in ('open', 'click'):
+        rates = {}
+        for name, application in applications.items():
+            run(application, requests_for(kind, 100)) # Warm up
+            results = []
+            for _ in range(args.runs):
+                tracking._buffer._pending.clear()
+                results.append(run(application, requests_for(kind, args.requests)))
+            elapsed, latencies = sorted(results, key=lambda result: result[0])[len(results) // 2]
+            latencies.sort()
+            rates[name] = args.requests / elapsed
+            print(
+                f"{kind:<6} {name:<9} {rates[name]:9.0f} req/s  "
+                f"p50 {statistics.median(latencies) * 1e6:7.1f} us  "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.1f} us"
+            )
+        print(f"{kind:<6} speedup   {rates['fastpath'] / rates['django']:9.1f}x")
+    tracking._buffer._pending.clear()
+
+
+if __name__ == '__main__':
+    main()
@@ -83,6 +83,27 @@ DATABASES = {
     )
 }
 
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Tests get a database file, not the in-memory default: threads (the render-ahead
+    # thread, the tracking flush) then lock each other the way they do in production
+    DATABASES['default']['TEST'] = {'NAME': str(BASE_DIR / 'test_db.sqlite3')}
+
+
+# Cache
+# Compiled email templates live in their own file-based cache so they survive
+# between management command runs (see emails/templating.py)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'templates': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('TEMPLATE_CACHE_DIR', str(BASE_DIR / '.cache' / 'templates')),
+        'TIMEOUT': None,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -123,17 +144,76 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Email Configuration (Gmail SMTP)
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_PORT = 587
-EMAIL_USE_TLS = True
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
 # User must provide these in environment or modify directly
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Limit on the total size of --attach files once base64-encoded (Gmail rejects messages over 25 MB)
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.environ.get('EMAIL_ATTACHMENT_MAX_BYTES', 24 * 1024 * 1024))
+
+# HTTP batch API backend, used with EMAIL_BACKEND=emails.backends.batch_api.BatchAPIEmailBackend
+# (run_fake_email_api serves a local mock of the API on the default URL)
+EMAIL_API_URL = os.environ.get('EMAIL_API_URL', 'http://127.0.0.1:8025')
+EMAIL_API_KEY = os.environ.get('EMAIL_API_KEY', '')
+EMAIL_API_BATCH_SIZE = int(os.environ.get('EMAIL_API_BATCH_SIZE', 500))
+EMAIL_API_TIMEOUT = int(os.environ.get('EMAIL_API_TIMEOUT', 30))
+
+# Sending renders messages ahead in a background thread, into a queue of at most
+# SEND_PIPELINE_QUEUE_SIZE messages; SEND_RENDER_WORKERS > 0 renders in that many processes
+SEND_PIPELINE_QUEUE_SIZE = int(os.environ.get('SEND_PIPELINE_QUEUE_SIZE', 200))
+SEND_RENDER_WORKERS = int(os.environ.get('SEND_RENDER_WORKERS', 0))
+
+# Campaign outbox (send_campaign --enqueue / --worker): a worker claims SEND_CLAIM_BATCH_SIZE
+# messages for SEND_LEASE_SECONDS (renewed while it sends); when everything left is
+# leased to others it checks back every SEND_WORKER_POLL_SECONDS
+SEND_CLAIM_BATCH_SIZE = int(os.environ.get('SEND_CLAIM_BATCH_SIZE', 50))
+SEND_LEASE_SECONDS = int(os.environ.get('SEND_LEASE_SECONDS', 300))
+SEND_WORKER_POLL_SECONDS = int(os.environ.get('SEND_WORKER_POLL_SECONDS', 5))
+# A message claimed this many times without a result (its worker kept dying on it)
+# is marked failed instead of being handed to the next worker
+SEND_MAX_ATTEMPTS = int(os.environ.get('SEND_MAX_ATTEMPTS', 3))
+
+# CSV ingest (emails/ingest.py): duplicate emails are found in memory up to this budget,
+# then on disk in INGEST_TEMP_DIR (default: the system temp directory)
+INGEST_MEMORY_BUDGET_MB = int(os.environ.get('INGEST_MEMORY_BUDGET_MB', 256))
+INGEST_TEMP_DIR = os.environ.get('INGEST_TEMP_DIR', '')
+
 # Website URL for tracking
 SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
 
+# Extra CSV columns (keys of Contact.extra_data) that get an expression index,
+# comma separated. Create the indexes with: python manage.py index_contact_attributes
+CONTACT_INDEXED_ATTRIBUTES = [name.strip() for name in os.environ.get('CONTACT_INDEXED_ATTRIBUTES', '').split(',') if name.strip()]
+
+# Open/click tracking: events are buffered in memory and written with one bulk insert
+# per TRACKING_BUFFER_SIZE events or TRACKING_FLUSH_INTERVAL_MS, whichever comes first.
+# Repeated hits for the same email within TRACKING_DEDUPE_SECONDS (image proxies,
+# link scanners) are dropped.
+TRACKING_BUFFER_SIZE = int(os.environ.get('TRACKING_BUFFER_SIZE', 500))
+TRACKING_FLUSH_INTERVAL_MS = int(os.environ.get('TRACKING_FLUSH_INTERVAL_MS', 1000))
+TRACKING_DEDUPE_SECONDS = int(os.environ.get('TRACKING_DEDUPE_SECONDS', 30))
+# Click links carry a signature of their target. Set to True to also redirect unsigned
+# links, e.g. for a while after upgrading, from emails sent before links were signed
+TRACKING_ALLOW_UNSIGNED_CLICKS = os.environ.get('TRACKING_ALLOW_UNSIGNED_CLICKS', 'False') == 'True'
+# Local IP database for the country/region/city of tracking events: a CSV of ranges
+# (start,end,country[,region[,city]], e.g. the DB-IP or IP2Location lite downloads)
+# or a MaxMind .mmdb file (needs `pip install geoip2`). Empty: no location.
+GEOIP_DATABASE = os.environ.get('GEOIP_DATABASE', '')
+# Serve tracking hits from emails.fastpath in front of the middleware stack (config/wsgi.py)
+TRACKING_FAST_PATH = os.environ.get('TRACKING_FAST_PATH', 'True') == 'True'
+
+# /metrics (Prometheus text format). Database counts are cached for METRICS_CACHE_SECONDS.
+# Off (404) unless at least one of these is set: with METRICS_TOKEN, scrapers must send
+# "Authorization: Bearer <token>"; with METRICS_ALLOWED_IPS (comma-separated addresses or
+# networks, e.g. "10.0.0.0/8,127.0.0.1"), they must connect from one (REMOTE_ADDR).
+METRICS_CACHE_SECONDS = int(os.environ.get('METRICS_CACHE_SECONDS', 5))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [value.strip() for value in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if value.strip()]
+
 # Mixpanel Configuration
 MIXPANEL_TOKEN = os.environ.get('MIXPANEL_TOKEN')
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402 (needs the settings module set above)
+
+if settings.TRACKING_FAST_PATH:
+    # Open/click tracking hits are answered before Django's middleware (see emails/fastpath.py)
+    from emails.fastpath import TrackingDispatcher  # noqa: E402
+    application = TrackingDispatcher(application)
@@ -0,0 +1,35 @@
+"""
+pytest fixtures shared by the test suite.
+"""
+import pytest
+
+from emails.testing.smtp import FakeSMTPServer
+
+
+@pytest.fixture
+def fake_smtp_factory():
+    """
+    Starts FakeSMTPServer instances with the given network conditions and
+    stops them after the test:
+
+        def test_retries(fake_smtp_factory):
+            server = fake_smtp_factory(latency=0.05, fail_rate=0.1)
+    """
+    servers = []
+
+    def start(**options):
+        server = FakeSMTPServer(**options).start_in_thread()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop_in_thread()
+
+
+@pytest.fixture
+def fake_smtp(fake_smtp_factory):
+    """
+    A started FakeSMTPServer on a free port (server.host / server.port) that accepts everything.
+    """
+    return fake_smtp_factory()
@@ -0,0 +1,140 @@
+import base64
+import mimetypes
+import os
+import uuid
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class SharedAttachment:
+    """
+    A file read and base64-encoded once per campaign, then shared by every message.
+
+    Attached to a CampaignMessage, the message only carries a small placeholder
+    part; the pre-encoded bytes are spliced in when the message is serialized,
+    so the email generator never walks the (possibly large) payload again.
+    Attached to any other EmailMessage, the full pre-encoded MIME part is used.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.size = len(data)
+
+        # base64 in 76 character lines, as the email package would write it
+        self._encoded = {'\n': base64.encodebytes(data).rstrip(b'\n')}
+        self.encoded_size = len(self._encoded['\n'])
+
+        self.marker = f'shared-attachment-{uuid.uuid4().hex}'
+        self.placeholder = self._make_part(self.marker)
+        self._part = None
+
+    def _make_part(self, payload):
+        maintype, subtype = self.mimetype.split('/', 1)
+        part = MIMEBase(maintype, subtype)
+        part.add_header('Content-Disposition', 'attachment', filename=self.filename)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(payload)
+        return part
+
+    @property
+    def part(self):
+        """Full MIME part with the encoded payload, for plain EmailMessage objects"""
+        if self._part is None:
+            self._part = self._make_part(self._encoded['\n'].decode('ascii'))
+        return self._part
+
+    def encoded(self, linesep='\n'):
+        if linesep not in self._encoded:
+            self._encoded[linesep] = self._encoded['\n'].replace(b'\n', linesep.encode('ascii'))
+        return self._encoded[linesep]
+
+    def attach_to(self, message):
+        if isinstance(message, CampaignMessage):
+            message.attach_shared(self)
+        else:
+            # EmailMessage.attach() keeps MIMEBase objects as they are, no copy
+            message.attach(self.part)
+
+
+class CampaignMessage(EmailMultiAlternatives):
+    """
+    EmailMultiAlternatives that splices SharedAttachment bytes into the
+    serialized message instead of re-generating them for every recipient.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared_attachments = []
+        # Compiled template and slot values this message was rendered from;
+        # batch API backends send the template once and only the values per recipient
+        self.template = None
+        self.merge_values = None
+        # Outcome reported by backends that track each message (see emails.backends)
+        self.send_result = None
+
+    def set_template(self, template, values):
+        self.template = template
+        self.merge_values = values
+
+    def attach_shared(self, attachment):
+        self.shared_attachments.append(attachment)
+        self.attach(attachment.placeholder)
+
+    def message(self, *args, **kwargs):
+        msg = super().message(*args, **kwargs)
+        if self.shared_attachments:
+            as_bytes = msg.as_bytes
+            shared_attachments = self.shared_attachments
+
+            def spliced_as_bytes(unixfrom=False, linesep='\n'):
+                data = as_bytes(unixfrom=unixfrom, linesep=linesep)
+                view = memoryview(data)
+                cuts = sorted(
+                    ((data.index(attachment.marker.encode('ascii')), attachment) for attachment in shared_attachments),
+                    key=lambda cut: cut[0],
+                )
+                # Headers/body around the markers are sliced without copying, and the
+                # shared blocks go in as they are: the one copy is the final join
+                # (smtplib needs the message as one bytes object)
+                pieces, start = [], 0
+                for at, attachment in cuts:
+                    pieces.append(view[start:at])
+                    pieces.append(attachment.encoded(linesep))
+                    start = at + len(attachment.marker)
+                pieces.append(view[start:])
+                return b''.join(pieces)
+
+            msg.as_bytes = spliced_as_bytes
+        return msg
+
+
+def load_attachments(paths, max_bytes=None):
+    """
+    Loads and encodes each file once, and checks the encoded total against
+    EMAIL_ATTACHMENT_MAX_BYTES before anything is sent.
+    """
+    if max_bytes is None:
+        max_bytes = settings.EMAIL_ATTACHMENT_MAX_BYTES
+
+    attachments = []
+    for path in paths or []:
+        if not os.path.exists(path):
+            raise AttachmentError(f"Attachment not found: {path}")
+        attachments.append(SharedAttachment(path))
+
+    total = sum(attachment.encoded_size for attachment in attachments)
+    if max_bytes and total > max_bytes:
+        raise AttachmentError(
+            f"Attachments are {total / 1024 / 1024:.1f} MB once encoded, over the "
+            f"{max_bytes / 1024 / 1024:.1f} MB limit (EMAIL_ATTACHMENT_MAX_BYTES)"
+        )
+    return attachments
@@ -0,0 +1,267 @@
+import base64
+import http.client
+import json
+from email.mime.base import MIMEBase
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+
+from ..templating import slot_value
+
+# Placeholders in the batch body; the API swaps them for each recipient's substitutions.
+# "s" values are plain text (subject, text part), "h" values are HTML-escaped.
+TEXT_TOKEN = '{{{{s{}}}}}'
+HTML_TOKEN = '{{{{h{}}}}}'
+
+BATCH_PATH = '/v1/messages/batch'
+
+
+class BatchAPIError(Exception):
+    pass
+
+
+class BatchAPIEmailBackend(BaseEmailBackend):
+    """
+    Sends mail through an HTTP batch API instead of SMTP.
+
+    send_messages() groups messages rendered from the same compiled template
+    (see CampaignMessage.set_template) into one API message: the template body
+    goes over the wire once, each recipient only adds its slot values. Other
+    messages are sent whole, batched with the rest. Each request carries up to
+    EMAIL_API_BATCH_SIZE recipients over one keep-alive connection.
+
+    Request:  {"messages": [{"from", "subject", "text", "html", "reply_to", "attachments",
+                             "recipients": [{"to", "cc", "bcc", "headers", "substitutions"}]}]}
+    Response: {"results": [{"status": "accepted" | "rejected", "id", "error", "permanent"}]},
+              one per recipient, in request order.
+
+    The outcome of every message is stored on message.send_result as
+    {'status': 'sent' | 'failed', 'id', 'error', 'permanent'}.
+    """
+    supports_batch = True
+
+    def __init__(self, api_url=None, api_key=None, batch_size=None, timeout=None, fail_silently=False, **kwargs):
+        super().__init__(fail_silently=fail_silently, **kwargs)
+        url = urlsplit(api_url or settings.EMAIL_API_URL)
+        self.scheme = url.scheme or 'http'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/') + BATCH_PATH
+        self.api_key = settings.EMAIL_API_KEY if api_key is None else api_key
+        self.batch_size = batch_size or settings.EMAIL_API_BATCH_SIZE
+        self.timeout = settings.EMAIL_API_TIMEOUT if timeout is None else timeout
+        self.connection = None
+        self.stats = {'requests': 0, 'recipients': 0, 'bytes': 0, 'reconnects': 0}
+        # template key -> (text slots, html slots) as (index, name) pairs
+        self._template_slots = {}
+
+    # --- Connection ---
+
+    def open(self):
+        if self.connection is not None:
+            return False
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(self.host, self.port, timeout=self.timeout)
+        return True
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        finally:
+            self.connection = None
+
+    def _post(self, data):
+        body = json.dumps(data).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+
+        # One retry: the server may have closed the kept-alive connection while it was idle
+        for attempt in range(2):
+            reused = not self.open()
+            try:
+                self.connection.request('POST', self.path, body, headers)
+                response = self.connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt or not reused:
+                    raise
+                self.stats['reconnects'] += 1
+                continue
+            break
+
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(body)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        if response.status >= 400:
+            raise BatchAPIError(f"{response.status} {response.reason}: {payload[:200].decode('utf-8', 'replace')}")
+        return json.loads(payload)
+
+    # --- Sending ---
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        new_connection = self.open()
+        try:
+            sent = 0
+            for payload, messages in self._batches(email_messages):
+                sent += self._send_batch(payload, messages)
+        finally:
+            if new_connection:
+                self.close()
+        return sent
+
+    def _send_batch(self, payload, messages):
+        try:
+            results = self._post({'messages': payload}).get('results', [])
+        except Exception as e:
+            for message in messages:
+                message.send_result = {'status': 'failed', 'id': '', 'error': str(e), 'permanent': False}
+            if not self.fail_silently:
+                raise
+            return 0
+
+        sent = 0
+        for i, message in enumerate(messages):
+            result = results[i] if i < len(results) else {'status': 'rejected', 'error': 'No result returned by the API'}
+            accepted = result.get('status') == 'accepted'
+            message.send_result = {
+                'status': 'sent' if accepted else 'failed',
+                'id': str(result.get('id', '')),
+                'error': result.get('error', ''),
+                'permanent': bool(result.get('permanent')),
+            }
+            sent += accepted
+        self.stats['recipients'] += len(messages)
+        return sent
+
+    def _batches(self, email_messages):
+        """
+        Yields (API messages, email messages) per request, the email messages
+        in the same order as the recipients in the request.
+        """
+        groups = {}
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            key = self._group_key(message)
+            templated = key[0] == 'template'
+            group = groups.get(key)
+            if group is None:
+                # Content (and attachments) are built once per group
+                group = groups[key] = (self._content(message, templated), [])
+            group[1].append((self._recipient(message, templated), message))
+
+        payload, messages, size = [], [], 0
+        for content, recipients in groups.values():
+            while recipients:
+                chunk, recipients = recipients[:self.batch_size - size], recipients[self.batch_size - size:]
+                payload.append(dict(content, recipients=[recipient for recipient, _ in chunk]))
+                messages.extend(message for _, message in chunk)
+                size += len(chunk)
+                if size >= self.batch_size:
+                    yield payload, messages
+                    payload, messages, size = [], [], 0
+        if payload:
+            yield payload, messages
+
+    @staticmethod
+    def _other_attachments(message):
+        placeholders = {id(attachment.placeholder) for attachment in getattr(message, 'shared_attachments', [])}
+        return [attachment for attachment in message.attachments if id(attachment) not in placeholders]
+
+    @staticmethod
+    def _has_html(message):
+        return any(mimetype == 'text/html' for _, mimetype in getattr(message, 'alternatives', []))
+
+    def _group_key(self, message):
+        """
+        Messages from the same template, sender and attachments share a key;
+        anything that can't be expressed as substitutions gets a key of its own.
+        """
+        template = getattr(message, 'template', None)
+        if (template is None or template.uses_django or self._other_attachments(message)
+                or len(message.to) != 1 or message.cc or message.bcc):
+            return ('message', id(message))
+        return (
+            'template', template.key, message.from_email, tuple(message.reply_to),
+            tuple(attachment.marker for attachment in message.shared_attachments), self._has_html(message),
+        )
+
+    def _content(self, message, templated):
+        """
+        The part of an API message shared by all its recipients.
+        """
+        attachments = [
+            {'filename': attachment.filename, 'content_type': attachment.mimetype, 'content': attachment.encoded('').decode('ascii')}
+            for attachment in getattr(message, 'shared_attachments', [])
+        ]
+        attachments.extend(self._attachment(attachment) for attachment in self._other_attachments(message))
+        content = {'from': message.from_email, 'reply_to': list(message.reply_to), 'attachments': attachments}
+
+        if templated:
+            template = message.template
+            content.update(
+                subject=self._join(template.subject_parts, template.slots, TEXT_TOKEN),
+                text=self._join(template.text_parts, template.slots, TEXT_TOKEN),
+                html=self._join(template.html_parts, template.slots, HTML_TOKEN) if self._has_html(message) else None,
+            )
+        elif message.content_subtype == 'html':
+            content.update(subject=message.subject, text='', html=message.body)
+        else:
+            html = next((body for body, mimetype in getattr(message, 'alternatives', []) if mimetype == 'text/html'), None)
+            content.update(subject=message.subject, text=message.body, html=html)
+        return content
+
+    def _recipient(self, message, templated):
+        recipient = {
+            'to': list(message.to),
+            'cc': list(message.cc),
+            'bcc': list(message.bcc),
+            'headers': {name: str(value) for name, value in message.extra_headers.items()},
+        }
+        if templated:
+            values = message.merge_values
+            text_slots, html_slots = self._slots(message.template)
+            substitutions = {f's{i}': slot_value(values, slot) for i, slot in text_slots}
+            substitutions.update({f'h{i}': slot_value(values, slot, escape=True) for i, slot in html_slots})
+            recipient['substitutions'] = substitutions
+        return recipient
+
+    def _slots(self, template):
+        slots = self._template_slots.get(template.key)
+        if slots is None:
+            used_text = set(template.subject_parts[1::2]) | set(template.text_parts[1::2])
+            used_html = set(template.html_parts[1::2])
+            slots = self._template_slots[template.key] = (
+                [(i, slot) for i, slot in enumerate(template.slots) if slot in used_text],
+                [(i, slot) for i, slot in enumerate(template.slots) if slot in used_html],
+            )
+        return slots
+
+    @staticmethod
+    def _join(parts, slots, token):
+        return ''.join(part if i % 2 == 0 else token.format(slots.index(part)) for i, part in enumerate(parts))
+
+    @staticmethod
+    def _attachment(attachment):
+        if isinstance(attachment, MIMEBase):
+            return {
+                'filename': attachment.get_filename() or 'attachment',
+                'content_type': attachment.get_content_type(),
+                'content': base64.b64encode(attachment.get_payload(decode=True) or b'').decode('ascii'),
+            }
+        filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return {
+            'filename': filename or 'attachment',
+            'content_type': mimetype or 'application/octet-stream',
+            'content': base64.b64encode(content).decode('ascii'),
+        }
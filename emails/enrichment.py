@@ -0,0 +1,269 @@
+import bisect
+import csv
+import ipaddress
+import logging
+import re
+import threading
+from array import array
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Distinct user agents / client addresses remembered. Opens come through a few
+# image proxies and corporate NATs, so most lookups after the first are hits.
+UA_CACHE_SIZE = 4096
+IP_CACHE_SIZE = 65536
+
+UserAgent = namedtuple('UserAgent', ['client', 'device', 'automated'])
+Location = namedtuple('Location', ['country', 'region', 'city'])
+
+UNKNOWN_AGENT = UserAgent('', 'unknown', False)
+UNKNOWN_LOCATION = Location('', '', '')
+
+# Mail providers that fetch images on the recipient's behalf: an open, but not the recipient's device or location
+PROXIES = [
+    (re.compile(r'GoogleImageProxy'), 'Gmail'),
+    (re.compile(r'YahooMailProxy'), 'Yahoo Mail'),
+]
+
+# Link scanners, previewers and scripts: these "opens" and "clicks" aren't people
+BOT_RE = re.compile(
+    r'bot\b|crawl|spider|slurp|scanner|preview|headless|python-|curl/|wget/|go-http-client|java/|okhttp|libwww'
+    r'|barracuda|mimecast|proofpoint|forcepoint|trendmicro|symantec|facebookexternalhit|existence discovery',
+    re.IGNORECASE,
+)
+
+# First match wins: mail clients first, then browsers whose tokens other browsers repeat
+CLIENTS = [
+    (re.compile(r'Thunderbird/'), 'Thunderbird'),
+    (re.compile(r'Microsoft Outlook|MSOffice|Outlook-'), 'Outlook'),
+    (re.compile(r'Edg(?:e|A|iOS)?/'), 'Edge'),
+    (re.compile(r'OPR/|Opera'), 'Opera'),
+    (re.compile(r'SamsungBrowser/'), 'Samsung Internet'),
+    (re.compile(r'Chrome/|CriOS/'), 'Chrome'),
+    (re.compile(r'Firefox/|FxiOS/'), 'Firefox'),
+    (re.compile(r'Version/[\d.]+.*Safari/'), 'Safari'),
+    # Apple Mail and iOS Mail load images with WebKit but no "Safari" token
+    (re.compile(r'(?:Macintosh|iPhone|iPad).*AppleWebKit/(?!.*Safari/)'), 'Apple Mail'),
+]
+
+TABLET_RE = re.compile(r'iPad|Tablet|Android(?!.*Mobile)')
+MOBILE_RE = re.compile(r'Mobile|iPhone|iPod|Android|Windows Phone')
+DESKTOP_RE = re.compile(r'Windows|Macintosh|X11|Linux|CrOS')
+
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def parse_user_agent(user_agent):
+    """
+    (client, device, automated) for a User-Agent header. device is one of
+    desktop, mobile, tablet, proxy (mail provider image proxy), bot or unknown;
+    automated marks hits that didn't come from the recipient's own client.
+    """
+    if not user_agent:
+        return UNKNOWN_AGENT
+
+    for pattern, client in PROXIES:
+        if pattern.search(user_agent):
+            return UserAgent(client, 'proxy', True)
+    if BOT_RE.search(user_agent):
+        return UserAgent('', 'bot', True)
+
+    client = next((name for pattern, name in CLIENTS if pattern.search(user_agent)), '')
+    if TABLET_RE.search(user_agent):
+        device = 'tablet'
+    elif MOBILE_RE.search(user_agent):
+        device = 'mobile'
+    elif DESKTOP_RE.search(user_agent):
+        device = 'desktop'
+    else:
+        device = 'unknown'
+    return UserAgent(client, device, False)
+
+
+class IPRangeDatabase:
+    """
+    Country/region/city by IP address from a local CSV of address ranges, in
+    the layout of the free "lite" downloads:
+
+        DB-IP:        1.0.0.0,1.0.0.255,[continent,]AU[,Queensland,South Brisbane,...]
+        IP2Location:  "16777216","16777471","AU","Australia"[,"Queensland","Brisbane",...]
+
+    Ranges given as integers are read as IP2Location (country code, then country
+    name); ranges given as addresses as DB-IP. Ranges are kept as sorted arrays
+    (one per address family) and looked up by bisection. Locations are interned,
+    so a country file costs a few bytes per range.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ranges = 0
+        # version -> (starts, ends, location indexes)
+        self._tables = {}
+        self._locations = []
+        self._load()
+
+    @staticmethod
+    def _address(value):
+        value = value.strip()
+        if value.isdigit():
+            number = int(value)
+            return (4 if number < 2 ** 32 else 6), number
+        address = ipaddress.ip_address(value)
+        return address.version, int(address)
+
+    @staticmethod
+    def _location(record):
+        values = [value.strip() for value in record[2:]]
+        if record[0].strip().isdigit():
+            # IP2Location: code, country name, region, city
+            values = values[:1] + values[2:]
+        elif len(values) > 1 and len(values[0]) == 2 and len(values[1]) == 2:
+            # DB-IP city files start with the continent code
+            values = values[1:]
+        country, region, city = (values + ['', ''])[:3]
+        return Location(country.upper(), region, city)
+
+    def _load(self):
+        interned = {}
+        rows = {4: [], 6: []}
+        with open(self.path, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            for record in csv.reader(f):
+                if len(record) < 3:
+                    continue
+                try:
+                    version, start = self._address(record[0])
+                    _, end = self._address(record[1])
+                except ValueError:
+                    continue # Header row or a malformed line
+                location = self._location(record)
+                if len(location.country) != 2 or location.country == 'ZZ':
+                    continue # "-" / "ZZ" for unallocated ranges
+                index = interned.setdefault(location, len(interned))
+                rows[version].append((start, end, index))
+
+        self._locations = list(interned)
+        for version, entries in rows.items():
+            entries.sort()
+            # IPv6 values don't fit a machine word
+            numbers = (lambda values: array('Q', values)) if version == 4 else list
+            self._tables[version] = (
+                numbers(start for start, _, _ in entries),
+                numbers(end for _, end, _ in entries),
+                array('I', (index for _, _, index in entries)),
+            )
+            self.ranges += len(entries)
+
+    def lookup(self, address):
+        starts, ends, indexes = self._tables[address.version]
+        position = bisect.bisect_right(starts, int(address)) - 1
+        if position >= 0 and int(address) <= ends[position]:
+            return self._locations[indexes[position]]
+        return UNKNOWN_LOCATION
+
+
+class MaxMindDatabase:
+    """
+    A MaxMind/GeoLite2 .mmdb file, read with the optional geoip2 package.
+    """
+    def __init__(self, path):
+        import geoip2.database
+        import geoip2.errors
+
+        self.path = path
+        self.reader = geoip2.database.Reader(path)
+        self.not_found = geoip2.errors.AddressNotFoundError
+        self.city = 'City' in self.reader.metadata().database_type
+
+    def lookup(self, address):
+        try:
+            if self.city:
+                result = self.reader.city(str(address))
+                return Location(result.country.iso_code or '', result.subdivisions.most_specific.name or '', result.city.name or '')
+            return Location(self.reader.country(str(address)).country.iso_code or '', '', '')
+        except self.not_found:
+            return UNKNOWN_LOCATION
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_geo_database():
+    """
+    The GEOIP_DATABASE file, loaded on first use; None if unset or unreadable.
+    """
+    global _database
+    if _database is None and settings.GEOIP_DATABASE:
+        with _database_lock:
+            if _database is None:
+                path = settings.GEOIP_DATABASE
+                try:
+                    _database = MaxMindDatabase(path) if path.endswith('.mmdb') else IPRangeDatabase(path)
+                except ImportError:
+                    logger.error("GEOIP_DATABASE is a .mmdb file but geoip2 isn't installed (pip install geoip2); events won't get a location")
+                    _database = False
+                except Exception:
+                    logger.exception("Couldn't load GEOIP_DATABASE %s; events won't get a location", path)
+                    _database = False
+    return _database or None
+
+
+@lru_cache(maxsize=IP_CACHE_SIZE)
+def lookup_ip(ip):
+    """
+    Location for an address string; empty for private addresses or without a database.
+    """
+    database = get_geo_database()
+    if database is None or not ip:
+        return UNKNOWN_LOCATION
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return UNKNOWN_LOCATION
+    if not address.is_global:
+        return UNKNOWN_LOCATION
+    return database.lookup(address)
+
+
+def enrich_events(events):
+    """
+    Fills in the client and location fields of TrackingEvent objects.
+    Runs in the tracking buffer's flush thread, never in a request.
+    """
+    from .models import TrackingEvent
+
+    # Database names can be longer than the columns (Postgres would reject the whole insert)
+    country_length, region_length, city_length = (TrackingEvent._meta.get_field(name).max_length for name in Location._fields)
+
+    for event in events:
+        agent = parse_user_agent(event.user_agent)
+        event.client, event.device, event.is_automated = agent
+        if agent.device == 'proxy':
+            # The proxy's address says where the mail provider is, not the recipient
+            continue
+        country, region, city = lookup_ip(event.ip_address)
+        event.country, event.region, event.city = country[:country_length], region[:region_length], city[:city_length]
+
+
+def event_properties(event):
+    """
+    Enrichment of an event as analytics properties (empty values left out).
+    """
+    properties = {
+        'Email Client': event.client,
+        'Device': event.device,
+        'Automated': event.is_automated,
+        'Country': event.country,
+        'Region': event.region,
+        'City': event.city,
+    }
+    return {name: value for name, value in properties.items() if value not in ('', None)}
+
+
+def cache_stats():
+    """
+    {cache name: functools cache_info()} for the metrics endpoint.
+    """
+    return {'user_agent': parse_user_agent.cache_info(), 'ip': lookup_ip.cache_info()}
@@ -0,0 +1,100 @@
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.encoding import iri_to_uri
+
+from .metrics import TRACKING_LATENCY, TRACKING_REQUESTS
+from .tracking import PIXEL_PNG, click_target, client_ip, get_event_buffer
+
+# Same paths (and uuid format) as the track_open / track_click routes in emails/urls.py
+UUID_PATTERN = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+TRACKING_PATH_RE = re.compile(rf'^/track/(?:open/(?P<open>{UUID_PATTERN})/pixel\.png|click/(?P<click>{UUID_PATTERN})/)$')
+
+# TrackingEvent.OPEN / CLICK (models aren't imported on this path)
+OPEN = 'open'
+CLICK = 'click'
+
+
+class TrackingDispatcher:
+    """
+    WSGI app mounted in front of Django (see config/wsgi.py) that answers
+    pixel and click-tracking hits itself:
+
+        application = TrackingDispatcher(get_wsgi_application())
+
+    Those hits skip the URL resolver and the whole MIDDLEWARE stack (sessions,
+    CSRF, auth, messages, WhiteNoise): a regex match, an append to the event
+    buffer and a prebuilt response. The security headers the middleware would
+    add to these responses are added here. Every other request, and anything
+    that doesn't match exactly, goes to Django unchanged.
+    """
+    def __init__(self, application):
+        self.application = application
+
+        security_headers = []
+        if settings.SECURE_CONTENT_TYPE_NOSNIFF:
+            security_headers.append(('X-Content-Type-Options', 'nosniff'))
+        if settings.SECURE_REFERRER_POLICY:
+            # Keeps the tracking URL out of the Referer the link target sees
+            policy = settings.SECURE_REFERRER_POLICY
+            security_headers.append(('Referrer-Policy', policy if isinstance(policy, str) else ','.join(policy)))
+
+        self.pixel_headers = [
+            ('Content-Type', 'image/png'),
+            ('Content-Length', str(len(PIXEL_PNG))),
+            ('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0'),
+            *security_headers,
+        ]
+        # Content types as Django sends them
+        self.redirect_headers = [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', '0'), *security_headers]
+        self.invalid_body = b'Invalid link'
+        self.invalid_headers = [
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Length', str(len(self.invalid_body))),
+            *security_headers,
+        ]
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith('/track/') and environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            match = TRACKING_PATH_RE.match(path)
+            if match:
+                started = time.perf_counter()
+                if match['open']:
+                    body = self.track_open(environ, start_response, match['open'])
+                    TRACKING_LATENCY.observe(time.perf_counter() - started, OPEN)
+                else:
+                    body = self.track_click(environ, start_response, match['click'])
+                    TRACKING_LATENCY.observe(time.perf_counter() - started, CLICK)
+                return [] if environ['REQUEST_METHOD'] == 'HEAD' else body
+        return self.application(environ, start_response)
+
+    def track_open(self, environ, start_response, tracking_id):
+        queued = get_event_buffer().add(
+            uuid.UUID(tracking_id), OPEN,
+            ip_address=client_ip(environ),
+            user_agent=environ.get('HTTP_USER_AGENT', ''),
+        )
+        TRACKING_REQUESTS.inc(OPEN, 'queued' if queued else 'deduped')
+        start_response('200 OK', self.pixel_headers)
+        return [PIXEL_PNG]
+
+    def track_click(self, environ, start_response, tracking_id):
+        target = click_target(environ.get('QUERY_STRING', ''), tracking_id)
+        # Same checks as HttpResponseRedirect: an ASCII Location without line breaks
+        location = iri_to_uri(target) if target is not None else None
+        if location is None or '\r' in location or '\n' in location:
+            TRACKING_REQUESTS.inc(CLICK, 'invalid')
+            start_response('400 Bad Request', self.invalid_headers)
+            return [self.invalid_body]
+
+        queued = get_event_buffer().add(
+            uuid.UUID(tracking_id), CLICK, url=target,
+            ip_address=client_ip(environ),
+            user_agent=environ.get('HTTP_USER_AGENT', ''),
+        )
+        TRACKING_REQUESTS.inc(CLICK, 'queued' if queued else 'deduped')
+        start_response('302 Found', [('Location', location), *self.redirect_headers])
+        return []
@@ -0,0 +1,252 @@
+import csv
+import glob
+import heapq
+import json
+import os
+import re
+import sys
+import tempfile
+
+from django.conf import settings
+
+from .suppression import address_hash, normalize_email
+
+# Headers are matched on lower case letters and digits only: "Job Role", "job_role" and "JOBROLE" are one column
+HEADER_KEY_RE = re.compile(r'[^a-z0-9]')
+
+# Columns every reader looks up by a fixed name, whatever the CSV calls them
+CANONICAL_HEADERS = {
+    'email': 'Email',
+    'emailaddress': 'Email',
+    'name': 'Name',
+    'fullname': 'Name',
+    'company': 'Company',
+}
+
+# Rough cost of one address in the in-memory seen set (set slot + int object)
+SEEN_ENTRY_BYTES = 64
+
+# Sorted runs merged at once; more than this are merged in several passes
+MAX_OPEN_RUNS = 64
+
+# Rows with huge fields (pasted HTML, notes) are kept rather than aborting the import
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+
+class IngestError(Exception):
+    pass
+
+
+def header_key(name):
+    return HEADER_KEY_RE.sub('', name.strip().lstrip('\ufeff').lower())
+
+
+def expand_paths(patterns):
+    """
+    CSV paths from a list of file names and/or glob patterns, in order, each file once.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise IngestError(f"No CSV files match: {pattern}")
+        for path in matches:
+            if not os.path.isfile(path):
+                raise IngestError(f"CSV file not found: {path}")
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+class CSVIngest:
+    """
+    Streams the rows of one or more CSV files as clean dicts:
+    - headers are stripped and matched case-insensitively across files
+      (the first spelling seen is used, Email/Name/Company are always spelled so,
+      and also kept under the file's own spelling, e.g. "Full Name", for templates)
+    - every row has every column of every file ('' where its file has none)
+    - emails are stripped and lower-cased; rows without one are dropped
+    - duplicate emails are dropped, first occurrence wins
+
+    Dedupe uses an in-memory set of 64-bit address hashes while it fits in
+    `memory_budget` bytes, so normal imports stream in file order. Past that,
+    the remaining rows are spilled to sorted run files and merged back (an
+    external sort), which keeps memory bounded for multi-million row lists;
+    those rows come out in hash order rather than file order.
+    """
+    def __init__(self, patterns, memory_budget=None, temp_dir=None):
+        self.paths = expand_paths(patterns)
+        self.memory_budget = memory_budget or settings.INGEST_MEMORY_BUDGET_MB * 1024 * 1024
+        self.temp_dir = temp_dir or settings.INGEST_TEMP_DIR or None
+
+        self.stats = {
+            'files': len(self.paths),
+            'rows_read': 0,
+            'rows_without_email': 0,
+            'duplicates': 0,
+            'rows_out': 0,
+            'spilled_rows': 0,
+            'run_files': 0,
+        }
+
+        # header key -> the spelling used in output rows
+        self._spelling = {}
+        # Spelling in a file -> the canonical column it was renamed to (see CANONICAL_HEADERS)
+        self.aliases = {}
+        self.fieldnames = []
+        for path in self.paths:
+            with self._open(path) as f:
+                header = next(csv.reader(f), [])
+            self._map_headers(header)
+
+    def _open(self, path):
+        # utf-8-sig drops the BOM Excel writes; bad bytes are replaced rather than aborting the import
+        return open(path, 'r', encoding='utf-8-sig', errors='replace', newline='')
+
+    def _map_headers(self, header):
+        names = []
+        for name in header:
+            key = header_key(name)
+            if not key:
+                names.append(None) # Unnamed column, dropped
+                continue
+            if key not in self._spelling:
+                self._spelling[key] = CANONICAL_HEADERS.get(key, name.strip().lstrip('\ufeff'))
+                if self._spelling[key] not in self.fieldnames:
+                    self.fieldnames.append(self._spelling[key])
+            spelling = name.strip().lstrip('\ufeff')
+            if key in CANONICAL_HEADERS and spelling != self._spelling[key] and spelling not in self.aliases:
+                # [Full Name] in a template keeps working after the column became Name
+                self.aliases[spelling] = self._spelling[key]
+                self.fieldnames.append(spelling)
+            names.append(self._spelling[key])
+        return names
+
+    def _read(self):
+        """
+        Yields normalized rows from every file, duplicates included.
+        """
+        for path in self.paths:
+            with self._open(path) as f:
+                reader = csv.reader(f)
+                names = self._map_headers(next(reader, []))
+                for values in reader:
+                    self.stats['rows_read'] += 1
+                    row = dict.fromkeys(self.fieldnames, '')
+                    for name, value in zip(names, values):
+                        # First non-empty value wins when two columns map to the same name
+                        if name is not None and value and not row[name]:
+                            row[name] = value.strip()
+                    email = normalize_email(row.get('Email'))
+                    if not email:
+                        self.stats['rows_without_email'] += 1
+                        continue
+                    row['Email'] = email
+                    for alias, name in self.aliases.items():
+                        row[alias] = row[name]
+                    yield row
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self):
+        seen = set()
+        max_seen = max(1, self.memory_budget // 2 // SEEN_ENTRY_BYTES)
+        rows = self._read()
+
+        for row in rows:
+            key = address_hash(row['Email'])
+            if key in seen:
+                self.stats['duplicates'] += 1
+                continue
+            seen.add(key)
+            self.stats['rows_out'] += 1
+            yield row
+
+            if len(seen) >= max_seen:
+                # Over budget: dedupe the rest on disk
+                yield from self._external_dedupe(seen, rows)
+                return
+
+    # --- External dedupe ---
+
+    def _external_dedupe(self, seen, rows):
+        with tempfile.TemporaryDirectory(prefix='ingest_', dir=self.temp_dir) as workdir:
+            # Hashes already emitted, sorted, as run 0 (sequence -1 sorts before any row)
+            runs = [self._write_run(workdir, ((key, -1, '') for key in sorted(seen)))]
+            seen.clear()
+
+            # Half the budget for the run buffer; lines are counted with a rough per-object overhead
+            buffer, buffered, run_budget = [], 0, self.memory_budget // 2
+            for seq, row in enumerate(rows):
+                line = json.dumps(row, ensure_ascii=False, separators=(',', ':'))
+                buffer.append((address_hash(row['Email']), seq, line))
+                buffered += len(line) + 120
+                self.stats['spilled_rows'] += 1
+                if buffered >= run_budget:
+                    buffer.sort()
+                    runs.append(self._write_run(workdir, buffer))
+                    buffer, buffered = [], 0
+            if buffer:
+                buffer.sort()
+                runs.append(self._write_run(workdir, buffer))
+                buffer = []
+
+            # Keep the number of open files bounded: merge runs in groups first if there are many
+            while len(runs) > MAX_OPEN_RUNS:
+                runs = [self._merge_runs(workdir, runs[i:i + MAX_OPEN_RUNS]) for i in range(0, len(runs), MAX_OPEN_RUNS)]
+
+            files = [open(path, 'r', encoding='utf-8') for path in runs]
+            try:
+                previous = None
+                for key, seq, line in heapq.merge(*(self._read_run(f) for f in files)):
+                    if key == previous:
+                        self.stats['duplicates'] += 1
+                        continue
+                    previous = key
+                    if seq == -1:
+                        continue # Emitted before the spill
+                    self.stats['rows_out'] += 1
+                    yield json.loads(line)
+            finally:
+                for f in files:
+                    f.close()
+
+    def _write_run(self, workdir, records):
+        path = os.path.join(workdir, f'run_{self.stats["run_files"]:05d}.tsv')
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, seq, line in records:
+                f.write(f'{key}\t{seq}\t{line}\n')
+        self.stats['run_files'] += 1
+        return path
+
+    def _merge_runs(self, workdir, runs):
+        if len(runs) == 1:
+            return runs[0]
+        files = [open(path, 'r', encoding='utf-8') for path in runs]
+        try:
+            merged = self._write_run(workdir, heapq.merge(*(self._read_run(f) for f in files)))
+        finally:
+            for f in files:
+                f.close()
+        for path in runs:
+            os.remove(path)
+        return merged
+
+    @staticmethod
+    def _read_run(f):
+        for record in f:
+            key, seq, line = record.rstrip('\n').split('\t', 2)
+            yield int(key), int(seq), line
+
+    def summary(self):
+        stats = self.stats
+        lines = [
+            f"CSV files: {stats['files']}, rows read: {stats['rows_read']}, unique contacts: {stats['rows_out']}",
+            f"Dropped: {stats['duplicates']} duplicate emails, {stats['rows_without_email']} rows without an email",
+        ]
+        if stats['run_files']:
+            lines.append(f"Deduplicated {stats['spilled_rows']} rows on disk ({stats['run_files']} sorted runs)")
+        return lines
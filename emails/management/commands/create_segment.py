@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from emails.models import Audience
+
+class Command(BaseCommand):
+    help = 'Create or update a segment: an audience defined by saved filters over contact fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', type=str, required=True, help='Name of the segment')
+        parser.add_argument(
+            '--filter', dest='filters', action='append', required=True,
+            help='FIELD=VALUE, e.g. "location=NYC" or "Job Role=Engineer,Manager" (comma = any of). Repeat to combine.'
+        )
+
+    def handle(self, *args, **options):
+        filters = {}
+        for item in options['filters']:
+            if '=' not in item:
+                raise CommandError(f"Invalid filter '{item}', expected FIELD=VALUE")
+            name, value = item.split('=', 1)
+            values = [v.strip() for v in value.split(',')]
+            filters[name.strip()] = values if len(values) > 1 else values[0]
+
+        audience, created = Audience.objects.get_or_create(name=options['name'])
+        if not created and not audience.is_segment and audience.memberships.exists():
+            raise CommandError(f"Audience '{audience.name}' already has imported members, pick another name")
+
+        audience.filters = filters
+        audience.save(update_fields=['filters'])
+
+        count = audience.recipients().count()
+        action = 'Created' if created else 'Updated'
+        self.stdout.write(self.style.SUCCESS(f"{action} segment '{audience.name}' ({count} contacts match)"))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from emails.models import EmailCampaign
+from emails.services import EmailEngine
+
+class Command(BaseCommand):
+    help = 'Export the results of a campaign as CSV (one row per email log)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', type=str, required=True, help='Name of the campaign to export')
+        parser.add_argument('--output', type=str, help='Path of the CSV file to write (default: stdout)')
+
+    def handle(self, *args, **options):
+        campaign_name = options['name']
+        output_path = options.get('output')
+
+        campaign = EmailCampaign.objects.filter(name=campaign_name).first()
+        if campaign is None:
+            raise CommandError(f"Campaign not found: {campaign_name}")
+
+        if output_path:
+            with open(output_path, 'w', encoding='utf-8', newline='') as f:
+                count = EmailEngine.write_campaign_export(campaign, f)
+            self.stdout.write(self.style.SUCCESS(f"Exported {count} rows to {output_path}"))
+        else:
+            EmailEngine.write_campaign_export(campaign, self.stdout)
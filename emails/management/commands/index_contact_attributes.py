@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from emails.models import Contact
+
+class Command(BaseCommand):
+    help = 'Create expression indexes for the extra_data keys listed in CONTACT_INDEXED_ATTRIBUTES'
+
+    def add_arguments(self, parser):
+        parser.add_argument('attributes', nargs='*', help='Keys to index (default: CONTACT_INDEXED_ATTRIBUTES)')
+        parser.add_argument('--drop', action='store_true', help='Drop the indexes instead of creating them')
+
+    def handle(self, *args, **options):
+        attributes = options['attributes'] or settings.CONTACT_INDEXED_ATTRIBUTES
+        if not attributes:
+            self.stdout.write(self.style.WARNING("No attributes given and CONTACT_INDEXED_ATTRIBUTES is empty."))
+            return
+
+        with connection.cursor() as cursor:
+            existing = set(connection.introspection.get_constraints(cursor, Contact._meta.db_table))
+
+        with connection.schema_editor() as schema_editor:
+            for name in attributes:
+                column = Contact.column_for_attribute(name)
+                if column:
+                    self.stdout.write(f"'{name}' is stored in the indexed column '{column}', skipping.")
+                    continue
+
+                index = Contact.attribute_index(name)
+                if options['drop']:
+                    if index.name in existing:
+                        schema_editor.remove_index(Contact, index)
+                        self.stdout.write(self.style.SUCCESS(f"Dropped index {index.name} on extra_data['{name}']"))
+                    continue
+
+                if index.name in existing:
+                    self.stdout.write(f"Index {index.name} on extra_data['{name}'] already exists.")
+                    continue
+                schema_editor.add_index(Contact, index)
+                self.stdout.write(self.style.SUCCESS(f"Created index {index.name} on extra_data['{name}']"))
@@ -0,0 +1,183 @@
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db.models import Count
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from emails.models import Audience, Contact, EmailCampaign, EmailLog, Suppression
+from emails.testing.smtp import FakeSMTPServer
+
+LOADTEST_DOMAIN = 'loadtest.example'
+
+DEFAULT_TEMPLATE = """Subject: Load test for [Company]
+
+Hi [Name],
+
+This is a load test message for the team at [Company]. Nothing to see here.
+
+[Portfolio](https://example.com/portfolio) | [GitHub](https://example.com/github)
+"""
+
+
+class Command(BaseCommand):
+    help = 'Load-test send_campaign and send_cold_emails end to end against a local fake SMTP server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--contacts', type=int, default=200, help='Number of synthetic contacts (default: 200)')
+        parser.add_argument(
+            '--commands', nargs='+', default=['send_campaign', 'send_cold_emails'],
+            choices=['send_campaign', 'send_cold_emails'], help='Commands to drive (default: both)'
+        )
+        parser.add_argument('--template', type=str, help='Template to send (default: a small built-in one)')
+        parser.add_argument('--latency', type=float, default=0.01, help='Server latency per reply in seconds (default: 0.01)')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Extra random latency per reply, up to this many seconds')
+        parser.add_argument('--max-connections', type=int, default=0, help='Server connection limit (0 = unlimited)')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Chance of a random 4xx/5xx reply')
+        parser.add_argument('--disconnect-rate', type=float, default=0.0, help='Chance of a dropped connection')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+        parser.add_argument('--keep-data', action='store_true', help='Keep the synthetic contacts, campaigns and logs')
+        parser.add_argument(
+            '--workers', type=int, default=0,
+            help='send_campaign only: queue the campaign, then send it with this many --worker processes'
+        )
+        parser.add_argument('--batch-size', type=int, default=10, help='Messages a worker claims at a time (with --workers)')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp(prefix='loadtest_')
+        run_id = time.strftime('%Y%m%d%H%M%S')
+        try:
+            csv_path = self.write_csv(workdir, run_id, options['contacts'])
+            template_path = options.get('template') or self.write_template(workdir)
+
+            for command in options['commands']:
+                self.run_command(command, csv_path, template_path, run_id, options)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            if not options['keep_data']:
+                self.cleanup(run_id)
+
+    def write_csv(self, workdir, run_id, count):
+        path = os.path.join(workdir, f'loadtest_{run_id}.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Name', 'Company', 'Email', 'Email Status', 'JobRole', 'Location'])
+            for i in range(count):
+                writer.writerow([f'Test User{i}', f'Company {i % 50}', f'user{i}@{LOADTEST_DOMAIN}', 'Valid', 'Engineer', 'Testville'])
+        return path
+
+    def write_template(self, workdir):
+        path = os.path.join(workdir, 'template.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(DEFAULT_TEMPLATE)
+        return path
+
+    def run_command(self, command, csv_path, template_path, run_id, options):
+        server = FakeSMTPServer(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            max_connections=options['max_connections'],
+            fail_rate=options['fail_rate'],
+            disconnect_rate=options['disconnect_rate'],
+            seed=options['seed'],
+        )
+
+        if command == 'send_campaign':
+            campaign_name = f'loadtest-{run_id}'
+            kwargs = {'csv': csv_path, 'template': template_path, 'subject': 'Load test', 'name': campaign_name, 'delay': 0}
+        else:
+            # send_cold_emails names the campaign after the CSV file
+            campaign_name = os.path.basename(csv_path).rsplit('.', 1)[0]
+            kwargs = {'csv': csv_path, 'template': template_path}
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{command}: {options['contacts']} contacts"))
+
+        with server, override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=server.host,
+            EMAIL_PORT=server.port,
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_HOST_USER=f'sender@{LOADTEST_DOMAIN}',
+            EMAIL_HOST_PASSWORD='',
+            DEFAULT_FROM_EMAIL=f'sender@{LOADTEST_DOMAIN}',
+            EMAIL_TIMEOUT=30,
+        ):
+            started = time.perf_counter()
+            output = StringIO()
+            error = None
+            try:
+                if command == 'send_campaign' and options['workers']:
+                    call_command(command, stdout=output, stderr=output, skip_checks=True, enqueue=True, **kwargs)
+                    self.run_workers(server, campaign_name, options)
+                else:
+                    call_command(command, stdout=output, stderr=output, skip_checks=True, **kwargs)
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - started
+
+        logs = EmailLog.objects.filter(campaign__name=campaign_name)
+        sent = logs.filter(status='sent').count()
+        failed = logs.filter(status='failed').count()
+
+        self.stdout.write(f"  Wall time: {elapsed:.2f}s")
+        self.stdout.write(f"  Logged sent: {sent}, failed: {failed}")
+        self.stdout.write(f"  Client throughput: {sent / elapsed:.1f} emails/sec")
+        if options['workers'] and command == 'send_campaign':
+            # Each contact must have exactly one log, and the server must have seen one message per sent log
+            duplicates = logs.values('contact').annotate(logs=Count('pk')).filter(logs__gt=1).count()
+            pending = logs.filter(status='pending').count()
+            self.stdout.write(f"  Workers: {options['workers']}, left pending: {pending}, contacts logged twice: {duplicates}")
+            self.stdout.write(f"  Sent per worker: {dict(logs.filter(status='sent').values_list('leased_by').annotate(Count('pk')))}")
+            if duplicates or pending or server.stats['messages'] != sent:
+                self.stdout.write(self.style.ERROR(f"  Double or missing sends: {server.stats['messages']} messages received for {sent} sent logs"))
+        if error is not None:
+            self.stdout.write(self.style.ERROR(f"  Command aborted: {type(error).__name__}: {error}"))
+        for line in server.summary(elapsed):
+            self.stdout.write(f"  Server {line[0].lower()}{line[1:]}")
+
+    def run_workers(self, server, campaign_name, options):
+        """
+        Runs `send_campaign --worker` in separate processes against the fake server, as separate hosts would.
+        """
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings'),
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=server.host,
+            EMAIL_PORT=str(server.port),
+            EMAIL_USE_TLS='False',
+            EMAIL_HOST_USER=f'sender@{LOADTEST_DOMAIN}',
+            EMAIL_HOST_PASSWORD='',
+        )
+        manage_py = os.path.join(settings.BASE_DIR, 'manage.py')
+        command = [
+            sys.executable, manage_py, 'send_campaign', '--worker', '--name', campaign_name,
+            '--delay', '0', '--batch-size', str(options['batch_size']), '--skip-checks',
+        ]
+        workers = [
+            subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for _ in range(options['workers'])
+        ]
+        for worker in workers:
+            output, _ = worker.communicate()
+            # Only the worker's summary, not a line per message
+            lines = [line for line in output.splitlines() if not line.startswith(('Sent to', 'Failed to send'))]
+            for line in lines[-3:]:
+                self.stdout.write(f"  {line}")
+            if worker.returncode:
+                raise RuntimeError(f"A worker exited with status {worker.returncode}")
+
+    def cleanup(self, run_id):
+        EmailCampaign.objects.filter(name__in=[f'loadtest-{run_id}', f'loadtest_{run_id}']).delete()
+        Audience.objects.filter(name__in=[f'loadtest-{run_id}', f'loadtest_{run_id}']).delete()
+        Contact.objects.filter(email__endswith=f'@{LOADTEST_DOMAIN}').delete()
+        # Bounces from --fail-rate would otherwise skip these addresses in the next run
+        Suppression.objects.filter(email__endswith=f'@{LOADTEST_DOMAIN}').delete()
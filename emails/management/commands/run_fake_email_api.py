@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from emails.testing.api import FakeBatchAPIServer
+
+class Command(BaseCommand):
+    help = 'Run a local mock of the HTTP batch email API (for BatchAPIEmailBackend and load tests)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8025, help='Port to listen on (default: 8025)')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait per request')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds of random latency')
+        parser.add_argument('--per-recipient-latency', type=float, default=0.0, help='Extra seconds per recipient in a request')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Chance (0-1) that a recipient is rejected')
+        parser.add_argument('--api-key', type=str, default='', help='Require this bearer token')
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+
+    def handle(self, *args, **options):
+        server = FakeBatchAPIServer(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            per_recipient_latency=options['per_recipient_latency'],
+            fail_rate=options['fail_rate'],
+            api_key=options['api_key'],
+            seed=options['seed'],
+        )
+        server.start()
+
+        self.stdout.write(self.style.SUCCESS(f"Fake email API listening on {server.url}"))
+        self.stdout.write(f"Point the app at it with: EMAIL_BACKEND=emails.backends.batch_api.BatchAPIEmailBackend EMAIL_API_URL={server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("")
+        for line in server.summary():
+            self.stdout.write(f"  {line}")
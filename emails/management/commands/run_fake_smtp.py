@@ -0,0 +1,40 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+from emails.testing.smtp import FakeSMTPServer
+
+class Command(BaseCommand):
+    help = 'Run a local fake SMTP server with injectable latency and failures (for load tests)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=1025, help='Port to listen on (default: 1025)')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before every reply')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds of random latency')
+        parser.add_argument('--max-connections', type=int, default=0, help='Reject connections beyond this many with 421 (0 = unlimited)')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Chance (0-1) of a random 4xx/5xx reply to MAIL/RCPT/DATA')
+        parser.add_argument('--disconnect-rate', type=float, default=0.0, help='Chance (0-1) of dropping the connection mid-session')
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+
+    def handle(self, *args, **options):
+        server = FakeSMTPServer(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            max_connections=options['max_connections'],
+            fail_rate=options['fail_rate'],
+            disconnect_rate=options['disconnect_rate'],
+            seed=options['seed'],
+        )
+
+        self.stdout.write(self.style.SUCCESS(f"Fake SMTP server listening on {options['host']}:{options['port']}"))
+        self.stdout.write("Point the app at it with: EMAIL_HOST=127.0.0.1 EMAIL_PORT=%d EMAIL_USE_TLS=False" % options['port'])
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("")
+        for line in server.summary():
+            self.stdout.write(f"  {line}")
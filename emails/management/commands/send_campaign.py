@@ -1,10 +1,12 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.core.mail import EmailMultiAlternatives
-from django.template import Template, Context
 from django.conf import settings
-from emails.models import Contact, EmailCampaign, EmailLog
-import csv
-import markdown
+from emails.attachments import AttachmentError, CampaignMessage, load_attachments
+from emails.ingest import CSVIngest, IngestError
+from emails import outbox
+from emails.models import Audience, Contact, EmailCampaign, EmailLog, Suppression
+from emails.pipeline import RenderError, RenderPipeline
+from emails.suppression import SuppressionSet, is_hard_bounce, list_unsubscribe_headers, normalize_email
+from emails.templating import load_template
 import os
 import time
 
@@ -15,17 +17,108 @@ from django.utils import timezone
 class Command(BaseCommand):
     help = 'Send bulk emails from CSV using a Markdown template'
 
+    # Placeholders available besides the CSV columns
+    CONTACT_SLOTS = ['email', 'first_name', 'last_name', 'company']
+
+    # Audience memberships are written in bulk, this many at a time
+    MEMBERSHIP_BATCH_SIZE = 5000
+
     def add_arguments(self, parser):
-        parser.add_argument('--csv', type=str, required=True, help='Path to the CSV file')
-        parser.add_argument('--template', type=str, required=True, help='Path to the Markdown template file')
-        parser.add_argument('--subject', type=str, required=True, help='Subject of the email')
+        parser.add_argument('--csv', action='append', default=[], help='Path (or glob) of a CSV file; repeat to merge several')
+        parser.add_argument('--audience', type=str, help='Audience or segment to send to (with --csv: the audience to import into)')
+        parser.add_argument('--template', type=str, help='Path to the Markdown template file (required unless --worker)')
+        parser.add_argument('--subject', type=str, help='Subject of the email (required unless --worker)')
         parser.add_argument('--name', type=str, help='Name of the campaign')
         parser.add_argument('--delay', type=int, default=10, help='Delay between emails in seconds (default: 10)')
         parser.add_argument('--dry-run', action='store_true', help='Simulate sending without actually sending')
         parser.add_argument('--schedule', type=str, help='Schedule execution time (YYYY-MM-DD HH:MM:SS[+/-HH:MM])')
+        parser.add_argument('--attach', action='append', default=[], help='File to attach to every email (repeat for several files)')
+        parser.add_argument('--render-workers', type=int, help='Render in this many processes (default: SEND_RENDER_WORKERS, 0 = a background thread)')
+        # Several senders, possibly on several hosts, sharing one campaign (see emails/outbox.py)
+        parser.add_argument('--enqueue', action='store_true', help='Queue the messages in the campaign outbox instead of sending them')
+        parser.add_argument('--worker', action='store_true', help='Send queued messages of the campaign --name until none are left')
+        parser.add_argument('--batch-size', type=int, help='Messages a worker claims at a time (default: SEND_CLAIM_BATCH_SIZE)')
+        parser.add_argument('--lease-seconds', type=int, help='How long a claim lasts before other workers may take it over (default: SEND_LEASE_SECONDS)')
+        parser.add_argument('--max-attempts', type=int, help='Tries per queued message before it is marked failed (default: SEND_MAX_ATTEMPTS)')
+
+    def csv_recipients(self, rows):
+        """
+        Yields (email, None, contact fields, context) for each CSV row (see emails.ingest).
+        No database access: this runs in the render-ahead thread, and the sending
+        loop saves the contact (see save_contact).
+        """
+        for row in rows:
+            email = row.get('email') or row.get('Email') or row.get('EMAIL')
+            if not email:
+                self.stdout.write(self.style.WARNING(f"Skipping row with no email: {row}"))
+                continue
+
+            fields = {
+                'first_name': row.get('first_name', '') or row.get('Name', '').split(' ')[0],
+                'last_name': row.get('last_name', '') or ' '.join(row.get('Name', '').split(' ')[1:]),
+                'company': row.get('company', '') or row.get('Company', ''),
+                **Contact.promoted_values(row),
+                'extra_data': row # Store everything just in case
+            }
+            yield email, None, fields, self.build_context(email, fields, row)
+
+    def audience_recipients(self, audience, columns):
+        """
+        Yields (email, contact, None, context) for each audience member; the CSV columns come from extra_data.
+        """
+        for contact in audience.iter_recipients():
+            fields = {'first_name': contact.first_name, 'last_name': contact.last_name, 'company': contact.company}
+            yield contact.email, contact, None, self.build_context(contact.email, fields, contact.extra_data or {}, columns)
+
+    def build_context(self, email, fields, row, columns=()):
+        # Columns a contact has no value for are blank, not left as [Column]
+        context_data = dict.fromkeys(columns, '')
+        context_data.update(row)
+        context_data.update({
+            'email': email,
+            'first_name': fields['first_name'],
+            'last_name': fields['last_name'],
+            'company': fields['company'],
+        })
+        return context_data
+
+    def save_contact(self, email, fields, audience):
+        """
+        Creates/updates a CSV contact and adds it to the audience (memberships are written in batches).
+        A contact whose fields already match (same row_hash) isn't written.
+        """
+        email = normalize_email(email)
+        contact = Contact.objects.filter(email=email).first()
+        if contact is None:
+            contact = Contact.objects.create(email=email, **fields)
+        else:
+            for name, value in fields.items():
+                setattr(contact, name, value)
+            if Contact.compute_row_hash({name: getattr(contact, name) for name in Contact.ROW_HASH_FIELDS}) != contact.row_hash:
+                contact.save()
+
+        self.member_ids.append(contact.pk)
+        if len(self.member_ids) >= self.MEMBERSHIP_BATCH_SIZE:
+            audience.add_contacts(self.member_ids)
+            self.member_ids = []
+        return contact
+
+    def build_message(self, email, subject, html_content, text_content, attachments):
+        msg = CampaignMessage(
+            subject=subject,
+            body=text_content, # Text version
+            from_email=settings.EMAIL_HOST_USER,
+            to=[email],
+            headers=list_unsubscribe_headers(email)
+        )
+        msg.attach_alternative(html_content, "text/html")
+        for attachment in attachments:
+            attachment.attach_to(msg)
+        return msg
 
     def handle(self, *args, **options):
         csv_path = options['csv']
+        audience_name = options.get('audience')
         template_path = options['template']
         # Subject from CLI is fallback/override
         cli_subject = options['subject']
@@ -34,6 +127,22 @@ class Command(BaseCommand):
         dry_run = options['dry_run']
         schedule = options['schedule']
 
+        if options['worker']:
+            if options['enqueue'] or csv_path or audience_name or dry_run:
+                raise CommandError('--worker only sends what --enqueue queued: give it the campaign --name (and optionally --template)')
+            if not options.get('name'):
+                raise CommandError('--worker needs the --name of the campaign to work on')
+        elif not template_path or not cli_subject:
+            raise CommandError('--template and --subject are required')
+        if options['enqueue'] and dry_run:
+            raise CommandError('--dry-run can\'t be combined with --enqueue')
+
+        # Load and encode attachments once for the whole campaign, and check the size limit before any waiting or sending
+        try:
+            attachments = load_attachments(options['attach'])
+        except AttachmentError as e:
+            raise CommandError(str(e))
+
         if schedule:
             try:
                 scheduled_time = datetime.fromisoformat(schedule)
@@ -52,151 +161,278 @@ class Command(BaseCommand):
             except ValueError:
                 raise CommandError(f"Invalid date format for --schedule: '{schedule}'. Use 'YYYY-MM-DD HH:MM:SS[+/-HH:MM]'")
 
-        if not os.path.exists(csv_path):
-            raise CommandError(f'CSV file not found: {csv_path}')
+        if options['worker']:
+            self.run_worker(options['name'], template_path, attachments, options)
+            return
+
+        if csv_path:
+            try:
+                ingest = CSVIngest(csv_path)
+            except IngestError as e:
+                raise CommandError(str(e))
         
         if not os.path.exists(template_path):
             raise CommandError(f'Template file not found: {template_path}')
 
-        # Read Template
-        with open(template_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        if not csv_path and not audience_name:
+            raise CommandError('Either --csv or --audience is required')
 
-        # Parse Subject from Template (if present)
-        template_subject = None
-        body_start_idx = 0
-        
-        if lines and lines[0].strip().lower().startswith('subject:'):
-            # Try to get subject from same line
-            first_line_content = lines[0][8:].strip()
-            if first_line_content:
-                template_subject = first_line_content
-                body_start_idx = 1
-            else:
-                # Try next line if strictly following "Subject:\nActual Subject"
-                if len(lines) > 1 and lines[1].strip():
-                    template_subject = lines[1].strip()
-                    body_start_idx = 2
-                else:
-                    body_start_idx = 1 # Just skip the Subject: line
-        
-        template_content_md = ''.join(lines[body_start_idx:])
-        
-        # Use template subject if found, otherwise CLI subject
-        final_subject_template = template_subject if template_subject else cli_subject
+        if csv_path:
+            # Read CSV; its contacts become the campaign audience (named after the campaign by default)
+            audience, _ = Audience.objects.get_or_create(name=audience_name or campaign_name)
+            if audience.is_segment:
+                raise CommandError(f"Audience '{audience.name}' is a segment and can't be filled from a CSV")
+            audience.memberships.all().delete()
+            audience.columns = ingest.fieldnames
+            audience.save(update_fields=['columns'])
+
+            # Rows stream from every file with headers matched case-insensitively,
+            # emails lower-cased and duplicates dropped (see emails.ingest)
+            columns = ingest.fieldnames
+            recipients = self.csv_recipients(ingest.rows())
+        else:
+            audience = Audience.objects.filter(name=audience_name).first()
+            if audience is None:
+                raise CommandError(f'Audience not found: {audience_name}')
+            columns = audience.template_columns()
+            recipients = self.audience_recipients(audience, columns)
+
+        # Load Template: compiled once per content hash (and set of CSV columns),
+        # so re-running the same template skips parsing and Markdown conversion
+        template = load_template(
+            template_path,
+            columns + self.CONTACT_SLOTS,
+            default_subject=cli_subject,
+            headers='subject_line',
+        )
+        # Template "Subject:" wins over the CLI subject
+        final_subject_template = template.subject
+        self.stdout.write(template.size_report())
 
         # Create Campaign
         campaign, created = EmailCampaign.objects.get_or_create(
             name=campaign_name,
-            defaults={'subject': final_subject_template, 'template_path': template_path}
+            defaults={'subject': final_subject_template, 'template_path': template_path, 'template_hash': template.content_hash, 'audience': audience, 'columns': columns}
         )
+        if not created:
+            campaign.template_path = template_path
+            campaign.template_hash = template.content_hash
+            campaign.audience = audience
+            campaign.columns = columns
+            campaign.save(update_fields=['template_path', 'template_hash', 'audience', 'columns'])
 
-        # Read CSV
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            # Normalize headers - strip whitespace
-            reader.fieldnames = [name.strip() for name in reader.fieldnames]
-            
-            for row in reader:
-                email = row.get('email') or row.get('Email') or row.get('EMAIL')
-                if not email:
-                    self.stdout.write(self.style.WARNING(f"Skipping row with no email: {row}"))
-                    continue
-                
-                # Create/Update Contact
-                contact, _ = Contact.objects.update_or_create(
-                    email=email,
-                    defaults={
-                        'first_name': row.get('first_name', '') or row.get('Name', '').split(' ')[0],
-                        'last_name': row.get('last_name', '') or ' '.join(row.get('Name', '').split(' ')[1:]),
-                        'company': row.get('company', '') or row.get('Company', ''),
-                        'extra_data': row # Store everything just in case
-                    }
-                )
+        # Suppressed addresses, loaded once and checked in memory for every recipient
+        suppressed = SuppressionSet.load()
+        if suppressed:
+            self.stdout.write(f"Loaded {len(suppressed)} suppressed addresses ({suppressed.nbytes // 1024} KiB)")
 
-                # Prepare Context
-                context_data = row.copy()
-                context_data.update({
-                    'email': contact.email,
-                    'first_name': contact.first_name,
-                    'last_name': contact.last_name,
-                    'company': contact.company,
-                })
-
-                # --- RENDER SUBJECT ---
-                rendered_subject = final_subject_template
-                # 1. Try [Key] replacement (for columns present in CSV)
-                for key, value in context_data.items():
-                    if key and value:
-                        rendered_subject = rendered_subject.replace(f'[{key}]', str(value))
-                
-                # 2. Try {{ Key }} replacement (Django style)
-                django_subject_tmpl = Template(rendered_subject)
-                django_context = Context(context_data)
-                rendered_subject = django_subject_tmpl.render(django_context)
+        if options['enqueue']:
+            self.enqueue(campaign, recipients, suppressed, audience, final_subject_template)
+            if csv_path:
+                for line in ingest.summary():
+                    self.stdout.write(line)
+            return
 
+        # Render ahead: a background thread reads the recipients and renders them into a
+        # bounded queue ([Key] slots, {{ Key }} tags and Markdown were resolved when the
+        # template was compiled), while this loop sends and waits on the server
+        pipeline = RenderPipeline(template, workers=options['render_workers'])
+        jobs = (
+            ((email, contact, fields), context_data, None)
+            for email, contact, fields, context_data in suppressed.exclude(recipients, email=lambda recipient: recipient[0])
+        )
+        self.member_ids = []
 
-                # --- RENDER BODY ---
-                # 1. [Key] Replacement
-                # We iterate over the CSV keys and replace [Key] with Value.
-                # This avoids replacing things like [Link Text](url) unless "Link Text" is actually a CSV column.
-                
-                rendered_md = template_content_md
-                for key, value in context_data.items():
-                    if key: # ensure key is not None/Empty
-                        # Simple string replace
-                        # Note: This is case-sensitive based on CSV header.
-                        # If CSV has "Name", it replaces [Name].
-                        placeholder = f'[{key}]'
-                        rendered_md = rendered_md.replace(placeholder, str(value))
-                
-                # 2. Django Template Replacement (fallback/advanced)
-                django_template = Template(rendered_md)
-                rendered_md = django_template.render(django_context)
-
-                # 3. Convert Markdown to HTML
-                html_content = markdown.markdown(rendered_md)
-
-                if dry_run:
-                    self.stdout.write(f"\n[Dry Run] Sending to {email}...")
-                    self.stdout.write(f"Subject: {rendered_subject}")
-                    self.stdout.write(f"--- Body (Full Preview) ---")
-                    self.stdout.write(rendered_md)
-                    self.stdout.write(f"--------------------------------\n")
-                    continue
-
-                # Send Email
-                try:
-                    msg = EmailMultiAlternatives(
-                        subject=rendered_subject,
-                        body=rendered_md, # Text version
-                        from_email=settings.EMAIL_HOST_USER,
-                        to=[email]
-                    )
-                    msg.attach_alternative(html_content, "text/html")
-                    msg.send()
+        for (email, contact, fields), rendered in pipeline.run(jobs):
+            if contact is None:
+                contact = self.save_contact(email, fields, audience)
 
-                    # Log Success
-                    EmailLog.objects.create(
-                        campaign=campaign,
-                        contact=contact,
-                        subject=rendered_subject,
-                        status='sent'
-                    )
-                    self.stdout.write(self.style.SUCCESS(f"Sent to {email}"))
-                
-                except Exception as e:
-                    # Log Failure
+            if isinstance(rendered, RenderError):
+                if not dry_run:
                     EmailLog.objects.create(
-                        campaign=campaign,
-                        contact=contact,
-                        subject=rendered_subject,
-                        status='failed',
-                        error_message=str(e)
+                        campaign=campaign, contact=contact, subject=final_subject_template,
+                        status='failed', error_message=str(rendered),
                     )
-                    self.stdout.write(self.style.ERROR(f"Failed to send to {email}: {e}"))
+                self.stdout.write(self.style.ERROR(f"Failed to render the message to {email}: {rendered}"))
+                continue
+            rendered_subject, html_content, rendered_md = rendered
+
+            if dry_run:
+                self.stdout.write(f"\n[Dry Run] Sending to {email}...")
+                self.stdout.write(f"Subject: {rendered_subject}")
+                self.stdout.write(f"--- Body (Full Preview) ---")
+                self.stdout.write(rendered_md)
+                self.stdout.write(f"--------------------------------\n")
+                continue
+
+            # Send Email
+            try:
+                self.build_message(email, rendered_subject, html_content, rendered_md, attachments).send()
+
+                # Log Success
+                EmailLog.objects.create(
+                    campaign=campaign,
+                    contact=contact,
+                    subject=rendered_subject,
+                    status='sent'
+                )
+                self.stdout.write(self.style.SUCCESS(f"Sent to {email}"))
+            
+            except Exception as e:
+                # Log Failure
+                EmailLog.objects.create(
+                    campaign=campaign,
+                    contact=contact,
+                    subject=rendered_subject,
+                    status='failed',
+                    error_message=str(e)
+                )
+                self.stdout.write(self.style.ERROR(f"Failed to send to {email}: {e}"))
+                if is_hard_bounce(e):
+                    Suppression.suppress([email], Suppression.BOUNCE, note=str(e))
+
+            # Delay to prevent spam
+            if delay > 0:
+                self.stdout.write(f"Waiting {delay} seconds...")
+                time.sleep(delay)
+
+        if self.member_ids:
+            audience.add_contacts(self.member_ids)
+
+        if csv_path:
+            for line in ingest.summary():
+                self.stdout.write(line)
+        for line in pipeline.summary():
+            self.stdout.write(line)
+
+        if suppressed.skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped {suppressed.skipped} unsubscribed/bounced/blocked addresses"))
+
+    def enqueue(self, campaign, recipients, suppressed, audience, subject):
+        """
+        Saves the recipients' contacts and queues a message to each in the
+        campaign outbox, for any number of `--worker` processes to send.
+        """
+        self.member_ids = []
+        queued = 0
+        contact_ids = []
+        for email, contact, fields, _ in suppressed.exclude(recipients, email=lambda recipient: recipient[0]):
+            if contact is None:
+                contact = self.save_contact(email, fields, audience)
+            contact_ids.append(contact.pk)
+            if len(contact_ids) >= self.MEMBERSHIP_BATCH_SIZE:
+                queued += outbox.enqueue(campaign, contact_ids, subject)
+                contact_ids = []
+        if contact_ids:
+            queued += outbox.enqueue(campaign, contact_ids, subject)
+        if self.member_ids:
+            audience.add_contacts(self.member_ids)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Queued {queued} messages for campaign '{campaign.name}' ({outbox.pending(campaign).count()} pending in total)"
+        ))
+        if suppressed.skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped {suppressed.skipped} unsubscribed/bounced/blocked addresses"))
+        self.stdout.write(f"Start senders with: manage.py send_campaign --worker --name \"{campaign.name}\"")
 
-                # Delay to prevent spam
-                if delay > 0:
-                    self.stdout.write(f"Waiting {delay} seconds...")
-                    time.sleep(delay)
+    def run_worker(self, campaign_name, template_path, attachments, options):
+        """
+        Claims batches of queued messages (a lease, see emails/outbox.py), sends
+        them and records each result, until the campaign has nothing pending.
+        Leases of workers that died are taken over once they expire.
+        """
+        campaign = EmailCampaign.objects.filter(name=campaign_name).order_by('-created_at').first()
+        if campaign is None:
+            raise CommandError(f'Campaign not found: {campaign_name}')
+        template_path = template_path or campaign.template_path
+        if not os.path.exists(template_path):
+            raise CommandError(f'Template file not found: {template_path}')
+
+        # The columns the enqueuer compiled with (campaigns queued before they were saved: the audience's)
+        columns = campaign.columns or (campaign.audience.template_columns() if campaign.audience else [])
+        template = load_template(template_path, columns + self.CONTACT_SLOTS, default_subject=campaign.subject, headers='subject_line')
+        if campaign.template_hash and template.content_hash != campaign.template_hash:
+            raise CommandError(f'{template_path} differs from the template the campaign was queued with')
+
+        worker = outbox.worker_name()
+        batch_size = options['batch_size'] or settings.SEND_CLAIM_BATCH_SIZE
+        lease_seconds = options['lease_seconds'] or settings.SEND_LEASE_SECONDS
+        max_attempts = options.get('max_attempts') or settings.SEND_MAX_ATTEMPTS
+        delay = options['delay']
+        suppressed = SuppressionSet.load()
+        totals = {'claims': 0, 'sent': 0, 'failed': 0, 'suppressed': 0, 'lost': 0, 'given_up': 0}
+
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker} sending campaign '{campaign.name}' ({outbox.pending(campaign).count()} pending)"))
+        started = time.perf_counter()
+
+        while True:
+            logs, expires = outbox.claim(campaign, worker, batch_size, lease_seconds, max_attempts)
+            if not logs:
+                # Messages that kept killing their workers
+                totals['given_up'] += outbox.give_up(campaign, max_attempts)
+                if not outbox.pending(campaign).exists():
+                    break
+                # The rest is leased to other workers; wait in case one of them dies
+                time.sleep(min(settings.SEND_WORKER_POLL_SECONDS, lease_seconds))
+                continue
+            totals['claims'] += 1
+
+            try:
+                while logs:
+                    # Renew well before the lease runs out (slow server, --delay); drop what was lost
+                    if (expires - timezone.now()).total_seconds() < lease_seconds / 2:
+                        held, expires = outbox.renew(logs, worker, expires, lease_seconds)
+                        totals['lost'] += len(logs) - len(held)
+                        logs = held
+                        if not logs:
+                            break
+
+                    email_log = logs.pop(0)
+                    contact = email_log.contact
+                    if contact.email in suppressed:
+                        outbox.drop(email_log, worker)
+                        totals['suppressed'] += 1
+                        continue
+
+                    if not outbox.start(email_log, worker):
+                        totals['lost'] += 1
+                        continue
+
+                    fields = {'first_name': contact.first_name, 'last_name': contact.last_name, 'company': contact.company}
+                    rendered_subject = campaign.subject
+                    try:
+                        # Rendering is inside: a message that can't be rendered fails on its own
+                        rendered_subject, html_content, rendered_md = template.render(
+                            self.build_context(contact.email, fields, contact.extra_data or {}, columns)
+                        )
+                        self.build_message(contact.email, rendered_subject, html_content, rendered_md, attachments).send()
+                    except Exception as e:
+                        outbox.complete(email_log, worker, 'failed', rendered_subject, error=str(e))
+                        totals['failed'] += 1
+                        self.stdout.write(self.style.ERROR(f"Failed to send to {contact.email}: {e}"))
+                        if is_hard_bounce(e):
+                            Suppression.suppress([contact.email], Suppression.BOUNCE, note=str(e))
+                    else:
+                        if not outbox.complete(email_log, worker, 'sent', rendered_subject):
+                            self.stdout.write(self.style.WARNING(f"Sent to {contact.email} after losing the lease"))
+                        totals['sent'] += 1
+                        self.stdout.write(self.style.SUCCESS(f"Sent to {contact.email}"))
+
+                    if delay > 0 and logs:
+                        time.sleep(delay)
+            finally:
+                # Interrupted or lost the lease: hand back what wasn't sent
+                if logs:
+                    outbox.release(logs, worker)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Worker {worker}: sent {totals['sent']}, failed {totals['failed']} in {totals['claims']} claims "
+            f"({elapsed:.1f}s, {totals['sent'] / (elapsed or 1e-9):.1f} emails/sec)"
+        )
+        if totals['suppressed']:
+            self.stdout.write(self.style.WARNING(f"Dropped {totals['suppressed']} queued messages to addresses suppressed since queueing"))
+        if totals['lost']:
+            self.stdout.write(self.style.WARNING(f"Lost the lease on {totals['lost']} messages (taken over by another worker)"))
+        if totals['given_up']:
+            self.stdout.write(self.style.ERROR(f"Marked {totals['given_up']} messages failed after {max_attempts} attempts each"))
@@ -1,4 +1,7 @@
 from django.core.management.base import BaseCommand
+from emails.attachments import AttachmentError, load_attachments
+from emails.ingest import IngestError, expand_paths
+from emails.models import Audience
 from emails.services import EmailEngine
 import os
 
@@ -6,29 +9,73 @@ class Command(BaseCommand):
     help = 'Send cold emails from a CSV file using a Markdown template'
 
     def add_arguments(self, parser):
-        parser.add_argument('--csv', type=str, required=True, help='Path to CSV file containing contacts')
+        parser.add_argument('--csv', action='append', default=[], help='CSV file (or glob, e.g. "lists/*.csv") containing contacts; repeat for several')
+        parser.add_argument('--audience', type=str, help='Name of the audience or segment to send to (with --csv: the audience to import into)')
         parser.add_argument('--template', type=str, required=True, help='Path to Markdown template file')
         parser.add_argument('--subject', type=str, default='Cold Outreach', help='Default subject (can be overridden by template)')
         parser.add_argument('--dry-run', action='store_true', help='Process files but do not actually send emails')
+        parser.add_argument('--attach', action='append', default=[], help='File to attach to every email (repeat for several files)')
+        parser.add_argument('--render-workers', type=int, help='Render in this many processes (default: SEND_RENDER_WORKERS, 0 = a background thread)')
+
+    @staticmethod
+    def campaign_name(csv_paths):
+        # Named after the first CSV file
+        return os.path.basename(csv_paths[0]).rsplit('.', 1)[0]
 
     def handle(self, *args, **options):
         csv_path = options['csv']
         template_path = options['template']
         subject = options['subject']
         dry_run = options['dry_run']
+        audience_name = options.get('audience')
 
-        if not os.path.exists(csv_path):
-            self.stdout.write(self.style.ERROR(f"CSV file not found: {csv_path}"))
+        if not csv_path and not audience_name:
+            self.stdout.write(self.style.ERROR("Either --csv or --audience is required"))
             return
-            
+
+        if csv_path:
+            try:
+                csv_path = expand_paths(csv_path)
+            except IngestError as e:
+                self.stdout.write(self.style.ERROR(str(e)))
+                return
+
+        audience = None
+        if audience_name:
+            if csv_path:
+                audience, _ = Audience.objects.get_or_create(name=audience_name)
+                if audience.is_segment:
+                    self.stdout.write(self.style.ERROR(f"Audience '{audience_name}' is a segment and can't be filled from a CSV"))
+                    return
+            else:
+                audience = Audience.objects.filter(name=audience_name).first()
+                if audience is None:
+                    self.stdout.write(self.style.ERROR(f"Audience not found: {audience_name}"))
+                    return
+        elif csv_path:
+            # Without --audience the CSV is imported into an audience named after the campaign
+            existing = Audience.objects.filter(name=self.campaign_name(csv_path)).first()
+            if existing is not None and existing.is_segment:
+                self.stdout.write(self.style.ERROR(
+                    f"Audience '{existing.name}' is a segment and can't be filled from a CSV; pass --audience to import into another one"
+                ))
+                return
+
         if not os.path.exists(template_path):
             self.stdout.write(self.style.ERROR(f"Template file not found: {template_path}"))
             return
 
+        # Load and encode attachments once for the whole campaign
+        try:
+            attachments = load_attachments(options['attach'])
+        except AttachmentError as e:
+            self.stdout.write(self.style.ERROR(str(e)))
+            return
+
         self.stdout.write(self.style.SUCCESS(f"Starting campaign... (Dry Run: {dry_run})"))
         
-        # Determine Campaign Name from CSV filename
-        campaign_name = os.path.basename(csv_path).rsplit('.', 1)[0]
+        # Determine Campaign Name from the (first) CSV filename, or the audience
+        campaign_name = self.campaign_name(csv_path) if csv_path else audience.name
         self.stdout.write(f"Campaign Name: {campaign_name}")
 
         results = EmailEngine.send_campaign(
@@ -36,12 +83,17 @@ class Command(BaseCommand):
             subject=subject,
             template_path=template_path,
             csv_path=csv_path,
-            dry_run=dry_run
+            dry_run=dry_run,
+            audience=audience,
+            attachments=attachments,
+            render_workers=options['render_workers']
         )
         
         # Report
         import_stats = results['import_stats']
-        self.stdout.write(f"Contacts Processed: {import_stats['created']} created, {import_stats['updated']} updated.")
+        self.stdout.write(f"Contacts Processed: {import_stats['created']} created, {import_stats['updated']} updated, {import_stats['unchanged']} unchanged.")
+        for line in import_stats.get('ingest', []):
+            self.stdout.write(f"  {line}")
         
         if import_stats['errors']:
             self.stdout.write(self.style.WARNING(f"Import Errors: {len(import_stats['errors'])}"))
@@ -49,7 +101,13 @@ class Command(BaseCommand):
                 self.stdout.write(f"  - {err}")
 
         self.stdout.write(self.style.SUCCESS(f"Emails Sent: {results['sent']}"))
+        if results['suppressed']:
+            self.stdout.write(self.style.WARNING(f"Skipped (unsubscribed/bounced/blocked): {results['suppressed']}"))
         
+        self.stdout.write(f"  {results['body_size']}")
+        for line in results['pipeline']:
+            self.stdout.write(f"  {line}")
+
         if results['errors']:
             self.stdout.write(self.style.ERROR(f"Sending Errors: {len(results['errors'])}"))
             for err in results['errors']:
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from emails.models import Suppression
+from emails.suppression import normalize_email
+import csv
+import os
+
+
+class Command(BaseCommand):
+    help = 'Block addresses from ever being emailed (or lift a block with --remove)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('emails', nargs='*', help='Addresses to suppress')
+        parser.add_argument('--csv', type=str, help='CSV file with an Email column')
+        parser.add_argument('--reason', choices=[Suppression.MANUAL, Suppression.UNSUBSCRIBE, Suppression.BOUNCE], default=Suppression.MANUAL)
+        parser.add_argument('--note', type=str, default='', help='Why the addresses were blocked')
+        parser.add_argument('--remove', action='store_true', help='Remove the addresses from the suppression list instead')
+
+    def read_csv(self, csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            reader.fieldnames = [name.strip() for name in reader.fieldnames]
+            for row in reader:
+                email = row.get('Email') or row.get('email') or row.get('EMAIL')
+                if email:
+                    yield email
+
+    def handle(self, *args, **options):
+        emails = list(options['emails'])
+        csv_path = options['csv']
+        if csv_path:
+            if not os.path.exists(csv_path):
+                raise CommandError(f'CSV file not found: {csv_path}')
+            emails.extend(self.read_csv(csv_path))
+
+        if not emails:
+            raise CommandError('Give addresses to suppress, or --csv')
+
+        if options['remove']:
+            deleted, _ = Suppression.objects.filter(email__in=[normalize_email(email) for email in emails]).delete()
+            self.stdout.write(self.style.SUCCESS(f"Removed {deleted} addresses from the suppression list"))
+            return
+
+        count = Suppression.suppress(emails, options['reason'], note=options['note'])
+        self.stdout.write(self.style.SUCCESS(f"Suppressed {count} addresses ({Suppression.objects.count()} in total)"))
@@ -0,0 +1,244 @@
+import bisect
+import ipaddress
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; suits in-process work (tracking hits, buffer flushes)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _sample(name, labelnames, labelvalues, value, extra=()):
+    pairs = [f'{label}="{_escape(value)}"' for label, value in (*zip(labelnames, labelvalues), *extra)]
+    labels = '{' + ','.join(pairs) + '}' if pairs else ''
+    return f'{name}{labels} {_format_value(value)}'
+
+
+class Metric:
+    """
+    A metric family with optional labels, values keyed by the label values:
+
+        TRACKING_REQUESTS = Counter('coldmail_tracking_requests_total', 'Tracking hits', ['type'])
+        TRACKING_REQUESTS.inc('open')
+
+    Updates take one lock and a dict lookup, so they can sit on request paths.
+    Counters and gauges can instead be read from `function` at scrape time: it
+    returns a number, or a dict of label value tuples -> number.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {labelvalues}")
+        return tuple(str(value) for value in labelvalues)
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            values = list(values.items()) if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for labelvalues, value in sorted(values):
+            yield _sample(self.name, self.labelnames, labelvalues, value)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for labelvalues, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                cumulative += bucket_count
+                yield _sample(f'{self.name}_bucket', self.labelnames, labelvalues, cumulative, extra=[('le', _format_value(float(bound)))])
+            yield _sample(f'{self.name}_sum', self.labelnames, labelvalues, total)
+            yield _sample(f'{self.name}_count', self.labelnames, labelvalues, count)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# --- Database gauges ---
+
+def email_log_counts():
+    """
+    EmailLog rows per status, in total and sent in the last minute. Two
+    queries on the (status, sent_at) index, cached for METRICS_CACHE_SECONDS
+    so frequent scrapes don't add load.
+    """
+    from django.core.cache import cache
+    from django.db.models import Count
+    from django.utils import timezone
+    from .models import EmailLog
+
+    def query():
+        since = timezone.now() - timedelta(seconds=60)
+        return {
+            'total': dict(EmailLog.objects.order_by().values_list('status').annotate(Count('pk'))),
+            'last_minute': dict(EmailLog.objects.filter(sent_at__gte=since).order_by().values_list('status').annotate(Count('pk'))),
+        }
+
+    return cache.get_or_set('metrics:email_log_counts', query, settings.METRICS_CACHE_SECONDS)
+
+
+def _by_status(period):
+    def read():
+        return {(status,): count for status, count in email_log_counts()[period].items()}
+    return read
+
+
+def _outbox_backlog():
+    from .models import EmailLog
+    return email_log_counts()['total'].get(EmailLog.PENDING, 0)
+
+
+def _tracking_buffer(name):
+    def read():
+        from .tracking import get_event_buffer
+        buffer = get_event_buffer()
+        return buffer.pending() if name == 'pending' else buffer.stats[name]
+    return read
+
+
+def _enrichment_cache(field):
+    def read():
+        from .enrichment import cache_stats
+        return {(name,): getattr(info, field) for name, info in cache_stats().items()}
+    return read
+
+
+# --- Metrics ---
+
+TRACKING_REQUESTS = Counter('coldmail_tracking_requests_total', 'Open/click tracking hits by outcome (queued, deduped, invalid)', ['type', 'outcome'])
+TRACKING_LATENCY = Histogram('coldmail_tracking_request_seconds', 'Time spent serving a tracking hit', ['type'])
+TRACKING_FLUSH = Histogram('coldmail_tracking_flush_seconds', 'Time to bulk insert one batch of tracking events',
+                           buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+TRACKING_FLUSH_SIZE = Histogram('coldmail_tracking_flush_events', 'Events per tracking flush', buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+Gauge('coldmail_tracking_buffer_pending', 'Tracking events waiting for the next flush', function=_tracking_buffer('pending'))
+Counter('coldmail_tracking_events_written_total', 'Tracking events written by this process', function=_tracking_buffer('written'))
+Counter('coldmail_tracking_events_dropped_total', 'Tracking events lost to failed inserts in this process', function=_tracking_buffer('dropped'))
+Counter('coldmail_enrichment_cache_hits_total', 'User-agent / IP lookups answered from the cache', ['cache'], function=_enrichment_cache('hits'))
+Counter('coldmail_enrichment_cache_misses_total', 'User-agent / IP lookups that were parsed or looked up', ['cache'], function=_enrichment_cache('misses'))
+
+Gauge('coldmail_email_logs', 'Email log rows by status', ['status'], function=_by_status('total'))
+Gauge('coldmail_emails_last_minute', 'Emails logged in the last 60 seconds by status (send rate and failures)', ['status'],
+      function=_by_status('last_minute'))
+Gauge('coldmail_outbox_backlog', 'Messages queued by send_campaign --enqueue and not sent yet', function=_outbox_backlog)
+
+
+def render():
+    return REGISTRY.expose()
+
+
+def scrape_allowed(meta):
+    """
+    Whether a request (its META) may read /metrics: None when metrics are off
+    (neither METRICS_TOKEN nor METRICS_ALLOWED_IPS is set), else True/False.
+    The address check uses REMOTE_ADDR, not X-Forwarded-For, which the client controls.
+    """
+    token, allowed = settings.METRICS_TOKEN, settings.METRICS_ALLOWED_IPS
+    if not token and not allowed:
+        return None
+    if token and not constant_time_compare(meta.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return False
+    if allowed:
+        try:
+            address = ipaddress.ip_address(meta.get('REMOTE_ADDR') or '')
+        except ValueError:
+            return False
+        return any(address in ipaddress.ip_network(network, strict=False) for network in allowed)
+    return True
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='template_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the template contents (key of the compiled template cache)', max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-19 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0002_campaign_template_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='email_status',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='job_role',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='location',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+    ]
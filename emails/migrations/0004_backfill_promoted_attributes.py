@@ -0,0 +1,77 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+# Same mapping as Contact.PROMOTED_COLUMNS (historical models don't carry class attributes)
+PROMOTED_COLUMNS = {
+    'job_role': ('Job Role', 'JobRole', 'job_role'),
+    'location': ('Location', 'location'),
+    'email_status': ('Email Status', 'EmailStatus', 'email_status'),
+}
+
+
+def backfill_promoted_attributes(apps, schema_editor):
+    """
+    Copies job role, location and email status out of extra_data, one batch of
+    primary keys at a time so large tables are never loaded at once.
+    """
+    Contact = apps.get_model('emails', 'Contact')
+    db_alias = schema_editor.connection.alias
+    last_pk = 0
+
+    while True:
+        batch = list(
+            Contact.objects.using(db_alias)
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .only('pk', 'extra_data', *PROMOTED_COLUMNS)[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        changed = []
+        for contact in batch:
+            extra_data = contact.extra_data or {}
+            dirty = False
+            for column, headers in PROMOTED_COLUMNS.items():
+                if getattr(contact, column):
+                    continue
+                for header in headers:
+                    if extra_data.get(header):
+                        setattr(contact, column, str(extra_data[header]).strip())
+                        dirty = True
+                        break
+            if dirty:
+                changed.append(contact)
+
+        if changed:
+            Contact.objects.using(db_alias).bulk_update(changed, list(PROMOTED_COLUMNS))
+
+
+def create_extra_data_gin_index(apps, schema_editor):
+    # GIN (jsonb_path_ops) serves extra_data__contains lookups; Postgres only
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS emails_contact_extra_data_gin '
+        'ON emails_contact USING gin (extra_data jsonb_path_ops)'
+    )
+
+
+def drop_extra_data_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS emails_contact_extra_data_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0003_contact_promoted_attributes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_promoted_attributes, migrations.RunPython.noop),
+        migrations.RunPython(create_extra_data_gin_index, drop_extra_data_gin_index),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 6.0 on 2026-10-19 17:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0004_backfill_promoted_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Audience',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('filters', models.JSONField(blank=True, default=dict, help_text='Segment filters; empty for imported audiences')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='audience',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='campaigns', to='emails.audience'),
+        ),
+        migrations.CreateModel(
+            name='AudienceMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('added_at', models.DateTimeField(auto_now_add=True)),
+                ('audience', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='emails.audience')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='audience_memberships', to='emails.contact')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='audience',
+            name='contacts',
+            field=models.ManyToManyField(related_name='audiences', through='emails.AudienceMember', to='emails.contact'),
+        ),
+        migrations.AddConstraint(
+            model_name='audiencemember',
+            constraint=models.UniqueConstraint(fields=('audience', 'contact'), name='unique_audience_member'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-19 17:34
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0005_audience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackingEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tracking_id', models.UUIDField()),
+                ('event_type', models.CharField(choices=[('open', 'Open'), ('click', 'Click')], max_length=10)),
+                ('url', models.TextField(blank=True)),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True)),
+                ('user_agent', models.TextField(blank=True)),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-occurred_at'],
+                'indexes': [models.Index(fields=['tracking_id', 'event_type'], name='emails_trac_trackin_87ac27_idx'), models.Index(fields=['occurred_at'], name='emails_trac_occurre_713d3c_idx')],
+            },
+        ),
+    ]
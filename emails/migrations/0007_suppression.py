@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-19 17:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0006_trackingevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(help_text='Normalized (stripped, lower case)', max_length=254, unique=True)),
+                ('address_hash', models.BigIntegerField(db_index=True, editable=False)),
+                ('reason', models.CharField(choices=[('unsubscribe', 'Unsubscribed'), ('bounce', 'Hard bounce'), ('manual', 'Manual block')], max_length=20)),
+                ('note', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
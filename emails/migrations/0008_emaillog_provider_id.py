@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0007_suppression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emaillog',
+            name='provider_id',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
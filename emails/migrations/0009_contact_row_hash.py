@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 17:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0008_emaillog_provider_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='row_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-19 17:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0009_contact_row_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emaillog',
+            index=models.Index(fields=['status', 'sent_at'], name='emaillog_status_sent_at'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 6.0 on 2026-10-19 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0010_emaillog_status_sent_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackingevent',
+            name='city',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='trackingevent',
+            name='client',
+            field=models.CharField(blank=True, help_text='Mail client or browser', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='trackingevent',
+            name='country',
+            field=models.CharField(blank=True, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='trackingevent',
+            name='device',
+            field=models.CharField(blank=True, choices=[('desktop', 'Desktop'), ('mobile', 'Mobile'), ('tablet', 'Tablet'), ('proxy', 'Mail image proxy'), ('bot', 'Bot / link scanner'), ('unknown', 'Unknown')], max_length=10),
+        ),
+        migrations.AddField(
+            model_name='trackingevent',
+            name='is_automated',
+            field=models.BooleanField(default=False, help_text="Fetched by a proxy or scanner, not the recipient's own client"),
+        ),
+        migrations.AddField(
+            model_name='trackingevent',
+            name='region',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
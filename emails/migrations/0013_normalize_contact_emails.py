@@ -0,0 +1,63 @@
+from django.db import migrations
+from django.db.models import F
+from django.db.models.functions import Lower, Trim
+
+BATCH_SIZE = 1000
+
+
+def normalize_contact_emails(apps, schema_editor):
+    """
+    Strips and lower-cases contact emails, as CSV imports do (emails.ingest).
+    Contacts that only differed in case are merged into the oldest one: their
+    audience memberships and email logs move over and the others are deleted.
+    Only rows that aren't normalized yet are read, one batch of primary keys at a time.
+    """
+    Contact = apps.get_model('emails', 'Contact')
+    AudienceMember = apps.get_model('emails', 'AudienceMember')
+    EmailLog = apps.get_model('emails', 'EmailLog')
+    db_alias = schema_editor.connection.alias
+    contacts = Contact.objects.using(db_alias)
+    last_pk = 0
+
+    while True:
+        batch = list(
+            contacts.annotate(normalized=Lower(Trim('email')))
+            .exclude(email=F('normalized'))
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', 'normalized')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        # normalized email -> pks of the contacts that share it, including one already normalized
+        groups = {}
+        for email, pk in contacts.filter(email__in={normalized for _, normalized in batch}).values_list('email', 'pk'):
+            groups[email] = [pk]
+        for pk, normalized in batch:
+            groups.setdefault(normalized, []).append(pk)
+
+        for email, pks in groups.items():
+            keeper, *duplicates = sorted(pks)
+            for duplicate in duplicates:
+                # One at a time: two duplicates can be in the same audience
+                keeper_audiences = list(AudienceMember.objects.using(db_alias).filter(contact_id=keeper).values_list('audience_id', flat=True))
+                members = AudienceMember.objects.using(db_alias).filter(contact_id=duplicate)
+                members.filter(audience_id__in=keeper_audiences).delete()
+                members.update(contact_id=keeper)
+                EmailLog.objects.using(db_alias).filter(contact_id=duplicate).update(contact_id=keeper)
+            if duplicates:
+                contacts.filter(pk__in=duplicates).delete()
+            contacts.filter(pk=keeper).exclude(email=email).update(email=email)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0012_emaillog_outbox_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_contact_emails, migrations.RunPython.noop),
+    ]
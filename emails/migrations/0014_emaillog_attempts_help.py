@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0013_normalize_contact_emails'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emaillog',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Times a worker started sending the message'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.0 on 2026-10-19 19:10
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def backfill_audience_columns(apps, schema_editor):
+    """
+    Saves the CSV columns of existing imported audiences: every extra_data key
+    of their members, one batch of primary keys at a time.
+    """
+    Audience = apps.get_model('emails', 'Audience')
+    Contact = apps.get_model('emails', 'Contact')
+    db_alias = schema_editor.connection.alias
+
+    for audience in Audience.objects.using(db_alias).all():
+        if audience.filters:
+            continue # Segments have no import; their columns are read from the contacts
+        members = (
+            Contact.objects.using(db_alias)
+            .filter(audience_memberships__audience=audience)
+            .order_by('pk')
+            .values_list('pk', 'extra_data')
+        )
+        columns = {}
+        last_pk = 0
+        while True:
+            batch = list(members.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            for _, extra_data in batch:
+                columns.update(dict.fromkeys(extra_data or {}))
+        if columns:
+            audience.columns = list(columns)
+            audience.save(update_fields=['columns'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0014_emaillog_attempts_help'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audience',
+            name='columns',
+            field=models.JSONField(blank=True, default=list, help_text='CSV columns imported into the audience, in file order'),
+        ),
+        migrations.RunPython(backfill_audience_columns, migrations.RunPython.noop),
+    ]
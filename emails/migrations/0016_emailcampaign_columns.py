@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 18:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0015_audience_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='columns',
+            field=models.JSONField(blank=True, default=list, help_text='CSV columns the template was compiled with (placeholders for queued sends)'),
+        ),
+    ]
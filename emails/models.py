@@ -1,31 +1,279 @@
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
+from django.db.models.lookups import Exact, In
 from django.utils import timezone
+import hashlib
+import json
 import uuid
 
+
+class ExtraDataText(models.Func):
+    """
+    extra_data[key] as text. Compiles to the same SQL in queries and in index
+    definitions, so the planner can match filters against the expression index.
+    """
+    output_field = models.TextField()
+
+    def __init__(self, key):
+        self.key = key
+        super().__init__(models.F('extra_data'))
+
+    @staticmethod
+    def _literal(value):
+        # Inlined rather than bound: SQLite only uses an expression index when the
+        # query repeats the indexed expression literally
+        return "'" + value.replace("'", "''").replace('%', '%%') + "'"
+
+    def as_sql(self, compiler, connection, **extra_context):
+        column, params = compiler.compile(self.source_expressions[0])
+        path = '$."' + self.key + '"'
+        return f"JSON_EXTRACT({column}, {self._literal(path)})", params
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        column, params = compiler.compile(self.source_expressions[0])
+        return f"({column} ->> {self._literal(self.key)})", params
+
+
+class ContactQuerySet(models.QuerySet):
+    def with_attribute(self, name, value):
+        """
+        Filters contacts on a CSV attribute, using whichever index covers it:
+        - promoted columns (job_role, location, email_status) are plain indexed lookups
+        - keys listed in CONTACT_INDEXED_ATTRIBUTES match their expression index
+        - anything else uses JSON containment (GIN index) on Postgres
+        A list value matches any of its items.
+        """
+        values = value if isinstance(value, (list, tuple)) else None
+
+        column = Contact.column_for_attribute(name)
+        if column:
+            if values is not None:
+                return self.filter(**{f'{column}__in': values})
+            return self.filter(**{column: value})
+
+        if name in settings.CONTACT_INDEXED_ATTRIBUTES or connection.vendor != 'postgresql':
+            # Plain Exact/In (not the JSON key lookups) keep the SQL identical to the index expression
+            if values is not None:
+                return self.filter(In(ExtraDataText(name), values))
+            return self.filter(Exact(ExtraDataText(name), value))
+
+        if values is not None:
+            condition = models.Q()
+            for item in values:
+                condition |= models.Q(extra_data__contains={name: item})
+            return self.filter(condition)
+        return self.filter(extra_data__contains={name: value})
+
+
 class Contact(models.Model):
     """Store your email contacts"""
     email = models.EmailField(unique=True)
     first_name = models.CharField(max_length=100, blank=True)
     last_name = models.CharField(max_length=100, blank=True)
     company = models.CharField(max_length=200, blank=True)
+
+    # Frequently segmented CSV attributes, promoted out of extra_data into indexed columns
+    job_role = models.CharField(max_length=200, blank=True, db_index=True)
+    location = models.CharField(max_length=200, blank=True, db_index=True)
+    email_status = models.CharField(max_length=50, blank=True, db_index=True)
     
     # Flexible field to store extra CSV columns as JSON
     extra_data = models.JSONField(default=dict, blank=True)
+
+    # Hash of the imported fields (see compute_row_hash): re-imports skip rows that match it
+    row_hash = models.CharField(max_length=32, blank=True, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ContactQuerySet.as_manager()
+
+    # Column -> CSV headers it is filled from
+    PROMOTED_COLUMNS = {
+        'job_role': ('Job Role', 'JobRole', 'job_role'),
+        'location': ('Location', 'location'),
+        'email_status': ('Email Status', 'EmailStatus', 'email_status'),
+    }
+
+    # Other columns segments can filter on directly
+    SEGMENT_FIELDS = ('email', 'first_name', 'last_name', 'company')
+
+    # Columns a CSV import writes, covered by row_hash
+    ROW_HASH_FIELDS = ('first_name', 'last_name', 'company', 'job_role', 'location', 'email_status', 'extra_data')
     
     def __str__(self):
         return self.email
+
+    def save(self, *args, **kwargs):
+        from .suppression import normalize_email
+
+        # Kept in step with the fields however they are changed (import, admin, shell);
+        # emails are stored normalized, as CSV imports write them
+        self.email = normalize_email(self.email)
+        self.row_hash = Contact.compute_row_hash({name: getattr(self, name) for name in Contact.ROW_HASH_FIELDS})
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'row_hash'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def compute_row_hash(cls, values):
+        """
+        Content hash of the ROW_HASH_FIELDS in `values` (a dict of contact fields).
+        extra_data keys are sorted, so the CSV column order doesn't matter.
+        """
+        payload = [values.get(name) or ({} if name == 'extra_data' else '') for name in cls.ROW_HASH_FIELDS]
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+        return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+    @classmethod
+    def column_for_attribute(cls, name):
+        if name in cls.SEGMENT_FIELDS:
+            return name
+        for column, headers in cls.PROMOTED_COLUMNS.items():
+            if name == column or name in headers:
+                return column
+        return None
+
+    @classmethod
+    def promoted_values(cls, row):
+        """
+        Picks the promoted columns out of a CSV row (or an extra_data dict).
+        """
+        values = {}
+        for column, headers in cls.PROMOTED_COLUMNS.items():
+            for header in headers:
+                if row.get(header):
+                    values[column] = str(row[header]).strip()
+                    break
+        return values
+
+    @staticmethod
+    def attribute_index_name(name):
+        # Index names must be short and stable; CSV headers can be neither
+        return 'contact_x_' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def attribute_index(cls, name):
+        """
+        Expression index over extra_data->>name (see the index_contact_attributes command).
+        """
+        return models.Index(ExtraDataText(name), name=cls.attribute_index_name(name))
     
     class Meta:
         ordering = ['-created_at']
 
 
+class Audience(models.Model):
+    """
+    A set of recipients for campaigns.
+    Either a fixed list (filled by a CSV import) or a segment: a saved filter over
+    contact fields, e.g. {"location": "NYC", "Job Role": ["Engineer", "Manager"]}.
+    """
+    name = models.CharField(max_length=200, unique=True)
+    filters = models.JSONField(default=dict, blank=True, help_text="Segment filters; empty for imported audiences")
+    columns = models.JSONField(default=list, blank=True, help_text="CSV columns imported into the audience, in file order")
+    contacts = models.ManyToManyField(Contact, through='AudienceMember', related_name='audiences')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def is_segment(self):
+        return bool(self.filters)
+
+    def recipients(self):
+        """
+        Contacts in this audience, as a join on the membership table
+        (or the segment filters), never a list of emails.
+        """
+        if self.is_segment:
+            contacts = Contact.objects.all()
+            for name, value in self.filters.items():
+                contacts = contacts.with_attribute(name, value)
+            return contacts
+        return Contact.objects.filter(audience_memberships__audience=self)
+
+    def iter_recipients(self, chunk_size=1000):
+        """
+        Yields the recipients in pk order, read chunk_size at a time (pk > last seen).
+        Each chunk is fetched in full, so no cursor stays open while the caller
+        works: the render-ahead thread reads through this, and on SQLite an open
+        read cursor would block the sending thread's writes.
+        """
+        contacts = self.recipients().order_by('pk')
+        last_pk = 0
+        while True:
+            chunk = list(contacts.filter(pk__gt=last_pk)[:chunk_size])
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            last_pk = chunk[-1].pk
+
+    def add_contacts(self, contact_ids, batch_size=5000):
+        """
+        Adds contacts by id in bulk; contacts that are already members are ignored.
+        """
+        contact_ids = list(contact_ids)
+        for start in range(0, len(contact_ids), batch_size):
+            AudienceMember.objects.bulk_create(
+                [AudienceMember(audience=self, contact_id=contact_id) for contact_id in contact_ids[start:start + batch_size]],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+
+    def add_columns(self, names):
+        """
+        Records the CSV columns of an import into the audience (new ones are appended).
+        """
+        new = [name for name in names if name not in self.columns]
+        if new:
+            self.columns = self.columns + new
+            self.save(update_fields=['columns'])
+
+    def template_columns(self, chunk_size=1000):
+        """
+        CSV columns usable as template placeholders: the ones saved when contacts
+        were imported, or for a segment every extra_data key of its contacts
+        (read chunk_size at a time, like iter_recipients).
+        """
+        if not self.is_segment:
+            return list(self.columns)
+        columns = {}
+        contacts = self.recipients().order_by('pk').values_list('pk', 'extra_data')
+        last_pk = 0
+        while True:
+            chunk = list(contacts.filter(pk__gt=last_pk)[:chunk_size])
+            for _, extra_data in chunk:
+                columns.update(dict.fromkeys(extra_data or {}))
+            if len(chunk) < chunk_size:
+                return list(columns)
+            last_pk = chunk[-1][0]
+
+    class Meta:
+        ordering = ['-created_at']
+
+
+class AudienceMember(models.Model):
+    """Membership of a contact in a (non-segment) audience"""
+    audience = models.ForeignKey(Audience, on_delete=models.CASCADE, related_name='memberships')
+    contact = models.ForeignKey(Contact, on_delete=models.CASCADE, related_name='audience_memberships')
+    added_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Also the index used to join an audience to its contacts
+            models.UniqueConstraint(fields=['audience', 'contact'], name='unique_audience_member'),
+        ]
+
+
 class EmailCampaign(models.Model):
     """Track different email campaigns"""
     name = models.CharField(max_length=200)
     subject = models.CharField(max_length=300)
     template_path = models.CharField(max_length=500, help_text="Path to the template file")
+    template_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the template contents (key of the compiled template cache)")
+    columns = models.JSONField(default=list, blank=True, help_text="CSV columns the template was compiled with (placeholders for queued sends)")
+    audience = models.ForeignKey(Audience, null=True, blank=True, on_delete=models.SET_NULL, related_name='campaigns')
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
@@ -37,6 +285,9 @@ class EmailCampaign(models.Model):
 
 class EmailLog(models.Model):
     """Log each email sent (NO TRACKING)"""
+    # Queued in the campaign outbox, not sent yet (see emails/outbox.py)
+    PENDING = 'pending'
+
     # UUID just for unique identification of this log entry, not for tracking
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     campaign = models.ForeignKey(EmailCampaign, on_delete=models.CASCADE, related_name='emails')
@@ -44,11 +295,108 @@ class EmailLog(models.Model):
     
     subject = models.CharField(max_length=300)
     sent_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, default='sent', choices=[('sent', 'Sent'), ('failed', 'Failed')])
+    status = models.CharField(max_length=20, default='sent', choices=[('sent', 'Sent'), ('failed', 'Failed'), (PENDING, 'Pending')])
     error_message = models.TextField(blank=True)
+    # Message id returned by API backends (see emails.backends.batch_api)
+    provider_id = models.CharField(max_length=200, blank=True)
+
+    # Outbox lease: the worker holding (or that sent) a queued message, and until when it holds it
+    leased_by = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Times a worker started sending the message")
     
     def __str__(self):
         return f"{self.contact.email} - {self.subject}"
+
+    @property
+    def tracking_id(self):
+        # The log id doubles as the tracking id in pixel and click URLs
+        return self.id
     
     class Meta:
         ordering = ['-sent_at']
+        indexes = [
+            # Counts per status and recent sends (see emails.metrics)
+            models.Index(fields=['status', 'sent_at'], name='emaillog_status_sent_at'),
+            # Claimable messages of a campaign (see emails.outbox.claim)
+            models.Index(fields=['campaign', 'status', 'lease_expires_at'], name='emaillog_outbox'),
+        ]
+
+
+class TrackingEvent(models.Model):
+    """An email open or link click (written in batches, see emails/tracking.py)"""
+    OPEN = 'open'
+    CLICK = 'click'
+
+    # EmailLog id; not a foreign key so batched inserts never wait on lookups
+    tracking_id = models.UUIDField()
+    event_type = models.CharField(max_length=10, choices=[(OPEN, 'Open'), (CLICK, 'Click')])
+    url = models.TextField(blank=True)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    user_agent = models.TextField(blank=True)
+    occurred_at = models.DateTimeField(default=timezone.now)
+
+    # Filled in when the buffer is flushed (see emails/enrichment.py)
+    client = models.CharField(max_length=50, blank=True, help_text="Mail client or browser")
+    device = models.CharField(max_length=10, blank=True, choices=[
+        ('desktop', 'Desktop'), ('mobile', 'Mobile'), ('tablet', 'Tablet'),
+        ('proxy', 'Mail image proxy'), ('bot', 'Bot / link scanner'), ('unknown', 'Unknown'),
+    ])
+    is_automated = models.BooleanField(default=False, help_text="Fetched by a proxy or scanner, not the recipient's own client")
+    country = models.CharField(max_length=2, blank=True)
+    region = models.CharField(max_length=100, blank=True)
+    city = models.CharField(max_length=100, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} {self.tracking_id}"
+
+    class Meta:
+        ordering = ['-occurred_at']
+        indexes = [
+            models.Index(fields=['tracking_id', 'event_type']),
+            models.Index(fields=['occurred_at']),
+        ]
+
+
+class Suppression(models.Model):
+    """
+    Addresses that must never be emailed again: unsubscribes, hard bounces and manual blocks.
+    Checked in memory at send time, see emails/suppression.py.
+    """
+    UNSUBSCRIBE = 'unsubscribe'
+    BOUNCE = 'bounce'
+    MANUAL = 'manual'
+
+    email = models.EmailField(unique=True, help_text="Normalized (stripped, lower case)")
+    # Signed 64-bit hash of the normalized address, the only thing loaded at send time
+    address_hash = models.BigIntegerField(db_index=True, editable=False)
+    reason = models.CharField(max_length=20, choices=[(UNSUBSCRIBE, 'Unsubscribed'), (BOUNCE, 'Hard bounce'), (MANUAL, 'Manual block')])
+    note = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.reason})"
+
+    def save(self, *args, **kwargs):
+        from .suppression import address_hash, normalize_email
+        self.email = normalize_email(self.email)
+        self.address_hash = address_hash(self.email)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def suppress(cls, emails, reason, note='', batch_size=5000):
+        """
+        Adds addresses in bulk; ones that are already suppressed keep their original reason.
+        """
+        from .suppression import address_hash, normalize_email
+
+        rows = {}
+        for email in emails:
+            email = normalize_email(email)
+            if email:
+                rows[email] = cls(email=email, address_hash=address_hash(email), reason=reason, note=note)
+        cls.objects.bulk_create(rows.values(), batch_size=batch_size, ignore_conflicts=True)
+        return len(rows)
+
+    class Meta:
+        ordering = ['-created_at']
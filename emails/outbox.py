@@ -0,0 +1,148 @@
+"""
+Campaign outbox shared by several sender processes (send_campaign --enqueue / --worker).
+
+Queued messages are EmailLog rows in status 'pending'. A worker claims a batch
+by setting leased_by and lease_expires_at on rows nobody holds (or whose lease
+expired), sends them, and marks each row sent/failed as it goes. A worker that
+dies just stops renewing; its rows are claimable again once the lease expires.
+
+Claims use SELECT ... FOR UPDATE SKIP LOCKED where the database has it
+(Postgres), so concurrent workers skip each other's rows instead of waiting.
+Elsewhere (SQLite) a conditional UPDATE does the claim: it only matches rows
+that are still unleased, and the worker reads back which ones it got.
+
+A worker counts an attempt on each message right before sending it (start).
+A message with max_attempts attempts and no result (every worker that tried it
+died) isn't claimed again: give_up() marks it failed once its lease expires.
+"""
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import EmailLog
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def queue_id(campaign, contact_id):
+    """
+    Log id of a queued message. Derived from the campaign and contact, so a
+    contact can't be queued twice even by concurrent enqueues; SECRET_KEY keeps
+    it (the tracking id) from being guessed.
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, f'{settings.SECRET_KEY}:outbox:{campaign.pk}:{contact_id}')
+
+
+def enqueue(campaign, contact_ids, subject):
+    """
+    Queues a message to each contact that has no log in the campaign yet.
+    Returns how many were queued.
+    """
+    contact_ids = list(contact_ids)
+    logged = set(EmailLog.objects.filter(campaign=campaign, contact_id__in=contact_ids).values_list('contact_id', flat=True))
+    logs = [
+        EmailLog(id=queue_id(campaign, contact_id), campaign=campaign, contact_id=contact_id, subject=subject, status=EmailLog.PENDING)
+        for contact_id in contact_ids if contact_id not in logged
+    ]
+    EmailLog.objects.bulk_create(logs, ignore_conflicts=True)
+    return len(logs)
+
+
+def pending(campaign):
+    return EmailLog.objects.filter(campaign=campaign, status=EmailLog.PENDING)
+
+
+def _unleased(campaign, now):
+    return pending(campaign).filter(Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now))
+
+
+def claim(campaign, worker, batch_size, lease_seconds, max_attempts):
+    """
+    Leases up to batch_size pending messages to this worker, skipping ones
+    already tried max_attempts times. Returns (logs with their contacts, lease expiry).
+    """
+    now = timezone.now()
+    expires = now + timedelta(seconds=lease_seconds)
+    claimable = _unleased(campaign, now).filter(attempts__lt=max_attempts).order_by('contact_id')
+    lease = {'leased_by': worker, 'lease_expires_at': expires}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(claimable.select_for_update(skip_locked=True).values_list('pk', flat=True)[:batch_size])
+            EmailLog.objects.filter(pk__in=ids).update(**lease)
+    else:
+        # The WHERE clause is checked again by the UPDATE, so rows another worker
+        # leased in between aren't taken; only the ones this update set are ours
+        candidates = list(claimable.values_list('pk', flat=True)[:batch_size])
+        claimable.filter(pk__in=candidates).update(**lease)
+        ids = EmailLog.objects.filter(pk__in=candidates, leased_by=worker, lease_expires_at=expires).values_list('pk', flat=True)
+
+    logs = EmailLog.objects.filter(pk__in=list(ids)).select_related('contact').order_by('contact_id')
+    return list(logs), expires
+
+
+def renew(logs, worker, expires, lease_seconds):
+    """
+    Extends the lease on logs still held by this worker.
+    Returns (the logs still held, new expiry); others may have been reclaimed.
+    """
+    new_expires = timezone.now() + timedelta(seconds=lease_seconds)
+    ids = [log.pk for log in logs]
+    EmailLog.objects.filter(
+        pk__in=ids, status=EmailLog.PENDING, leased_by=worker, lease_expires_at=expires,
+    ).update(lease_expires_at=new_expires)
+    held = set(EmailLog.objects.filter(pk__in=ids, leased_by=worker, lease_expires_at=new_expires).values_list('pk', flat=True))
+    return [log for log in logs if log.pk in held], new_expires
+
+
+def start(log, worker):
+    """
+    Counts an attempt at a leased message, right before it's sent.
+    Returns False if the lease was lost (another worker has the message now).
+    """
+    return EmailLog.objects.filter(pk=log.pk, status=EmailLog.PENDING, leased_by=worker).update(attempts=F('attempts') + 1) == 1
+
+
+def complete(log, worker, status, subject, error=''):
+    """
+    Records the outcome of a leased message. leased_by is kept as the sender.
+    Returns False if the lease was lost (the result isn't written).
+    """
+    return EmailLog.objects.filter(pk=log.pk, status=EmailLog.PENDING, leased_by=worker).update(
+        status=status, subject=subject[:300], error_message=error, sent_at=timezone.now(), lease_expires_at=None,
+    ) == 1
+
+
+def release(logs, worker):
+    """
+    Hands unsent messages back to the queue without waiting for the lease to expire.
+    """
+    EmailLog.objects.filter(
+        pk__in=[log.pk for log in logs], status=EmailLog.PENDING, leased_by=worker,
+    ).update(lease_expires_at=None)
+
+
+def give_up(campaign, max_attempts):
+    """
+    Marks failed the messages tried max_attempts times whose last lease has
+    expired without a result. Returns how many.
+    """
+    return _unleased(campaign, timezone.now()).filter(attempts__gte=max_attempts).update(
+        status='failed', error_message=f'Gave up after {max_attempts} attempts (every worker that tried it stopped before a result)',
+        sent_at=timezone.now(), lease_expires_at=None,
+    )
+
+
+def drop(log, worker):
+    """
+    Removes a queued message that won't be sent (the address was suppressed after queueing).
+    """
+    EmailLog.objects.filter(pk=log.pk, status=EmailLog.PENDING, leased_by=worker).delete()
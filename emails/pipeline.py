@@ -0,0 +1,200 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+# Marks the end of the render queue
+_DONE = object()
+
+
+def _init_worker():
+    # Workers started with spawn/forkserver need settings for templates with Django tags
+    import django
+    django.setup()
+
+
+class RenderError(Exception):
+    """
+    Handed back in place of a message whose rendering raised.
+    """
+
+
+def _render(template, context, tracking_id):
+    try:
+        return template.render(context, tracking_id)
+    except Exception as e:
+        # One recipient's bad data fails that message, not the campaign; the
+        # original exception may not pickle back from a worker process
+        return RenderError(str(e))
+
+
+def _render_chunk(template, chunk):
+    return [_render(template, context, tracking_id) for context, tracking_id in chunk]
+
+
+class RenderPipeline:
+    """
+    Renders messages ahead of the sender.
+
+    A producer thread reads the recipients and renders them (in a process pool
+    when `workers` is set) into a bounded queue; the caller drains it and sends:
+
+        pipeline = RenderPipeline(template)
+        for key, (subject, html, text) in pipeline.run(jobs):
+            ...  # send
+
+    jobs yields (key, context, tracking_id); key is handed back untouched with
+    the rendered message, in the same order. A message that fails to render
+    comes back as a RenderError instead, and the rest carry on. While the caller waits on the
+    mail server the producer keeps rendering, so a campaign takes roughly
+    max(render, send) instead of their sum. The queue bound keeps memory flat
+    when rendering is faster than sending.
+    """
+    def __init__(self, template, queue_size=None, workers=None, chunk_size=50):
+        self.template = template
+        self.queue_size = queue_size or settings.SEND_PIPELINE_QUEUE_SIZE
+        self.workers = settings.SEND_RENDER_WORKERS if workers is None else workers
+        self.chunk_size = chunk_size
+
+        self.stats = {
+            'rendered': 0,
+            'render_errors': 0,
+            'sent': 0,
+            'elapsed': 0.0,
+            'render_busy': 0.0,
+            'render_blocked': 0.0, # Producer waiting for room in the queue
+            'send_busy': 0.0,
+            'send_starved': 0.0,   # Sender waiting for a rendered message
+            'max_queue_depth': 0,
+            'queue_depth_total': 0,
+        }
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._error = None
+
+    # --- Producer ---
+
+    def _put(self, item):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.stats['render_blocked'] += time.perf_counter() - started
+
+    def _count(self, rendered):
+        self.stats['render_errors' if isinstance(rendered, RenderError) else 'rendered'] += 1
+
+    def _produce(self, jobs):
+        from django.db import connections
+
+        try:
+            if self.workers:
+                self._produce_in_pool(jobs)
+            else:
+                template = self.template
+                started = time.perf_counter()
+                for key, context, tracking_id in jobs:
+                    rendered = _render(template, context, tracking_id)
+                    self.stats['render_busy'] += time.perf_counter() - started
+                    self._put((key, rendered))
+                    self._count(rendered)
+                    if self._stop.is_set():
+                        return
+                    started = time.perf_counter()
+        except BaseException as e:
+            self._error = e
+        finally:
+            # Reading the recipients opened a connection in this thread
+            connections.close_all()
+            self._put(_DONE)
+
+    def _produce_in_pool(self, jobs):
+        """
+        Renders chunks of jobs in worker processes, keeping a few chunks in
+        flight per worker and handing results back in order.
+        """
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as executor:
+            in_flight = deque()
+
+            def drain_one():
+                keys, future = in_flight.popleft()
+                started = time.perf_counter()
+                rendered = future.result()
+                self.stats['render_busy'] += time.perf_counter() - started
+                for key, message in zip(keys, rendered):
+                    self._put((key, message))
+                    self._count(message)
+
+            keys, chunk = [], []
+            for key, context, tracking_id in jobs:
+                keys.append(key)
+                chunk.append((context, tracking_id))
+                if len(chunk) >= self.chunk_size:
+                    in_flight.append((keys, executor.submit(_render_chunk, self.template, chunk)))
+                    keys, chunk = [], []
+                    if len(in_flight) >= self.workers * 2:
+                        drain_one()
+                if self._stop.is_set():
+                    return
+            if chunk:
+                in_flight.append((keys, executor.submit(_render_chunk, self.template, chunk)))
+            while in_flight and not self._stop.is_set():
+                drain_one()
+
+    # --- Consumer ---
+
+    def run(self, jobs):
+        """
+        Yields (key, (subject, html, text)) as messages are rendered, or
+        (key, RenderError) for a message that couldn't be.
+        Time the caller spends between items counts as sending.
+        """
+        producer = threading.Thread(target=self._produce, args=(jobs,), name='render-ahead', daemon=True)
+        started = time.perf_counter()
+        producer.start()
+
+        try:
+            while True:
+                waiting = time.perf_counter()
+                depth = self._queue.qsize()
+                item = self._queue.get()
+                self.stats['send_starved'] += time.perf_counter() - waiting
+                if item is _DONE:
+                    break
+
+                self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], depth)
+                self.stats['queue_depth_total'] += depth
+
+                sending = time.perf_counter()
+                yield item
+                self.stats['send_busy'] += time.perf_counter() - sending
+                self.stats['sent'] += 1
+        finally:
+            # Also reached when the caller stops early: let the producer finish up
+            self._stop.set()
+            producer.join()
+            self.stats['elapsed'] = time.perf_counter() - started
+
+        if self._error is not None:
+            raise self._error
+
+    def summary(self):
+        stats = self.stats
+        elapsed = stats['elapsed'] or 1e-9
+        avg_depth = stats['queue_depth_total'] / stats['sent'] if stats['sent'] else 0
+        return [
+            f"Rendered: {stats['rendered']}, sent: {stats['sent']} in {stats['elapsed']:.2f}s"
+            + (f" ({self.workers} render processes)" if self.workers else "")
+            + (f", {stats['render_errors']} failed to render" if stats['render_errors'] else ""),
+            f"Render stage: {stats['render_busy']:.2f}s busy ({stats['render_busy'] / elapsed:.0%}), "
+            f"{stats['render_blocked']:.2f}s waiting on a full queue",
+            f"Send stage: {stats['send_busy']:.2f}s busy ({stats['send_busy'] / elapsed:.0%}), "
+            f"{stats['send_starved']:.2f}s waiting for messages",
+            f"Queue depth: avg {avg_depth:.1f}, max {stats['max_queue_depth']} (limit {self.queue_size})",
+        ]
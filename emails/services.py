@@ -1,74 +1,142 @@
 import csv
-import markdown
-import re
-from bs4 import BeautifulSoup
+import uuid
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
-from django.utils.html import strip_tags
-from .models import Contact, EmailCampaign, EmailLog
+from django.core.mail import get_connection
+from django.db import transaction
+from .attachments import CampaignMessage
+from .ingest import CSVIngest
+from .models import Audience, Contact, EmailCampaign, EmailLog, Suppression
+from .pipeline import RenderError, RenderPipeline
+from .suppression import SuppressionSet, is_hard_bounce, list_unsubscribe_headers
+from .templating import load_template
 
 class EmailEngine:
+    # Audience memberships are written in bulk, this many at a time
+    MEMBERSHIP_BATCH_SIZE = 5000
+    # CSV rows checked against the stored contacts (one query) and written per chunk
+    IMPORT_CHUNK_SIZE = 1000
+
     @staticmethod
-    def import_contacts(csv_file_path):
+    def import_contacts(csv_file_path, audience=None):
         """
-        Reads a CSV file and creates/updates Contact objects.
+        Reads CSV files and creates/updates Contact objects.
+        csv_file_path: a path, a glob pattern, or a list of them (see emails.ingest:
+        headers are matched case-insensitively, emails lower-cased, duplicates dropped).
         Expected columns: Name, Company, Email, Job Role, Location
+        If an audience is given, every imported contact is added to it.
+        Rows are written IMPORT_CHUNK_SIZE at a time; rows that match the stored
+        contact (same row_hash) are counted as unchanged and not written.
         """
-        results = {'created': 0, 'updated': 0, 'errors': []}
+        results = {'created': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0, 'errors': [], 'ingest': []}
+        member_ids = []
+        ingest = None
         
         try:
-            with open(csv_file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                
-                # Normalize headers: strip whitespace and lower case for safer access
-                reader.fieldnames = [name.strip() for name in reader.fieldnames]
-                
-                for row in reader:
-                    email = row.get('Email', '').strip()
-                    if not email:
-                        continue
-                        
-                    # Extract name parts
-                    full_name = row.get('Name', '').strip()
-                    parts = full_name.split(' ', 1)
-                    first_name = parts[0]
-                    last_name = parts[1] if len(parts) > 1 else ''
-                    
-                    contact_data = {
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'company': row.get('Company', '').strip(),
-                        'job_role': row.get('Job Role', '').strip(),
-                        'location': row.get('Location', '').strip(),
-                        'email_status': row.get('Email Status', 'Valid').strip(),
-                    }
-                    
-                    contact, created = Contact.objects.update_or_create(
-                        email=email,
-                        defaults=contact_data
-                    )
-                    
-                    if created:
-                        results['created'] += 1
-                    else:
-                        results['updated'] += 1
+            ingest = CSVIngest(csv_file_path)
+            if audience is not None:
+                audience.add_columns(ingest.fieldnames)
+            chunk = []
+            for row in ingest.rows():
+                chunk.append(row)
+                if len(chunk) >= EmailEngine.IMPORT_CHUNK_SIZE:
+                    member_ids.extend(EmailEngine.import_chunk(chunk, results))
+                    chunk = []
+
+                    if audience is not None and len(member_ids) >= EmailEngine.MEMBERSHIP_BATCH_SIZE:
+                        audience.add_contacts(member_ids)
+                        member_ids = []
+            if chunk:
+                member_ids.extend(EmailEngine.import_chunk(chunk, results))
                         
         except Exception as e:
             results['errors'].append(str(e))
+
+        if audience is not None and member_ids:
+            audience.add_contacts(member_ids)
+
+        if ingest is not None:
+            results['duplicates'] = ingest.stats['duplicates']
+            results['ingest'] = ingest.summary()
             
         return results
 
     @staticmethod
-    def prepare_content(template_content, contact, tracking_id, subject_template=None):
+    def contact_fields(row):
+        """
+        Contact fields for a normalized CSV row (see emails.ingest).
+        """
+        # Extract name parts
+        full_name = row.get('Name', '').strip()
+        parts = full_name.split(' ', 1)
+
+        contact_data = {
+            'first_name': parts[0],
+            'last_name': parts[1] if len(parts) > 1 else '',
+            'company': row.get('Company', '').strip(),
+            'job_role': '',
+            'location': '',
+            'email_status': 'Valid',
+            'extra_data': row, # Keep every column for segments and audience sends
+        }
+        # Job Role / Location / Email Status, whichever header spelling the CSV uses
+        contact_data.update(Contact.promoted_values(row))
+        return contact_data
+
+    @staticmethod
+    def import_chunk(rows, results):
+        """
+        Writes a chunk of CSV rows (unique emails): one query for the stored
+        row hashes, then a bulk insert of new contacts and a bulk update of
+        changed ones. Returns the ids of all the chunk's contacts.
+        """
+        fields = {row['Email']: EmailEngine.contact_fields(row) for row in rows}
+        stored = {
+            email: (pk, row_hash)
+            for email, pk, row_hash in Contact.objects.filter(email__in=list(fields)).values_list('email', 'pk', 'row_hash')
+        }
+
+        ids, new, changed = [], [], []
+        for email, contact_data in fields.items():
+            row_hash = Contact.compute_row_hash(contact_data)
+            if email not in stored:
+                new.append(Contact(email=email, row_hash=row_hash, **contact_data))
+                continue
+            pk, stored_hash = stored[email]
+            ids.append(pk)
+            if stored_hash == row_hash:
+                results['unchanged'] += 1
+            else:
+                changed.append(Contact(pk=pk, email=email, row_hash=row_hash, **contact_data))
+
+        # Bulk writes skip Contact.save(), so row_hash is set above
+        with transaction.atomic():
+            if new:
+                Contact.objects.bulk_create(new)
+            if changed:
+                Contact.objects.bulk_update(changed, [*Contact.ROW_HASH_FIELDS, 'row_hash'])
+        results['created'] += len(new)
+        results['updated'] += len(changed)
+
+        if any(contact.pk is None for contact in new):
+            # Backends that can't return ids from a bulk insert
+            ids.extend(Contact.objects.filter(email__in=[contact.email for contact in new]).values_list('pk', flat=True))
+        else:
+            ids.extend(contact.pk for contact in new)
+        return ids
+
+    # Placeholders EmailEngine fills from the Contact model
+    TEMPLATE_SLOTS = ['Name', 'First Name', 'Last Name', 'Company', 'Job Role', 'Location', 'Email']
+
+    @staticmethod
+    def load_template(template_path, default_subject=''):
         """
-        1. Replaces placeholders in Markdown.
-        2. Converts Markdown to HTML.
-        3. Injects tracking pixel.
-        4. Rewrites links for tracking.
+        Returns the compiled template (cached by content hash, see emails.templating).
         """
-        # 1. Replace Placeholders
-        # Safe substitution using a dictionary
-        context = {
+        return load_template(template_path, EmailEngine.TEMPLATE_SLOTS, default_subject=default_subject, headers='engine', track=True)
+
+    @staticmethod
+    def template_context(contact):
+        return {
             'Name': contact.first_name,
             'First Name': contact.first_name, # Alias
             'Last Name': contact.last_name,
@@ -77,180 +145,245 @@ class EmailEngine:
             'Location': contact.location,
             'Email': contact.email
         }
-        
-        # Regex to match [Placeholder]
-        # We look for square brackets and try to match the key inside
-        def replace_placeholder(match):
-            key = match.group(1)
-            return context.get(key, match.group(0)) # Return original if not found
-            
-        # Replaces [Name], [Company], etc.
-        markdown_text = re.sub(r'\[(.*?)\]', replace_placeholder, template_content)
-        
-        # 2. Convert to HTML
-        html_content = markdown.markdown(markdown_text)
-        
-        # 3. Process HTML with BeautifulSoup for Links and Pixel
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Rewrite links
-        for a_tag in soup.find_all('a', href=True):
-            original_url = a_tag['href']
-            if not original_url.startswith('http'):
-                continue # Skip internal links or mailto if needed, or handle them differently
-                
-            tracking_url = f"{settings.SITE_URL}/track/click/{tracking_id}/?url={original_url}"
-            a_tag['href'] = tracking_url
-            
-        # 4. Inject Tracking Pixel
-        pixel_url = f"{settings.SITE_URL}/track/open/{tracking_id}/pixel.png"
-        img_tag = soup.new_tag("img", src=pixel_url, width="1", height="1", style="display:none;", alt="")
-        soup.append(img_tag)
-        
-        final_html = str(soup)
-        plain_text = strip_tags(html_content) # Strip tags from the *unmodified* HTML (or modified, doesn't matter much for text)
-        
-        final_subject = subject_template
-        if subject_template:
-            final_subject = re.sub(r'\[(.*?)\]', replace_placeholder, subject_template)
-        
-        return final_subject, final_html, plain_text
 
     @staticmethod
-    def send_campaign(campaign_name, subject, template_path, csv_path, dry_run=False):
+    def prepare_content(template, contact, tracking_id):
+        """
+        Renders a compiled template for one contact.
+        Placeholders, Markdown conversion, link rewriting and the tracking pixel
+        are all resolved at compile time, so this is just filling in the slots.
+        """
+        return template.render(EmailEngine.template_context(contact), tracking_id=tracking_id)
+
+    @staticmethod
+    def send_campaign(campaign_name, subject, template_path, csv_path=None, dry_run=False, audience=None, attachments=None, render_workers=None):
         """
         Orchestrates the campaign sending process.
+        With CSVs (csv_path: a path, glob or list, see import_contacts), their contacts
+        become the campaign's audience (named after the campaign unless one is passed in). Without one, the given audience or segment is used as is.
+        attachments: SharedAttachment objects (see emails.attachments), added to every message.
+        render_workers: processes to render in (default SEND_RENDER_WORKERS, 0 = a thread).
         """
-        # 1. Import Contacts
-        import_results = EmailEngine.import_contacts(csv_path)
-        print(f"Import Results: {import_results}")
+        # 1. Import Contacts into the audience
+        import_results = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': []}
+        if csv_path:
+            if audience is None:
+                audience, _ = Audience.objects.get_or_create(name=campaign_name)
+            if audience.is_segment:
+                raise ValueError(f"Audience '{audience.name}' is a segment and can't be filled from a CSV")
+            # The audience is exactly this CSV, drop members of previous imports
+            audience.memberships.all().delete()
+            import_results = EmailEngine.import_contacts(csv_path, audience=audience)
+            print(f"Import Results: {import_results}")
+        elif audience is None:
+            raise ValueError("Either a CSV file or an audience is required")
         
         # 2. Get/Create Campaign
         campaign, _ = EmailCampaign.objects.get_or_create(name=campaign_name, defaults={'subject': subject})
         
-        # 3. Read Template
-        with open(template_path, 'r', encoding='utf-8') as f:
-            template_content = f.read()
-            
-        # Extract Subject from template if present (First line "Subject: ...")
-        # If the template file starts with "Subject:", we use that instead of the generic one
-        lines = template_content.split('\n')
-        
-        # Parse Subject
-        # Look for "Subject:" in the first few lines
-        parsing_body = False
-        new_lines = []
-        
-        for i, line in enumerate(lines):
-            stripped_line = line.strip()
-            
-            # Extract Subject
-            if not parsing_body and stripped_line.lower().startswith('subject:'):
-                potential_subject = stripped_line.split(':', 1)[1].strip()
-                if potential_subject:
-                    subject = potential_subject
-                else:
-                    # If empty, check next line
-                    if i + 1 < len(lines):
-                         subject = lines[i+1].strip()
-                         # We skip the next line in loop? No, handled by filtering below
-                         # Actually simpler: Just set subject and continue
-                continue
-                
-            # Skip the next line if it was the subject content (heuristic: if subject was empty on "Subject:" line)
-            if not parsing_body and subject == lines[i].strip() and lines[i-1].strip().lower() == 'subject:':
-                continue
+        # 3. Load Template (parsed once per content hash, including the Subject:/Email: header heuristic)
+        template = EmailEngine.load_template(template_path, default_subject=subject)
+        subject = template.subject
 
-            # Filtering other metadata (Email:, Portfolio:, etc if they appear at top)
-            # Based on user request, "Email:" appeared in body.
-            # We will strip lines that look like headers until we hit blank lines or body?
-            # User example:
-            # Subject:
-            # Quick question...
-            # <blank>
-            # Email:
-            # <blank>
-            # Hi [Name],
-            
-            # Heuristic: If we are not in body yet, and line is "Subject:" or "Email:" or "Portfolio:" etc, skip it?
-            # Or just strip specifically requested parts. 
-            
-            # Let's clean up specifically based on the layout we saw.
-            if stripped_line.lower().startswith('email:'):
-                continue
-            
-            # If we hit "Hi [Name]", we are definitely in body
-            if "Hi " in line:
-                parsing_body = True
-                
-            new_lines.append(line)
-            
-        template_content = '\n'.join(new_lines).strip()
-        
         # Update campaign subject
         campaign.subject = subject
+        campaign.template_path = template_path
+        campaign.template_hash = template.content_hash
+        campaign.audience = audience
         campaign.save()
 
         # 4. Send Emails
-        contacts = Contact.objects.all() # Or filter based on import? For now, all contacts.
-        # Maybe we should only send to contacts in the CSV? 
-        # For this logic, let's assume we want to send to everyone in the DB who was just imported/updated.
-        # Ideally, we filter by created_at or explicitly return the list from import. 
-        # But simplistic approach: Send to all valid contacts.
+        # Only the audience: a join on the membership table (or the segment filters),
+        # minus suppressed addresses (checked in memory, no query per recipient).
+        # Read in keyset chunks, see Audience.iter_recipients
+        suppressed = SuppressionSet.load()
+        contacts = suppressed.exclude(audience.iter_recipients())
+
+        # Backends with a batch API (chosen through EMAIL_BACKEND) get the messages in batches
+        connection = None if dry_run else get_connection()
+        batch_size = connection.batch_size if getattr(connection, 'supports_batch', False) else 0
+        pending = []
         
         sent_count = 0
         errors = []
-        
-        for contact in contacts:
-            try:
-                # Create Log entry first to get UUID
-                email_log = EmailLog.objects.create(
-                    campaign=campaign,
-                    contact=contact,
-                    subject=subject
-                )
-                
-                # Prepare Content
-                final_subject, html_body, text_body = EmailEngine.prepare_content(template_content, contact, email_log.tracking_id, subject_template=subject)
-                
-                # Update log with personalized subject
-                email_log.subject = final_subject
-                email_log.save()
-                
-                if not dry_run:
-                    msg = EmailMultiAlternatives(
-                        subject=final_subject,
-                        body=text_body,
-                        from_email=settings.DEFAULT_FROM_EMAIL,
-                        to=[contact.email]
+
+        # Rendering runs ahead in a background thread (see emails.pipeline), so the
+        # next messages are ready while this one waits on the mail server.
+        # Log ids are generated up front: they are the tracking ids baked into the message.
+        def jobs():
+            for contact in contacts:
+                context = EmailEngine.template_context(contact)
+                tracking_id = uuid.uuid4()
+                yield (contact, context, tracking_id), context, tracking_id
+
+        pipeline = RenderPipeline(template, workers=render_workers)
+
+        if batch_size:
+            connection.open()
+        try:
+            for (contact, context, tracking_id), rendered in pipeline.run(jobs()):
+                if isinstance(rendered, RenderError):
+                    # Recorded like a failed send; the rest of the campaign goes on
+                    errors.append(f"{contact.email}: {rendered}")
+                    EmailLog.objects.create(
+                        id=tracking_id, campaign=campaign, contact=contact, subject=subject,
+                        status='failed', error_message=str(rendered),
                     )
-                    msg.attach_alternative(html_body, "text/html")
-                    msg.send()
-                
-                sent_count += 1
-                
-            except Exception as e:
-                errors.append(f"{contact.email}: {str(e)}")
+                    continue
+                final_subject, html_body, text_body = rendered
+                email_log = None
+                try:
+                    email_log = EmailLog.objects.create(
+                        id=tracking_id,
+                        campaign=campaign,
+                        contact=contact,
+                        subject=final_subject
+                    )
+                    
+                    if not dry_run:
+                        msg = CampaignMessage(
+                            subject=final_subject,
+                            body=text_body,
+                            from_email=settings.DEFAULT_FROM_EMAIL,
+                            to=[contact.email],
+                            headers=list_unsubscribe_headers(contact.email)
+                        )
+                        msg.attach_alternative(html_body, "text/html")
+                        for attachment in attachments or []:
+                            attachment.attach_to(msg)
+
+                        if batch_size:
+                            # Only the slot values travel per recipient, the template once per batch
+                            msg.set_template(template, template.merge_values(context, tracking_id))
+                            pending.append((email_log, msg))
+                            if len(pending) >= batch_size:
+                                sent_count += EmailEngine.send_batch(connection, pending, errors)
+                                pending = []
+                            continue
+
+                        msg.send()
+                    
+                    sent_count += 1
+                    
+                except Exception as e:
+                    errors.append(f"{contact.email}: {str(e)}")
+                    # The log was created as 'sent' before sending, record the failure on it
+                    if email_log is not None:
+                        email_log.status = 'failed'
+                        email_log.error_message = str(e)
+                        email_log.save(update_fields=['status', 'error_message'])
+                    if is_hard_bounce(e):
+                        Suppression.suppress([contact.email], Suppression.BOUNCE, note=str(e))
+
+            if pending:
+                sent_count += EmailEngine.send_batch(connection, pending, errors)
+        finally:
+            if batch_size:
+                connection.close()
                 
         return {
             'sent': sent_count,
+            'suppressed': suppressed.skipped,
             'errors': errors,
+            'pipeline': pipeline.summary(),
+            'body_size': template.size_report(),
             'import_stats': import_results
         }
 
-from mixpanel import Mixpanel
+    @staticmethod
+    def send_batch(connection, pending, errors):
+        """
+        Sends (EmailLog, message) pairs with one send_messages() call on a batch
+        backend, then writes each message's result back onto its log.
+        """
+        try:
+            connection.send_messages([msg for _, msg in pending])
+        except Exception:
+            # Messages of the failed request carry the error; any after it were never sent
+            pass
+
+        sent = 0
+        bounced = []
+        for email_log, msg in pending:
+            result = msg.send_result or {'status': 'failed', 'id': '', 'error': 'Not sent, an earlier batch failed', 'permanent': False}
+            email_log.provider_id = result['id']
+            if result['status'] == 'sent':
+                sent += 1
+                continue
+            email_log.status = 'failed'
+            email_log.error_message = result['error']
+            errors.append(f"{email_log.contact.email}: {result['error']}")
+            if result['permanent']:
+                bounced.append(email_log.contact.email)
+
+        EmailLog.objects.bulk_update([email_log for email_log, _ in pending], ['status', 'error_message', 'provider_id'])
+        if bounced:
+            Suppression.suppress(bounced, Suppression.BOUNCE, note='Rejected by the email API')
+        return sent
+
+    # Columns written by the campaign export, paired with the EmailLog lookups they come from
+    EXPORT_COLUMNS = [
+        ('Email', 'contact__email'),
+        ('First Name', 'contact__first_name'),
+        ('Last Name', 'contact__last_name'),
+        ('Company', 'contact__company'),
+        ('Job Role', 'contact__job_role'),
+        ('Location', 'contact__location'),
+        ('Email Status', 'contact__email_status'),
+        ('Subject', 'subject'),
+        ('Status', 'status'),
+        ('Sent At', 'sent_at'),
+        ('Error', 'error_message'),
+    ]
+
+    @staticmethod
+    def iter_campaign_export(campaign, chunk_size=2000):
+        """
+        Yields the CSV header followed by one row per EmailLog of the campaign.
+        Rows come straight from the database cursor as tuples (no model instances),
+        so memory stays flat no matter how many emails the campaign sent.
+        """
+        yield [header for header, _ in EmailEngine.EXPORT_COLUMNS]
+
+        # values_list follows the contact FK with a single JOIN, same as select_related
+        rows = (
+            EmailLog.objects
+            .filter(campaign=campaign)
+            .order_by()
+            .values_list(*[lookup for _, lookup in EmailEngine.EXPORT_COLUMNS])
+            .iterator(chunk_size=chunk_size)
+        )
+        for row in rows:
+            yield row
+
+    @staticmethod
+    def write_campaign_export(campaign, file_obj):
+        """
+        Writes the campaign export to a file-like object, row by row.
+        """
+        writer = csv.writer(file_obj)
+        count = 0
+        for row in EmailEngine.iter_campaign_export(campaign):
+            writer.writerow(row)
+            count += 1
+        return count - 1 # Header row doesn't count
 
 class AnalyticsService:
     _mp = None
     
     @classmethod
     def get_instance(cls):
-        if cls._mp is None and hasattr(settings, 'MIXPANEL_TOKEN'):
+        if cls._mp is None and getattr(settings, 'MIXPANEL_TOKEN', None):
+            # Imported here: mixpanel pulls in requests/urllib3, which only the tracking path needs
+            from mixpanel import Mixpanel
             cls._mp = Mixpanel(settings.MIXPANEL_TOKEN)
         return cls._mp
         
     @staticmethod
-    def track_open(contact, campaign_name, subject, tracking_id):
+    def track_open(contact, campaign_name, subject, tracking_id, properties=None):
+        """
+        properties: extra event properties, e.g. the client and location from emails.enrichment.
+        """
         mp = AnalyticsService.get_instance()
         if not mp:
             return
@@ -264,16 +397,12 @@ class AnalyticsService:
             'Tracking ID': str(tracking_id),
             'Email': contact.email,
             'Company': contact.company,
-            'Job Role': contact.job_role
+            'Job Role': contact.job_role,
+            **(properties or {}),
         })
-        
-        # Determine location from IP isn't easy here without request context, 
-        # so we rely on Mixpanel's ingestion to parse IP if we passed it, 
-        # but the library doesn't easily support passing IP for geoip unless we use the HTTP API manually 
-        # or update the profile. For now, simple event tracking.
 
     @staticmethod
-    def track_click(contact, campaign_name, target_url, tracking_id):
+    def track_click(contact, campaign_name, target_url, tracking_id, properties=None):
         mp = AnalyticsService.get_instance()
         if not mp:
             return
@@ -284,5 +413,6 @@ class AnalyticsService:
             'Campaign': campaign_name,
             'Target URL': target_url,
             'Tracking ID': str(tracking_id),
-            'Email': contact.email
+            'Email': contact.email,
+            **(properties or {}),
         })
@@ -0,0 +1,402 @@
+import hashlib
+import html
+import re
+from dataclasses import dataclass, field
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import strip_tags
+
+from .tracking import click_signature
+
+# markdown, bs4, html2text and the Django template engine are imported inside the functions
+# that need them: rendering a cached template never touches them, and neither do
+# commands or views that only import this module
+
+# Bump when the compiled format changes so old cache entries are ignored
+COMPILER_VERSION = 5
+
+# Matches [Placeholder] in templates
+PLACEHOLDER_RE = re.compile(r'\[(.*?)\]')
+
+# Slots are swapped for plain alphanumeric tokens while the template is compiled,
+# so Markdown and BeautifulSoup pass them through untouched
+SLOT_TOKEN = 'cmslot{}x'
+SLOT_TOKEN_RE = re.compile(r'cmslot(\d+)x')
+
+# Whitespace around these tags doesn't render, so the minifier drops it
+BLOCK_TAG_RE = re.compile(
+    r'\s*(</?(?:address|article|blockquote|body|br|div|dl|dd|dt|h[1-6]|head|hr|html|li|meta|ol|p|section|table|tbody|td|tfoot|th|thead|title|tr|ul)\b[^>]*>)\s*',
+    re.IGNORECASE,
+)
+# Contents of these tags are left exactly as they are
+PRESERVE_RE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+# Markdown escapes html2text adds, which a plain-text reader doesn't need
+MARKDOWN_ESCAPE_RE = re.compile(r'\\([\\`*_{}\[\]()#+\-.!])')
+# Lines html2text leaves holding only indentation (around <pre> blocks)
+BLANK_LINE_RE = re.compile(r'^[ \t]+$', re.MULTILINE)
+
+# Reserved slot filled with the EmailLog id (used in tracking links and the pixel)
+TRACKING_SLOT = '__tracking_id__'
+# Reserved slots filled with the signature of each tracked link (see emails.tracking.click_signature)
+LINK_SIGNATURE_SLOT = '__link_signature_{}__'
+# Reserved slots filled with each tracked link's target, percent-encoded for the url= parameter
+LINK_URL_SLOT = '__link_url_{}__'
+
+# In-process copy of compiled templates, so repeated lookups skip the cache backend too
+_compiled = {}
+
+# Django Template objects can't be pickled, so they're built once per process
+_django_templates = {}
+
+
+def content_hash(raw_bytes):
+    return hashlib.sha256(raw_bytes).hexdigest()
+
+
+def parse_engine_headers(text):
+    """
+    Header heuristic used by EmailEngine.
+    Pulls out the "Subject:" (same line or the line after) and drops "Email:" lines.
+    Returns (subject or None, body).
+    """
+    lines = text.split('\n')
+    subject = None
+    parsing_body = False
+    new_lines = []
+
+    for i, line in enumerate(lines):
+        stripped_line = line.strip()
+
+        if not parsing_body and stripped_line.lower().startswith('subject:'):
+            potential_subject = stripped_line.split(':', 1)[1].strip()
+            if potential_subject:
+                subject = potential_subject
+            elif i + 1 < len(lines):
+                # Subject is on the next line
+                subject = lines[i + 1].strip()
+            continue
+
+        # Skip the line we just used as the subject
+        if not parsing_body and i > 0 and subject == stripped_line and lines[i - 1].strip().lower() == 'subject:':
+            continue
+
+        if stripped_line.lower().startswith('email:'):
+            continue
+
+        # If we hit "Hi [Name]", we are definitely in body
+        if "Hi " in line:
+            parsing_body = True
+
+        new_lines.append(line)
+
+    return subject, '\n'.join(new_lines).strip()
+
+
+def parse_subject_line(text):
+    """
+    Header heuristic used by the send_campaign command.
+    Only the first line may be "Subject: ..." (or "Subject:" followed by the subject).
+    Returns (subject or None, body).
+    """
+    lines = text.splitlines(keepends=True)
+    subject = None
+    body_start_idx = 0
+
+    if lines and lines[0].strip().lower().startswith('subject:'):
+        first_line_content = lines[0].strip()[8:].strip()
+        if first_line_content:
+            subject = first_line_content
+            body_start_idx = 1
+        elif len(lines) > 1 and lines[1].strip():
+            subject = lines[1].strip()
+            body_start_idx = 2
+        else:
+            body_start_idx = 1 # Just skip the Subject: line
+
+    return subject, ''.join(lines[body_start_idx:])
+
+
+HEADER_PARSERS = {
+    'engine': parse_engine_headers,
+    'subject_line': parse_subject_line,
+}
+
+
+@dataclass
+class CompiledTemplate:
+    """
+    A template parsed once into everything needed to render a message.
+
+    Each *_parts list alternates static text and slot names:
+    [static, slot, static, slot, ..., static]. The *_skeleton strings keep the
+    slot tokens and are only needed when the template also uses Django tags.
+    """
+    key: str
+    content_hash: str
+    subject: str
+    slots: list
+    subject_parts: list
+    html_parts: list
+    text_parts: list
+    subject_skeleton: str = ''
+    html_skeleton: str = ''
+    text_skeleton: str = ''
+    uses_django: bool = False
+    # Bytes per message of the static HTML/text parts, before and after optimizing
+    # (the old output was unminified HTML, and strip_tags or the raw Markdown as text)
+    html_bytes_before: int = 0
+    html_bytes_after: int = 0
+    text_bytes_before: int = 0
+    text_bytes_after: int = 0
+    # Targets of the tracked links as parts lists, in LINK_SIGNATURE_SLOT / LINK_URL_SLOT order
+    links: list = field(default_factory=list)
+
+    def size_report(self):
+        before = self.html_bytes_before + self.text_bytes_before
+        after = self.html_bytes_after + self.text_bytes_after
+        return (
+            f"Message body: {before} -> {after} bytes per message before personalization "
+            f"(HTML {self.html_bytes_before} -> {self.html_bytes_after} minified, "
+            f"text {self.text_bytes_before} -> {self.text_bytes_after} with link targets)"
+        )
+
+    def merge_values(self, context, tracking_id=None):
+        """
+        Slot values for one recipient (what render() fills in, or a batch API substitutes).
+        """
+        values = dict(context)
+        if tracking_id is not None:
+            values[TRACKING_SLOT] = str(tracking_id)
+        for i, parts in enumerate(self.links):
+            url = _fill(parts, values, escape=False)
+            # Encoded whole, so a #fragment or the target's own query string survive the trip
+            values[LINK_URL_SLOT.format(i)] = quote(url, safe='')
+            if tracking_id is not None:
+                values[LINK_SIGNATURE_SLOT.format(i)] = click_signature(values[TRACKING_SLOT], url)
+        return values
+
+    def render(self, context, tracking_id=None):
+        """
+        Returns (subject, html, text) for one recipient.
+        """
+        values = self.merge_values(context, tracking_id)
+
+        if not self.uses_django:
+            return (
+                _fill(self.subject_parts, values, escape=False),
+                _fill(self.html_parts, values, escape=True),
+                _fill(self.text_parts, values, escape=False),
+            )
+
+        from django.template import Context, Template
+
+        django_context = Context(context)
+        rendered = []
+        for name, skeleton, escape in (
+            ('subject', self.subject_skeleton, False),
+            ('html', self.html_skeleton, True),
+            ('text', self.text_skeleton, False),
+        ):
+            cache_key = (self.key, name)
+            template = _django_templates.get(cache_key)
+            if template is None:
+                template = _django_templates[cache_key] = Template(skeleton)
+            rendered.append(_fill(_split_slots(template.render(django_context), self.slots), values, escape))
+        return tuple(rendered)
+
+
+def slot_value(values, slot, escape=False):
+    value = values.get(slot)
+    if value is None:
+        value = '' if slot == TRACKING_SLOT else f'[{slot}]'
+    value = str(value)
+    return html.escape(value) if escape else value
+
+
+def _fill(parts, values, escape):
+    out = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            out.append(part)
+        else:
+            out.append(slot_value(values, part, escape))
+    return ''.join(out)
+
+
+def _split_slots(text, slots):
+    parts = SLOT_TOKEN_RE.split(text)
+    for i in range(1, len(parts), 2):
+        parts[i] = slots[int(parts[i])]
+    return parts
+
+
+def _tokenize(text, slots):
+    """
+    Replaces [Key] with a slot token when Key is one of the slots.
+    Anything else in brackets (e.g. Markdown link text) is left alone.
+    """
+    def replace_placeholder(match):
+        key = match.group(1)
+        if key in slots:
+            return SLOT_TOKEN.format(slots.index(key))
+        return match.group(0)
+    return PLACEHOLDER_RE.sub(replace_placeholder, text)
+
+
+def minify_html(content):
+    """
+    Drops comments and whitespace that doesn't render: runs of whitespace become
+    one space, and whitespace next to block tags goes away. <pre>, <textarea>,
+    <script> and <style> contents are kept as they are.
+    """
+    parts = PRESERVE_RE.split(content)
+    out = []
+    # split() with two groups gives [text, block, tag name, text, block, tag name, ...]
+    for i in range(0, len(parts), 3):
+        text = COMMENT_RE.sub('', parts[i])
+        text = WHITESPACE_RE.sub(' ', text)
+        out.append(BLOCK_TAG_RE.sub(r'\1', text))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    return ''.join(out).strip()
+
+
+def html_to_text(content):
+    """
+    Plain-text alternative of an HTML body. Unlike strip_tags, links keep
+    their targets ("[text](url)"), and lists and line breaks survive.
+    """
+    import html2text
+
+    converter = html2text.HTML2Text()
+    converter.body_width = 0 # Let mail clients wrap
+    converter.ignore_images = True
+    converter.ignore_emphasis = True
+    converter.unicode_snob = True
+    text = BLANK_LINE_RE.sub('', MARKDOWN_ESCAPE_RE.sub(r'\1', converter.handle(content)))
+    return re.sub(r'\n{3,}', '\n\n', text).strip() + '\n'
+
+
+def _add_tracking(html_content, tracking_token, slots):
+    """
+    Rewrites http(s) links through the click tracker and appends the open pixel.
+    Each link target gets a signature slot and a slot for the encoded target
+    (both added to slots), so the tracker only redirects to targets that were
+    sent. Returns (html, link targets).
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    # Target -> its tracker query string; repeated links share one
+    links = {}
+    for a_tag in soup.find_all('a', href=True):
+        original_url = a_tag['href']
+        if not original_url.startswith('http'):
+            continue # Skip internal links or mailto
+        if original_url not in links:
+            slots.extend((LINK_SIGNATURE_SLOT.format(len(links)), LINK_URL_SLOT.format(len(links))))
+            links[original_url] = f"sig={SLOT_TOKEN.format(len(slots) - 2)}&url={SLOT_TOKEN.format(len(slots) - 1)}"
+        a_tag['href'] = f"{settings.SITE_URL}/track/click/{tracking_token}/?{links[original_url]}"
+
+    pixel_url = f"{settings.SITE_URL}/track/open/{tracking_token}/pixel.png"
+    img_tag = soup.new_tag("img", src=pixel_url, width="1", height="1", style="display:none;", alt="")
+    soup.append(img_tag)
+    return str(soup), list(links)
+
+
+def compile_template(text, slots, default_subject='', headers='engine', track=False, key='', digest=''):
+    """
+    Parses a Markdown template into a CompiledTemplate.
+    - headers: which header heuristic to run ('engine' or 'subject_line')
+    - track: rewrite links and add the open pixel (EmailEngine)
+    The HTML part is minified, and the text part is converted from the HTML with
+    html2text, with the original (untracked) link targets. Both happen here, once
+    per template, not for every recipient.
+    """
+    import markdown
+
+    slots = list(slots)
+    if track:
+        slots.append(TRACKING_SLOT)
+
+    subject, body = HEADER_PARSERS[headers](text)
+    subject = subject or default_subject or ''
+
+    subject_skeleton = _tokenize(subject, slots)
+    body_markdown = _tokenize(body, slots)
+    body_html = markdown.markdown(body_markdown)
+
+    links = []
+    if track:
+        html_before, links = _add_tracking(body_html, SLOT_TOKEN.format(slots.index(TRACKING_SLOT)), slots)
+        text_before = strip_tags(body_html)
+    else:
+        html_before = body_html
+        text_before = body_markdown
+
+    html_skeleton = minify_html(html_before)
+    text_skeleton = html_to_text(body_html)
+
+    uses_django = any('{{' in s or '{%' in s for s in (subject_skeleton, body_markdown))
+
+    return CompiledTemplate(
+        key=key,
+        content_hash=digest,
+        subject=subject,
+        slots=slots,
+        subject_parts=_split_slots(subject_skeleton, slots),
+        html_parts=_split_slots(html_skeleton, slots),
+        text_parts=_split_slots(text_skeleton, slots),
+        subject_skeleton=subject_skeleton if uses_django else '',
+        html_skeleton=html_skeleton if uses_django else '',
+        text_skeleton=text_skeleton if uses_django else '',
+        uses_django=uses_django,
+        html_bytes_before=_static_size(html_before),
+        html_bytes_after=_static_size(html_skeleton),
+        text_bytes_before=_static_size(text_before),
+        text_bytes_after=_static_size(text_skeleton),
+        links=[_split_slots(url, slots) for url in links],
+    )
+
+
+def _static_size(skeleton):
+    return len(SLOT_TOKEN_RE.sub('', skeleton).encode('utf-8'))
+
+
+def load_template(template_path, slots, default_subject='', headers='engine', track=False):
+    """
+    Returns the CompiledTemplate for a template file.
+
+    Entries are keyed by the SHA-256 of the file contents plus the compile options,
+    and kept in the 'templates' cache, so repeated or scheduled runs of the same
+    template skip parsing entirely. Editing the file changes the hash, which
+    invalidates the entry on its own.
+    """
+    with open(template_path, 'rb') as f:
+        raw = f.read()
+
+    digest = content_hash(raw)
+    options = repr((COMPILER_VERSION, sorted(set(slots)), default_subject, headers, track, settings.SITE_URL if track else ''))
+    key = f"tmpl:{digest}:{hashlib.sha256(options.encode('utf-8')).hexdigest()[:16]}"
+
+    compiled = _compiled.get(key)
+    if compiled is not None:
+        return compiled
+
+    cache = caches['templates']
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = compile_template(
+            raw.decode('utf-8'), sorted(set(slots)),
+            default_subject=default_subject, headers=headers, track=track,
+            key=key, digest=digest,
+        )
+        cache.set(key, compiled, None)
+
+    _compiled[key] = compiled
+    return compiled
@@ -0,0 +1,188 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from emails.backends.batch_api import BATCH_PATH
+
+# {{s0}} / {{h0}} placeholders of the batch API
+TOKEN_RE = re.compile(r'\{\{([sh]\d+)\}\}')
+
+REJECTIONS = [
+    ('550 5.1.1 Mailbox unavailable', True),
+    ('552 5.2.2 Mailbox full', False),
+    ('554 5.7.1 Message rejected as spam', True),
+]
+
+
+class FakeBatchAPIServer:
+    """
+    Local mock of the HTTP batch email API used by BatchAPIEmailBackend.
+    Substitutes every recipient's values (so malformed batches surface as
+    errors) and keeps only counters. Injectable conditions:
+
+    - latency: seconds to wait per request (plus up to `jitter` more)
+    - per_recipient_latency: extra seconds per recipient in the request
+    - fail_rate: chance that a recipient is rejected
+    - api_key: if set, requests without "Authorization: Bearer <api_key>" get 401
+
+        with FakeBatchAPIServer(latency=0.05) as server:
+            ...  # EMAIL_API_URL = server.url
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, per_recipient_latency=0.0,
+                 fail_rate=0.0, api_key='', seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.per_recipient_latency = per_recipient_latency
+        self.fail_rate = fail_rate
+        self.api_key = api_key
+        self.random = random.Random(seed)
+
+        self.stats = {
+            'connections': 0,
+            'requests': 0,
+            'messages': 0,
+            'recipients': 0,
+            'accepted': 0,
+            'rejected': 0,
+            'request_bytes': 0,
+            'rendered_bytes': 0,
+            'bad_requests': 0,
+        }
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    # --- Lifecycle ---
+
+    def start(self):
+        server = self
+
+        class Handler(BatchAPIHandler):
+            api = server
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+
+    def serve_forever(self):
+        if self._httpd is None:
+            self.start()
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def start_in_thread(self):
+        self.start()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-email-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop_in_thread(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info):
+        self.stop_in_thread()
+
+    # --- API ---
+
+    def count(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self.stats[name] += value
+
+    def handle_batch(self, data):
+        """
+        Returns the results list for a batch request.
+        """
+        results = []
+        messages = data['messages']
+        recipients = 0
+        rendered_bytes = 0
+
+        for message in messages:
+            parts = [message.get('subject') or '', message.get('text') or '', message.get('html') or '']
+            for recipient in message['recipients']:
+                recipients += 1
+                substitutions = recipient.get('substitutions') or {}
+                for part in parts:
+                    rendered_bytes += len(TOKEN_RE.sub(lambda match: substitutions[match.group(1)], part))
+
+                if self.fail_rate and self.random.random() < self.fail_rate:
+                    error, permanent = self.random.choice(REJECTIONS)
+                    results.append({'status': 'rejected', 'error': error, 'permanent': permanent})
+                else:
+                    results.append({'status': 'accepted', 'id': f'fake-{self.random.getrandbits(48):012x}'})
+
+        delay = self.latency + recipients * self.per_recipient_latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        accepted = sum(result['status'] == 'accepted' for result in results)
+        self.count(messages=len(messages), recipients=recipients, accepted=accepted,
+                   rejected=recipients - accepted, rendered_bytes=rendered_bytes)
+        return results
+
+    def summary(self, elapsed=None):
+        lines = [f"{name.replace('_', ' ').capitalize()}: {value}" for name, value in self.stats.items()]
+        if elapsed:
+            lines.append(f"Accepted recipients/sec: {self.stats['accepted'] / elapsed:.1f}")
+        return lines
+
+
+class BatchAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive
+    api = None
+
+    def setup(self):
+        super().setup()
+        self.api.count(connections=1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.api.count(requests=1, request_bytes=len(body))
+
+        if self.path != BATCH_PATH:
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if self.api.api_key and self.headers.get('Authorization') != f'Bearer {self.api.api_key}':
+            self.send_json(401, {'error': 'Invalid API key'})
+            return
+
+        try:
+            results = self.api.handle_batch(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            self.api.count(bad_requests=1)
+            self.send_json(400, {'error': f'Malformed batch: {e!r}'})
+            return
+        self.send_json(200, {'results': results})
@@ -0,0 +1,214 @@
+import asyncio
+import random
+import threading
+
+# Replies used when a failure is injected, by SMTP phase
+TEMP_FAILURES = [
+    '421 4.3.2 Service not available, closing transmission channel',
+    '451 4.3.0 Temporary local problem, try again later',
+    '452 4.2.2 Mailbox full',
+]
+PERM_FAILURES = [
+    '550 5.1.1 Mailbox unavailable',
+    '552 5.3.4 Message size exceeds fixed limit',
+    '554 5.7.1 Message rejected',
+]
+
+
+class FakeSMTPServer:
+    """
+    Minimal asyncio SMTP server for load tests. Accepts everything and keeps
+    only counters, with injectable network conditions:
+
+    - latency: seconds to wait before every reply (plus up to `jitter` more)
+    - max_connections: connections beyond this get "421 Too many connections"
+    - fail_rate: chance that a MAIL/RCPT/DATA reply is a random 4xx/5xx
+    - disconnect_rate: chance of dropping the connection instead of replying
+
+    Run it with `await server.serve_forever()`, or in a background thread:
+
+        with FakeSMTPServer(latency=0.05, fail_rate=0.02) as server:
+            ...  # point EMAIL_HOST/EMAIL_PORT at server.host/server.port
+
+    In pytest, the fake_smtp / fake_smtp_factory fixtures (conftest.py) do this;
+    FakeSMTPServerTests in emails/tests.py shows the TestCase way.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, max_connections=0,
+                 fail_rate=0.0, disconnect_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.max_connections = max_connections
+        self.fail_rate = fail_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+
+        self.stats = {
+            'connections': 0,
+            'active_connections': 0,
+            'peak_connections': 0,
+            'rejected_connections': 0,
+            'commands': 0,
+            'messages': 0,
+            'recipients': 0,
+            'bytes': 0,
+            'temp_failures': 0,
+            'perm_failures': 0,
+            'disconnects': 0,
+        }
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+
+    # --- Lifecycle ---
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=1024 * 1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self):
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            self._started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='fake-smtp', daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop_in_thread(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info):
+        self.stop_in_thread()
+
+    # --- Protocol ---
+
+    async def _reply(self, writer, line):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        writer.write(line.encode('ascii') + b'\r\n')
+        await writer.drain()
+
+    def _injected_failure(self):
+        """Returns a failure reply to send instead of success, or None"""
+        if self.fail_rate and self.random.random() < self.fail_rate:
+            if self.random.random() < 0.5:
+                self.stats['temp_failures'] += 1
+                return self.random.choice(TEMP_FAILURES)
+            self.stats['perm_failures'] += 1
+            return self.random.choice(PERM_FAILURES)
+        return None
+
+    def _should_disconnect(self):
+        if self.disconnect_rate and self.random.random() < self.disconnect_rate:
+            self.stats['disconnects'] += 1
+            return True
+        return False
+
+    async def _handle(self, reader, writer):
+        stats = self.stats
+        stats['connections'] += 1
+
+        if self.max_connections and stats['active_connections'] >= self.max_connections:
+            stats['rejected_connections'] += 1
+            await self._reply(writer, '421 4.7.0 Too many connections, try again later')
+            writer.close()
+            return
+
+        stats['active_connections'] += 1
+        stats['peak_connections'] = max(stats['peak_connections'], stats['active_connections'])
+        try:
+            await self._session(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            stats['active_connections'] -= 1
+            writer.close()
+
+    async def _session(self, reader, writer):
+        await self._reply(writer, '220 fake-smtp ESMTP ready')
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            self.stats['commands'] += 1
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if self._should_disconnect():
+                return
+
+            if verb == 'EHLO':
+                await self._reply(writer, '250-fake-smtp\r\n250-SIZE 52428800\r\n250-8BITMIME\r\n250 AUTH PLAIN')
+            elif verb == 'HELO':
+                await self._reply(writer, '250 fake-smtp')
+            elif verb == 'AUTH':
+                await self._reply(writer, '235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT'):
+                failure = self._injected_failure()
+                if failure:
+                    await self._reply(writer, failure)
+                    if failure.startswith('421'):
+                        return
+                    continue
+                if verb == 'RCPT':
+                    self.stats['recipients'] += 1
+                await self._reply(writer, '250 2.1.0 OK')
+            elif verb == 'DATA':
+                await self._reply(writer, '354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data_line = await reader.readline()
+                    if not data_line:
+                        return
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data_line)
+                self.stats['bytes'] += size
+
+                if self._should_disconnect():
+                    return
+                failure = self._injected_failure()
+                if failure:
+                    await self._reply(writer, failure)
+                    if failure.startswith('421'):
+                        return
+                    continue
+                self.stats['messages'] += 1
+                await self._reply(writer, f'250 2.0.0 Queued as {self.stats["messages"]}')
+            elif verb in ('RSET', 'NOOP'):
+                await self._reply(writer, '250 2.0.0 OK')
+            elif verb == 'QUIT':
+                await self._reply(writer, '221 2.0.0 Bye')
+                return
+            else:
+                await self._reply(writer, '502 5.5.2 Command not recognized')
+
+    def summary(self, elapsed=None):
+        lines = [f"{name.replace('_', ' ').capitalize()}: {value}" for name, value in self.stats.items()]
+        if elapsed:
+            lines.append(f"Accepted messages/sec: {self.stats['messages'] / elapsed:.1f}")
+        return lines
+
@@ -1,3 +1,1007 @@
-from django.test import TestCase
+import csv
+import email
+import html
+import importlib
+import os
+import re
+import smtplib
+import tempfile
+import threading
+import uuid
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.encoding import iri_to_uri
+
+from .attachments import AttachmentError, CampaignMessage, load_attachments
+from .backends.batch_api import BatchAPIEmailBackend, BatchAPIError
+from .models import Audience, Contact, EmailCampaign, EmailLog, Suppression, TrackingEvent
+from .services import EmailEngine
+from .templating import CompiledTemplate, compile_template, html_to_text, load_template, minify_html
+from .suppression import SuppressionSet, address_hash, unsubscribe_token
+from . import enrichment, outbox, templating
+from .fastpath import TrackingDispatcher
+from .ingest import CSVIngest
+from .management.commands.loadtest_smtp import Command as LoadTestCommand
+from .pipeline import RenderError, RenderPipeline
+from .metrics import render as render_metrics
+from .testing.api import TOKEN_RE, FakeBatchAPIServer
+from .testing.smtp import FakeSMTPServer
+from .tracking import EventBuffer, client_ip, get_event_buffer
+
+
+TEMPLATE = """Subject: Hello [Company]
+
+Hi [first_name], a quick note for [Company].
+"""
+
+
+def write_template(directory, content=TEMPLATE):
+    path = Path(directory) / 'template.md'
+    path.write_text(content)
+    return str(path)
+
+
+class UpperTemplate:
+    """
+    Stands in for a CompiledTemplate in RenderPipeline (picklable for the process pool).
+    """
+    def render(self, context, tracking_id=None):
+        if context['email'] == 'bad@example.com':
+            raise ValueError('bad merge value')
+        return context['email'].upper(), '', ''
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', SEND_PIPELINE_QUEUE_SIZE=20)
+class SendCampaignPipelineTests(TransactionTestCase):
+    # The render thread reads recipients while the sending thread writes logs:
+    # a real transaction on each side, as in a campaign run
+
+    def test_sends_more_recipients_than_one_read_chunk(self):
+        # More than one chunk of recipients and a queue that fills up: an open
+        # read cursor in the render thread used to block the log writes on SQLite
+        audience = Audience.objects.create(name='Big list')
+        Contact.objects.bulk_create([
+            Contact(email=f'person{i}@example.com', first_name=f'P{i}', company='Acme') for i in range(1500)
+        ])
+        audience.add_contacts(Contact.objects.values_list('pk', flat=True))
+
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            def send():
+                results.update(EmailEngine.send_campaign('Big send', 'Hello', write_template(directory), audience=audience, render_workers=0))
+
+            # In a thread, so a deadlock fails the test instead of hanging the run
+            sender = threading.Thread(target=send, daemon=True)
+            sender.start()
+            sender.join(timeout=60)
+            self.assertFalse(sender.is_alive(), 'send_campaign deadlocked')
+
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['sent'], 1500)
+        self.assertEqual(EmailLog.objects.filter(status='sent').count(), 1500)
+
+    def test_one_render_error_doesnt_stop_the_campaign(self):
+        audience = Audience.objects.create(name='Some bad')
+        Contact.objects.bulk_create([Contact(email=f'p{i}@example.com', first_name='Bad' if i == 2 else 'Ok') for i in range(5)])
+        audience.add_contacts(Contact.objects.values_list('pk', flat=True))
+        render = CompiledTemplate.render
+
+        def failing_render(template, context, *args, **kwargs):
+            if context['Name'] == 'Bad':
+                raise ValueError('bad merge value')
+            return render(template, context, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(CompiledTemplate, 'render', failing_render):
+            results = EmailEngine.send_campaign('Some bad', 'Hello', write_template(directory), audience=audience, render_workers=0)
+
+        self.assertEqual(results['sent'], 4)
+        self.assertEqual(results['errors'], ['p2@example.com: bad merge value'])
+        failed = EmailLog.objects.get(status='failed')
+        self.assertEqual((failed.contact.email, failed.error_message), ('p2@example.com', 'bad merge value'))
+        self.assertEqual(EmailLog.objects.filter(status='sent').count(), 4)
+        self.assertIn('1 failed to render', results['pipeline'][0])
+
+    def test_pipeline_hands_back_render_errors_in_order(self):
+        emails = ['a@example.com', 'bad@example.com', 'c@example.com']
+        for workers in (0, 1):
+            pipeline = RenderPipeline(UpperTemplate(), workers=workers, chunk_size=2)
+            results = list(pipeline.run((email, {'email': email}, None) for email in emails))
+
+            self.assertEqual([key for key, _ in results], emails)
+            self.assertEqual(results[0][1], ('A@EXAMPLE.COM', '', ''))
+            self.assertIsInstance(results[1][1], RenderError)
+            self.assertEqual(str(results[1][1]), 'bad merge value')
+            self.assertEqual(results[2][1], ('C@EXAMPLE.COM', '', ''))
+            self.assertEqual((pipeline.stats['rendered'], pipeline.stats['render_errors']), (2, 1))
+
+    def test_iter_recipients_reads_in_chunks(self):
+        audience = Audience.objects.create(name='Chunked')
+        Contact.objects.bulk_create([Contact(email=f'c{i}@example.com') for i in range(25)])
+        audience.add_contacts(Contact.objects.values_list('pk', flat=True))
+
+        with self.assertNumQueries(3):
+            emails = [contact.email for contact in audience.iter_recipients(chunk_size=10)]
+        self.assertEqual(sorted(emails), sorted(f'c{i}@example.com' for i in range(25)))
+
+    def test_send_to_audience_uses_the_saved_columns(self):
+        # Whichever member comes first, [Notes] is a slot for everyone
+        audience = Audience.objects.create(name='list', columns=['Notes'])
+        Contact.objects.bulk_create([
+            Contact(email='a@example.com', extra_data={}),
+            Contact(email='b@example.com', extra_data={'Notes': 'hello'}),
+        ])
+        audience.add_contacts(Contact.objects.values_list('pk', flat=True))
+
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            call_command(
+                'send_campaign', audience='list', template=write_template(directory, 'Subject: Hi\n\nNote: [Notes].\n'),
+                subject='Hi', dry_run=True, delay=0, stdout=out,
+            )
+        self.assertIn('Note: hello.', out.getvalue())
+        self.assertIn('Note: .', out.getvalue())
+        self.assertNotIn('[Notes]', out.getvalue())
+
+class CampaignExportTests(TestCase):
+    HEADER = ['Email', 'First Name', 'Last Name', 'Company', 'Job Role', 'Location', 'Email Status', 'Subject', 'Status', 'Sent At', 'Error']
+
+    def setUp(self):
+        self.campaign = EmailCampaign.objects.create(name='Export me', subject='Hi')
+        ann = Contact.objects.create(email='ann@example.com', first_name='Ann', company='Acme, Inc.', job_role='Engineer')
+        bob = Contact.objects.create(email='bob@example.com', first_name='Bob')
+        EmailLog.objects.create(campaign=self.campaign, contact=ann, subject='Hi Ann', status='sent')
+        EmailLog.objects.create(campaign=self.campaign, contact=bob, subject='Hi Bob', status='failed', error_message='550 no such user')
+        # Another campaign's log isn't exported
+        EmailLog.objects.create(campaign=EmailCampaign.objects.create(name='Other', subject='x'), contact=bob, subject='x')
+
+    def check_rows(self, text):
+        header, *rows = csv.reader(StringIO(text))
+        self.assertEqual(header, self.HEADER)
+        rows = sorted(rows)
+        self.assertEqual([row[:5] + row[7:9] + row[10:] for row in rows], [
+            ['ann@example.com', 'Ann', '', 'Acme, Inc.', 'Engineer', 'Hi Ann', 'sent', ''],
+            ['bob@example.com', 'Bob', '', '', '', 'Hi Bob', 'failed', '550 no such user'],
+        ])
+
+    def test_command_writes_to_stdout_or_a_file(self):
+        out = StringIO()
+        call_command('export_campaign', name='Export me', stdout=out)
+        self.check_rows(out.getvalue())
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'export.csv'
+            out = StringIO()
+            call_command('export_campaign', name='Export me', output=str(path), stdout=out)
+            self.check_rows(path.read_text(encoding='utf-8'))
+        self.assertIn('Exported 2 rows', out.getvalue())
+
+    def test_staff_endpoint_streams_the_csv(self):
+        url = f'/campaigns/{self.campaign.pk}/export.csv'
+        self.assertEqual(self.client.get(url).status_code, 302) # To the admin login
+
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="campaign_{self.campaign.pk}.csv"')
+        self.check_rows(b''.join(response.streaming_content).decode('utf-8'))
+
+
+class SendColdEmailsCommandTests(TestCase):
+    def test_csv_named_like_a_segment_is_an_error(self):
+        # Without --audience the CSV goes into the audience named after it
+        Audience.objects.create(name='leads', filters={'location': 'NYC'})
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = Path(directory) / 'leads.csv'
+            csv_path.write_text('Email,Name\nann@example.com,Ann\n')
+            call_command('send_cold_emails', csv=[str(csv_path)], template=write_template(directory), dry_run=True, stdout=out)
+
+        self.assertIn("Audience 'leads' is a segment", out.getvalue())
+        self.assertFalse(Contact.objects.exists())
+
+
+class ContactAttributeTests(TestCase):
+    def setUp(self):
+        self.ann, self.bob, self.cal = Contact.objects.bulk_create([
+            Contact(email='ann@example.com', job_role='Engineer', location='NYC', extra_data={'Job Role': 'Engineer', 'Team': 'Red'}),
+            Contact(email='bob@example.com', job_role='Manager', location='NYC', extra_data={'Job Role': 'Manager', 'Team': 'Blue'}),
+            Contact(email='cal@example.com', job_role='Engineer', location='LA', extra_data={'Team': 'Red'}),
+        ])
+
+    def emails(self, contacts):
+        return sorted(contact.email for contact in contacts)
+
+    def test_promoted_attributes_use_their_column(self):
+        # Any header spelling of the attribute, or the column name itself
+        for name in ('Job Role', 'JobRole', 'job_role'):
+            contacts = Contact.objects.with_attribute(name, 'Engineer')
+            where = str(contacts.query).split(' WHERE ')[1]
+            self.assertIn('"job_role" =', where)
+            self.assertNotIn('extra_data', where)
+            self.assertEqual(self.emails(contacts), ['ann@example.com', 'cal@example.com'])
+        self.assertEqual(self.emails(Contact.objects.with_attribute('Location', ['LA', 'SF'])), ['cal@example.com'])
+
+    def test_other_attributes_match_extra_data(self):
+        self.assertEqual(self.emails(Contact.objects.with_attribute('Team', 'Red')), ['ann@example.com', 'cal@example.com'])
+        self.assertEqual(self.emails(Contact.objects.with_attribute('Team', ['Blue', 'Green'])), ['bob@example.com'])
+        self.assertEqual(self.emails(Contact.objects.with_attribute('Team', 'red')), [])
+        # Chained, as segment filters are
+        self.assertEqual(self.emails(Contact.objects.with_attribute('Team', 'Red').with_attribute('location', 'NYC')), ['ann@example.com'])
+
+    def test_migration_backfills_promoted_columns(self):
+        Contact.objects.all().delete()
+        old, kept, empty = Contact.objects.bulk_create([
+            Contact(email='old@example.com', extra_data={'JobRole': ' Engineer ', 'location': 'NYC', 'Email Status': 'Valid'}),
+            Contact(email='kept@example.com', job_role='Director', extra_data={'Job Role': 'Engineer'}),
+            Contact(email='empty@example.com'),
+        ])
+
+        migration = importlib.import_module('emails.migrations.0004_backfill_promoted_attributes')
+        with mock.patch.object(migration, 'BATCH_SIZE', 2):
+            migration.backfill_promoted_attributes(apps, connection.schema_editor())
+
+        values = {contact.email: (contact.job_role, contact.location, contact.email_status) for contact in Contact.objects.all()}
+        self.assertEqual(values, {
+            'old@example.com': ('Engineer', 'NYC', 'Valid'),
+            'kept@example.com': ('Director', '', ''), # Set columns aren't overwritten
+            'empty@example.com': ('', '', ''),
+        })
+
+
+class AudienceColumnsTests(TestCase):
+    def test_import_saves_the_columns_of_every_file(self):
+        audience = Audience.objects.create(name='list')
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = Path(directory) / 'a.csv', Path(directory) / 'b.csv'
+            first.write_text('Email,Name\nann@example.com,Ann\n')
+            second.write_text('Email,Notes\nbob@example.com,hello\n')
+            EmailEngine.import_contacts([str(first), str(second)], audience=audience)
+
+        audience.refresh_from_db()
+        self.assertEqual(audience.columns, ['Email', 'Name', 'Notes'])
+
+    def test_segment_columns_are_every_key_of_its_contacts(self):
+        Contact.objects.bulk_create([
+            Contact(email='a@example.com', location='NYC', extra_data={'Name': 'A'}),
+            Contact(email='b@example.com', location='NYC', extra_data={'Notes': 'hi'}),
+            Contact(email='c@example.com', location='LA', extra_data={'Other': 'x'}),
+        ])
+        segment = Audience.objects.create(name='nyc', filters={'location': 'NYC'})
+        self.assertEqual(sorted(segment.template_columns(chunk_size=1)), ['Name', 'Notes'])
+
+    def test_migration_saves_columns_of_existing_audiences(self):
+        audience = Audience.objects.create(name='old')
+        Contact.objects.bulk_create([
+            Contact(email='a@example.com', extra_data={'Email': 'a@example.com'}),
+            Contact(email='b@example.com', extra_data={'Email': 'b@example.com', 'Notes': 'hi'}),
+        ])
+        audience.add_contacts(Contact.objects.values_list('pk', flat=True))
+
+        migration = importlib.import_module('emails.migrations.0015_audience_columns')
+        migration.backfill_audience_columns(apps, connection.schema_editor())
+
+        audience.refresh_from_db()
+        self.assertEqual(audience.columns, ['Email', 'Notes'])
+
+
+class EventBufferTests(TestCase):
+    def make_buffer(self):
+        # Flushed by hand only
+        return EventBuffer(max_events=1000, flush_interval=3600, dedupe_window=30)
+
+    def test_repeated_hits_are_deduped(self):
+        buffer = self.make_buffer()
+        tracking_id = uuid.uuid4()
+        self.assertTrue(buffer.add(tracking_id, TrackingEvent.OPEN))
+        self.assertFalse(buffer.add(tracking_id, TrackingEvent.OPEN))
+        self.assertTrue(buffer.add(tracking_id, TrackingEvent.CLICK, url='https://example.com/a'))
+        self.assertTrue(buffer.add(tracking_id, TrackingEvent.CLICK, url='https://example.com/b'))
+        self.assertFalse(buffer.add(tracking_id, TrackingEvent.CLICK, url='https://example.com/a'))
+
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(TrackingEvent.objects.count(), 3)
+        self.assertEqual(buffer.stats['deduped'], 2)
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_bad_row_only_drops_itself(self):
+        buffer = self.make_buffer()
+        for _ in range(5):
+            buffer.add(uuid.uuid4(), TrackingEvent.OPEN, ip_address='203.0.113.7')
+        buffer._pending[2].tracking_id = None # NOT NULL: fails the bulk insert
+
+        with self.assertLogs('emails.tracking', 'WARNING'):
+            self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(TrackingEvent.objects.count(), 4)
+        self.assertEqual(buffer.stats['dropped'], 1)
+        self.assertEqual(buffer.stats['written'], 4)
+
+    def test_client_ip(self):
+        self.assertEqual(client_ip({'HTTP_X_FORWARDED_FOR': '203.0.113.7, 10.0.0.1', 'REMOTE_ADDR': '10.0.0.1'}), '203.0.113.7')
+        self.assertEqual(client_ip({'REMOTE_ADDR': '2001:db8::1'}), '2001:db8::1')
+        # Client-controlled junk is stored as no address
+        self.assertIsNone(client_ip({'HTTP_X_FORWARDED_FOR': 'unknown', 'REMOTE_ADDR': '10.0.0.1'}))
+        self.assertIsNone(client_ip({'HTTP_X_FORWARDED_FOR': '1.2.3.4:5678'}))
+        self.assertIsNone(client_ip({}))
+
+
+@override_settings(SITE_URL='http://testserver')
+class ClickTrackingTests(TestCase):
+    def setUp(self):
+        self.tracking_id = uuid.uuid4()
+        [(self.path, self.query)] = self.tracked_links('Hi [Name], see [pricing](https://example.com/pricing?ref=[Company]).')
+        self.addCleanup(get_event_buffer()._pending.clear)
+
+    def tracked_links(self, body, company='Acme'):
+        """
+        (path, query string) of each tracked link in the HTML part of body.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            template = EmailEngine.load_template(write_template(directory, f'Subject: Hi\n\n{body}\n'))
+        contact = Contact(email='ann@example.com', first_name='Ann', company=company)
+        _, html_body, _ = EmailEngine.prepare_content(template, contact, self.tracking_id)
+        links = [urlsplit(html.unescape(href)) for href in re.findall(r'href="([^"]+)"', html_body)]
+        return [(link.path, link.query) for link in links]
+
+    def test_fragments_and_query_strings_survive(self):
+        # Browsers don't send the #fragment of the tracker URL, and an unencoded
+        # "&" in the target would split it; both have to arrive encoded
+        links = self.tracked_links(
+            '[a](https://example.com/page#section) [b](https://example.com/?a=1&b=2) [c](https://example.com/?q=[Company]#top)',
+            company='R&D #1',
+        )
+        targets = ['https://example.com/page#section', 'https://example.com/?a=1&b=2', 'https://example.com/?q=R&D #1#top']
+        for (path, query), target in zip(links, targets):
+            response = self.client.get(path, QUERY_STRING=query)
+            self.assertEqual(response.status_code, 302, target)
+            self.assertEqual(response['Location'], iri_to_uri(target))
+
+    def test_signed_link_redirects(self):
+        self.assertEqual(self.path, f'/track/click/{self.tracking_id}/')
+        response = self.client.get(self.path, QUERY_STRING=self.query)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], 'https://example.com/pricing?ref=Acme')
+
+    def test_other_targets_are_rejected(self):
+        signature = self.query.split('&url=')[0]
+        for query in (
+            f'{signature}&url=https://evil.example/',            # Signature of another target
+            'url=https://example.com/pricing?ref=Acme',          # Unsigned
+        ):
+            self.assertEqual(self.client.get(self.path, QUERY_STRING=query).status_code, 400)
+        # Signed for another email
+        self.assertEqual(self.client.get(f'/track/click/{uuid.uuid4()}/', QUERY_STRING=self.query).status_code, 400)
+
+    @override_settings(TRACKING_ALLOW_UNSIGNED_CLICKS=True)
+    def test_unsigned_links_when_allowed(self):
+        response = self.client.get(self.path, QUERY_STRING='url=https://example.com/old')
+        self.assertEqual(response.status_code, 302)
+
+    def test_fast_path_checks_the_signature(self):
+        dispatcher = TrackingDispatcher(application=None)
+        statuses = []
+
+        def call(query):
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': self.path, 'QUERY_STRING': query, 'REMOTE_ADDR': '203.0.113.7'}
+            dispatcher(environ, lambda status, headers: statuses.append((status, dict(headers))))
+            return statuses[-1]
+
+        status, headers = call(self.query)
+        self.assertEqual((status, headers['Location']), ('302 Found', 'https://example.com/pricing?ref=Acme'))
+        self.assertEqual(call('url=https://evil.example/')[0], '400 Bad Request')
+
+
+class SuppressionSetTests(TestCase):
+    def test_addresses_are_normalized(self):
+        Suppression.suppress([' Ann@Example.COM '], Suppression.UNSUBSCRIBE)
+        suppressed = SuppressionSet.load()
+        self.assertIn('ann@example.com', suppressed)
+        self.assertIn('ANN@example.com', suppressed)
+        self.assertNotIn('ann@example.org', suppressed)
+        self.assertEqual(Suppression.objects.get().email, 'ann@example.com')
+
+    def test_load_is_sorted_across_the_signed_range(self):
+        emails = [f'user{i}@example.com' for i in range(500)]
+        Suppression.suppress(emails[::2], Suppression.BOUNCE)
+        suppressed = SuppressionSet.load()
+
+        hashes = list(suppressed.hashes)
+        self.assertEqual(hashes, sorted(hashes))
+        self.assertTrue(hashes[0] < 0 < hashes[-1])
+        self.assertEqual(len(suppressed), 250)
+        self.assertEqual(suppressed.nbytes, 250 * 8)
+        self.assertEqual([email for email in emails if email in suppressed], emails[::2])
+
+    def test_only_an_equal_hash_matches(self):
+        value = address_hash('ann@example.com')
+        self.assertNotIn('ann@example.com', SuppressionSet([value - 1, value + 1]))
+        # Two addresses with the same hash: both count as suppressed
+        self.assertIn('ann@example.com', SuppressionSet([value - 1, value, value, value + 1]))
+        self.assertNotIn('ann@example.com', SuppressionSet())
+
+    def test_exclude(self):
+        Suppression.suppress(['b@example.com', 'd@example.com'], Suppression.MANUAL)
+        suppressed = SuppressionSet.load()
+        rows = [{'address': f'{name}@example.com'} for name in 'abcde']
+
+        kept = list(suppressed.exclude(rows, email=lambda row: row['address']))
+        self.assertEqual([row['address'] for row in kept], ['a@example.com', 'c@example.com', 'e@example.com'])
+        self.assertEqual(suppressed.skipped, 2)
+
+        empty = SuppressionSet()
+        self.assertEqual(list(empty.exclude(rows, email=lambda row: row['address'])), rows)
+        self.assertEqual(empty.skipped, 0)
+
+    def test_suppress_keeps_the_first_reason(self):
+        Suppression.suppress(['ann@example.com'], Suppression.BOUNCE)
+        self.assertEqual(Suppression.suppress(['ANN@example.com', 'bob@example.com', ''], Suppression.UNSUBSCRIBE), 2)
+        self.assertEqual(Suppression.objects.get(email='ann@example.com').reason, Suppression.BOUNCE)
+        self.assertEqual(Suppression.objects.count(), 2)
+
+
+class UnsubscribeViewTests(TestCase):
+    def test_get_only_shows_the_form(self):
+        response = self.client.get(f'/unsubscribe/{unsubscribe_token("Ann@Example.com")}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'ann@example.com')
+        self.assertFalse(Suppression.objects.exists())
+
+    def test_post_unsubscribes(self):
+        response = self.client.post(f'/unsubscribe/{unsubscribe_token("Ann@Example.com")}/', {'List-Unsubscribe': 'One-Click'})
+        self.assertEqual(response.status_code, 200)
+        suppression = Suppression.objects.get()
+        self.assertEqual((suppression.email, suppression.reason), ('ann@example.com', Suppression.UNSUBSCRIBE))
+        self.assertIn('ann@example.com', SuppressionSet.load())
+
+    def test_tampered_token(self):
+        token = unsubscribe_token('ann@example.com')
+        response = self.client.post(f'/unsubscribe/{token[:-2]}xx/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Suppression.objects.exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'templates': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'template-cache-tests', 'TIMEOUT': None,
+}})
+class TemplateCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = write_template(directory.name)
+        # Start from an empty in-process copy, and leave the real one as it was
+        patcher = mock.patch.dict(templating._compiled, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(caches['templates'].clear)
+
+    def load(self, slots=('first_name', 'Company')):
+        return load_template(self.path, list(slots), headers='subject_line')
+
+    def test_hits_skip_compiling(self):
+        first = self.load()
+        with mock.patch.object(templating, 'compile_template', side_effect=AssertionError('compiled again')):
+            # In-process copy, then the cache backend (another process)
+            self.assertIs(self.load(), first)
+            templating._compiled.clear()
+            self.assertEqual(self.load().key, first.key)
+
+    def test_editing_the_file_or_the_slots_recompiles(self):
+        first = self.load()
+        Path(self.path).write_text(TEMPLATE.replace('a quick note', 'a short note'))
+        edited = self.load()
+        self.assertNotEqual(edited.key, first.key)
+        self.assertIn('a short note', edited.render({'first_name': 'Ann', 'Company': 'Acme'})[2])
+
+        fewer_slots = self.load(slots=['first_name'])
+        self.assertNotEqual(fewer_slots.key, edited.key)
+        self.assertEqual(fewer_slots.subject_parts, ['Hello [Company]'])
+        # Same slots in another order are the same entry
+        self.assertIs(self.load(slots=['Company', 'first_name']), edited)
+
+    def test_missing_values_render_as_the_placeholder(self):
+        subject, html_body, text = self.load().render({'first_name': 'Ann'})
+        self.assertEqual(subject, 'Hello [Company]')
+        self.assertIn('Hi Ann, a quick note for [Company].', text)
+        self.assertIn('[Company]', html_body)
+
+
+@override_settings(SITE_URL='http://testserver')
+class MessageBodyTests(SimpleTestCase):
+    def test_minify_drops_whitespace_that_doesnt_render(self):
+        content = '<div>\n  <p>Hello   <b>world</b> and  <i>you</i>\n</p>\n<!-- note -->\n<pre>  keep\n   this </pre>\n</div>'
+        self.assertEqual(minify_html(content), '<div><p>Hello <b>world</b> and <i>you</i></p><pre>  keep\n   this </pre></div>')
+
+    def test_minify_keeps_conditional_comments(self):
+        self.assertEqual(minify_html('<p>a</p>\n<!--[if mso]><p>b</p><![endif]-->'), '<p>a</p><!--[if mso]><p>b</p><![endif]-->')
+
+    def test_text_part_keeps_links_lists_and_preformatted_text(self):
+        text = html_to_text(
+            '<p>Hi <b>Ann</b>,   see   <a href="https://example.com/a_b?x=1">our   pricing</a>.</p>'
+            '<ul><li>One</li><li>Two_2</li></ul><pre>line 1\n    indented *x*\n</pre><img src="x.png" alt="logo">'
+        )
+        self.assertEqual(text, 'Hi Ann, see [our pricing](https://example.com/a_b?x=1).\n\n  * One\n  * Two_2\n\n    line 1\n        indented *x*\n')
+
+    def test_compiled_parts_are_minified_and_text_has_the_original_links(self):
+        template = compile_template('Subject: Hi\n\nHello [Name],\n\nSee   [the site](https://example.com/x).\n\n    code  block\n', ['Name'], track=True)
+        _, html_body, text = template.render({'Name': 'Ann'}, tracking_id='abc')
+
+        self.assertTrue(html_body.startswith('<p>Hello Ann,</p><p>See <a href="http://testserver/track/click/abc/?'))
+        self.assertIn('<pre><code>code  block\n</code></pre>', html_body)
+        self.assertEqual(text, 'Hello Ann,\n\nSee [the site](https://example.com/x).\n\n    code  block\n')
+        self.assertLess(template.html_bytes_after, template.html_bytes_before)
+
+
+class CSVIngestTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def write_csv(self, name, text):
+        path = self.directory / name
+        path.write_text(text, encoding='utf-8')
+        return str(path)
+
+    def test_headers_emails_and_duplicates_across_files(self):
+        first = self.write_csv('a.csv', '\ufeffE-mail Address,Full Name,Job Role\n Ann@Example.com ,Ann,Engineer\n,No Email,x\nbob@example.com,Bob,\n')
+        second = self.write_csv('b.csv', 'email,NAME,job_role,Notes\nANN@example.com,Ann Again,Manager,dup\ncal@example.com,Cal,,hi\n')
+        ingest = CSVIngest([first, second])
+        rows = list(ingest)
+
+        # Renamed headers are kept under each file's spelling too
+        self.assertEqual(ingest.fieldnames, ['Email', 'E-mail Address', 'Name', 'Full Name', 'Job Role', 'email', 'NAME', 'Notes'])
+        self.assertEqual([row['Email'] for row in rows], ['ann@example.com', 'bob@example.com', 'cal@example.com'])
+        # First occurrence wins
+        self.assertEqual(
+            {name: rows[0][name] for name in ('Email', 'Name', 'Job Role', 'Notes')},
+            {'Email': 'ann@example.com', 'Name': 'Ann', 'Job Role': 'Engineer', 'Notes': ''},
+        )
+        self.assertEqual(rows[2]['Notes'], 'hi')
+        self.assertEqual(ingest.stats['rows_read'], 5)
+        self.assertEqual(ingest.stats['duplicates'], 1)
+        self.assertEqual(ingest.stats['rows_without_email'], 1)
+
+    def test_rows_from_narrower_files_have_every_column(self):
+        first = self.write_csv('a.csv', 'Email,Full Name\nann@example.com,Ann Lee\n')
+        second = self.write_csv('b.csv', 'email address,Notes\nbob@example.com,hello\n')
+        ingest = CSVIngest([first, second])
+        ann, bob = list(ingest)
+
+        self.assertEqual(ingest.fieldnames, ['Email', 'Name', 'Full Name', 'email address', 'Notes'])
+        self.assertEqual(ann, {'Email': 'ann@example.com', 'Name': 'Ann Lee', 'Full Name': 'Ann Lee', 'email address': 'ann@example.com', 'Notes': ''})
+        self.assertEqual(bob, {'Email': 'bob@example.com', 'Name': '', 'Full Name': '', 'email address': 'bob@example.com', 'Notes': 'hello'})
+
+        # Placeholders under the renamed spelling, or of another file's columns, get values
+        template = load_template(write_template(self.directory, 'Subject: Hi\n\n[Full Name]|[Name]|[Notes]\n'), ingest.fieldnames, headers='subject_line')
+        self.assertEqual(template.render(ann)[2].strip(), 'Ann Lee|Ann Lee|')
+        self.assertEqual(template.render(bob)[2].strip(), '||hello')
+
+    @mock.patch('emails.ingest.MAX_OPEN_RUNS', 3)
+    def test_external_dedupe_over_the_memory_budget(self):
+        lines = ['Email,Name,Notes']
+        for i in range(300):
+            lines.append(f'user{i % 120}@example.com,User {i},"line one\nline\ttwo {i}"')
+        path = self.write_csv('big.csv', '\n'.join(lines) + '\n')
+
+        # A tiny budget spills almost everything to sorted runs, merged in several passes
+        ingest = CSVIngest(path, memory_budget=2000)
+        rows = list(ingest)
+
+        self.assertGreater(ingest.stats['run_files'], 3)
+        self.assertEqual(sorted(row['Email'] for row in rows), sorted(f'user{i}@example.com' for i in range(120)))
+        self.assertEqual(ingest.stats['duplicates'], 180)
+        # First occurrences, fields intact through the run files
+        by_email = {row['Email']: row for row in rows}
+        self.assertEqual(by_email['user7@example.com'], {'Email': 'user7@example.com', 'Name': 'User 7', 'Notes': 'line one\nline\ttwo 7'})
+
+
+class IncrementalImportTests(TestCase):
+    CSV = 'Email,Name,Company,Job Role\nann@example.com,Ann Lee,Acme,Engineer\nbob@example.com,Bob,Beta,Manager\ncal@example.com,Cal,Gamma,\n'
+
+    def import_csv(self, text):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'contacts.csv'
+            path.write_text(text)
+            with CaptureQueriesContext(connection) as queries:
+                results = EmailEngine.import_contacts(str(path))
+        writes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        return results, writes
+
+    def test_reimporting_the_same_csv_writes_nothing(self):
+        results, _ = self.import_csv(self.CSV)
+        self.assertEqual((results['created'], results['updated'], results['unchanged']), (3, 0, 0))
+        # Hashes match what save() computes
+        for contact in Contact.objects.all():
+            self.assertEqual(contact.row_hash, Contact.compute_row_hash({name: getattr(contact, name) for name in Contact.ROW_HASH_FIELDS}))
+
+        results, writes = self.import_csv(self.CSV)
+        self.assertEqual((results['created'], results['updated'], results['unchanged']), (0, 0, 3))
+        self.assertEqual(writes, [])
+
+    def test_editing_one_row_updates_only_that_contact(self):
+        self.import_csv(self.CSV)
+        before = dict(Contact.objects.values_list('email', 'row_hash'))
+
+        results, writes = self.import_csv(self.CSV.replace('Bob,Beta,Manager', 'Bob,Beta,Director'))
+        self.assertEqual((results['created'], results['updated'], results['unchanged']), (0, 1, 2))
+        self.assertEqual(len(writes), 1)
+        after = dict(Contact.objects.values_list('email', 'row_hash'))
+        self.assertEqual([email for email in before if before[email] != after[email]], ['bob@example.com'])
+        self.assertEqual(Contact.objects.get(email='bob@example.com').job_role, 'Director')
+
+
+class ContactEmailNormalizationTests(TestCase):
+    def test_save_normalizes(self):
+        self.assertEqual(Contact.objects.create(email=' Ann@Example.COM ').email, 'ann@example.com')
+
+    def test_migration_merges_contacts_that_differ_in_case(self):
+        # bulk_create skips save(), like rows written before emails were normalized
+        john, upper, lower, other = Contact.objects.bulk_create([
+            Contact(email='John@X.com', first_name='John'),
+            Contact(email='JOHN@x.com '),
+            Contact(email='john@x.com'),
+            Contact(email='Mary@X.com'),
+        ])
+        first, second = Audience.objects.create(name='first'), Audience.objects.create(name='second')
+        first.add_contacts([john.pk, upper.pk, lower.pk])
+        second.add_contacts([upper.pk, lower.pk])
+        campaign = EmailCampaign.objects.create(name='c', subject='s')
+        EmailLog.objects.create(campaign=campaign, contact=upper, subject='s')
+
+        migration = importlib.import_module('emails.migrations.0013_normalize_contact_emails')
+        migration.normalize_contact_emails(apps, connection.schema_editor())
+
+        self.assertEqual(sorted(Contact.objects.values_list('email', flat=True)), ['john@x.com', 'mary@x.com'])
+        kept = Contact.objects.get(email='john@x.com')
+        self.assertEqual((kept.pk, kept.first_name), (john.pk, 'John'))
+        self.assertEqual(list(first.recipients()), [kept])
+        self.assertEqual(list(second.recipients()), [kept])
+        self.assertEqual(EmailLog.objects.get().contact, kept)
+        self.assertEqual(Contact.objects.get(pk=other.pk).email, 'mary@x.com')
+
+    def test_reimport_matches_a_mixed_case_contact(self):
+        Contact.objects.bulk_create([Contact(email='John@X.com')])
+        migration = importlib.import_module('emails.migrations.0013_normalize_contact_emails')
+        migration.normalize_contact_emails(apps, connection.schema_editor())
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = Path(directory) / 'people.csv'
+            csv_path.write_text('Email,Name\nJOHN@x.com,John Smith\n')
+            results = EmailEngine.import_contacts(str(csv_path))
+
+        self.assertEqual(results['updated'], 1)
+        self.assertEqual(Contact.objects.get().first_name, 'John')
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.campaign = EmailCampaign.objects.create(name='Queued', subject='Hello')
+        self.contacts = Contact.objects.bulk_create([Contact(email=f'q{i}@example.com') for i in range(4)])
+        outbox.enqueue(self.campaign, [contact.pk for contact in self.contacts], 'Hello')
+
+    def expire(self, logs):
+        EmailLog.objects.filter(pk__in=[log.pk for log in logs]).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_enqueue_skips_contacts_already_queued(self):
+        self.assertEqual(outbox.enqueue(self.campaign, [contact.pk for contact in self.contacts], 'Hello'), 0)
+        self.assertEqual(outbox.pending(self.campaign).count(), 4)
+
+    def test_claims_dont_overlap(self):
+        first, _ = outbox.claim(self.campaign, 'a', 3, 60, 3)
+        second, _ = outbox.claim(self.campaign, 'b', 3, 60, 3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({log.pk for log in first} & {log.pk for log in second})
+        self.assertEqual(outbox.claim(self.campaign, 'c', 3, 60, 3)[0], [])
+
+    def test_renew_keeps_only_logs_still_held(self):
+        logs, expires = outbox.claim(self.campaign, 'a', 4, 60, 3)
+        self.expire(logs[:1])
+        taken, _ = outbox.claim(self.campaign, 'b', 4, 60, 3)
+        held, new_expires = outbox.renew(logs, 'a', expires, 60)
+        self.assertEqual([log.pk for log in taken], [logs[0].pk])
+        self.assertEqual([log.pk for log in held], [log.pk for log in logs[1:]])
+        self.assertEqual(EmailLog.objects.filter(leased_by='a', lease_expires_at=new_expires).count(), 3)
+
+    def test_expired_lease_is_reclaimed_and_old_holder_cant_complete(self):
+        logs, _ = outbox.claim(self.campaign, 'a', 1, 60, 3)
+        self.expire(logs)
+        taken, _ = outbox.claim(self.campaign, 'b', 1, 60, 3)
+        self.assertEqual(taken[0].pk, logs[0].pk)
+        self.assertFalse(outbox.start(logs[0], 'a'))
+        self.assertFalse(outbox.complete(logs[0], 'a', 'sent', 'Hello'))
+        self.assertTrue(outbox.complete(taken[0], 'b', 'sent', 'Hello'))
+        self.assertEqual(EmailLog.objects.get(pk=logs[0].pk).status, 'sent')
+
+    def test_release_hands_logs_back(self):
+        logs, _ = outbox.claim(self.campaign, 'a', 4, 60, 3)
+        outbox.release(logs, 'a')
+        self.assertEqual(len(outbox.claim(self.campaign, 'b', 4, 60, 3)[0]), 4)
+
+    def test_message_tried_max_attempts_times_is_given_up(self):
+        for worker in ['a', 'b']:
+            logs, _ = outbox.claim(self.campaign, worker, 1, 60, 2)
+            self.assertTrue(outbox.start(logs[0], worker))
+            # The worker dies before a result
+            self.expire(logs)
+        poisoned = logs[0].pk
+        self.assertEqual(EmailLog.objects.get(pk=poisoned).attempts, 2)
+
+        claimed, _ = outbox.claim(self.campaign, 'c', 4, 60, 2)
+        self.assertNotIn(poisoned, [log.pk for log in claimed])
+        self.assertEqual(outbox.give_up(self.campaign, 2), 1)
+        log = EmailLog.objects.get(pk=poisoned)
+        self.assertEqual(log.status, 'failed')
+        self.assertIn('2 attempts', log.error_message)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_worker_compiles_with_the_columns_the_campaign_was_queued_with(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = Path(directory) / 'notes.csv'
+            csv_path.write_text('Email,Notes\nann@example.com,hello\n')
+            template_path = write_template(directory, 'Subject: Hi\n\nNote: [Notes]\n')
+            call_command('send_campaign', csv=[str(csv_path)], template=template_path, subject='Hi', name='Notes', enqueue=True, stdout=StringIO())
+            self.assertEqual(EmailCampaign.objects.get(name='Notes').columns, ['Email', 'Notes'])
+            # Not read from the audience (or one of its members) any more
+            Audience.objects.update(columns=[])
+            call_command('send_campaign', worker=True, name='Notes', stdout=StringIO())
+
+        [message] = mail.outbox
+        self.assertIn('Note: hello', message.body)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_worker_fails_a_message_that_cant_be_rendered(self):
+        render = CompiledTemplate.render
+
+        def failing_render(template, context, *args, **kwargs):
+            if context['email'] == 'q1@example.com':
+                raise ValueError('bad merge value')
+            return render(template, context, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as directory:
+            EmailCampaign.objects.filter(pk=self.campaign.pk).update(template_path=write_template(directory))
+            with mock.patch.object(CompiledTemplate, 'render', failing_render):
+                call_command('send_campaign', worker=True, name='Queued', stdout=StringIO())
+
+        failed = EmailLog.objects.get(status='failed')
+        self.assertEqual(failed.contact.email, 'q1@example.com')
+        self.assertEqual(failed.error_message, 'bad merge value')
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(EmailLog.objects.filter(status='sent').count(), 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class FakeSMTPServerTests(SimpleTestCase):
+    MESSAGE = 'Subject: Hello\r\n\r\nHi there.\r\n'
+
+    def start(self, **options):
+        server = FakeSMTPServer(**options).start_in_thread()
+        self.addCleanup(server.stop_in_thread)
+        return server
+
+    def test_accepts_messages(self):
+        server = self.start()
+        with smtplib.SMTP(server.host, server.port) as client:
+            client.sendmail('me@example.com', ['ann@example.com', 'bob@example.com'], self.MESSAGE)
+            client.sendmail('me@example.com', ['cal@example.com'], self.MESSAGE)
+
+        self.assertEqual(server.stats['messages'], 2)
+        self.assertEqual(server.stats['recipients'], 3)
+        self.assertEqual(server.stats['connections'], 1)
+
+    def test_injected_failures(self):
+        server = self.start(fail_rate=1.0, seed=1)
+        with self.assertRaises(smtplib.SMTPException):
+            with smtplib.SMTP(server.host, server.port) as client:
+                client.sendmail('me@example.com', ['ann@example.com'], self.MESSAGE)
+
+        self.assertEqual(server.stats['messages'], 0)
+        self.assertEqual(server.stats['temp_failures'] + server.stats['perm_failures'], 1)
+
+    def test_connection_limit(self):
+        server = self.start(max_connections=1)
+        with smtplib.SMTP(server.host, server.port):
+            with self.assertRaises(smtplib.SMTPConnectError):
+                smtplib.SMTP(server.host, server.port)
+
+        self.assertEqual(server.stats['rejected_connections'], 1)
+        self.assertEqual(server.stats['peak_connections'], 1)
+
+
+class LoadTestCommandTests(TestCase):
+    def test_cleanup_removes_load_test_suppressions(self):
+        Suppression.suppress(['user1@loadtest.example', 'ann@example.com'], Suppression.BOUNCE)
+        LoadTestCommand().cleanup('20260101000000')
+        self.assertEqual(list(Suppression.objects.values_list('email', flat=True)), ['ann@example.com'])
+
+
+class SharedAttachmentTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.files = {}
+        for name, size in (('resume.pdf', 200_000), ('notes.txt', 1000)):
+            path = Path(directory.name) / name
+            path.write_bytes(os.urandom(size))
+            self.files[str(path)] = path.read_bytes()
+        self.attachments = load_attachments(list(self.files))
+
+    def attached(self, raw):
+        parsed = email.message_from_bytes(raw)
+        return {part.get_filename(): (part.get_content_type(), part.get_payload(decode=True)) for part in parsed.walk() if part.get_filename()}
+
+    def test_spliced_message_parses_back_to_the_files(self):
+        for linesep in ('\n', '\r\n'):
+            message = CampaignMessage(subject='Hi', body='Hello', from_email='me@example.com', to=['ann@example.com'])
+            message.attach_alternative('<p>Hello</p>', 'text/html')
+            for attachment in self.attachments:
+                attachment.attach_to(message)
+
+            raw = message.message().as_bytes(linesep=linesep)
+            self.assertNotIn(b'shared-attachment-', raw)
+            self.assertEqual(self.attached(raw), {
+                'resume.pdf': ('application/pdf', self.files[self.attachments[0].path]),
+                'notes.txt': ('text/plain', self.files[self.attachments[1].path]),
+            })
+            if linesep == '\r\n':
+                self.assertNotIn(b'\n', raw.replace(b'\r\n', b''))
+
+    def test_plain_messages_get_the_whole_part(self):
+        message = EmailMessage(subject='Hi', body='Hello', from_email='me@example.com', to=['ann@example.com'])
+        self.attachments[0].attach_to(message)
+        self.assertEqual(self.attached(message.message().as_bytes())['resume.pdf'][1], self.files[self.attachments[0].path])
+
+    def test_size_limit_is_checked_on_the_encoded_total(self):
+        with self.assertRaises(AttachmentError):
+            load_attachments(list(self.files), max_bytes=200_000)
+        with self.assertRaises(AttachmentError):
+            load_attachments(['/nonexistent/file.pdf'])
+
+
+class RecordingBatchAPIServer(FakeBatchAPIServer):
+    """
+    Rejects recipients at bad@ addresses and keeps the text each recipient of each request got.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+
+    def handle_batch(self, data):
+        texts = []
+        for message in data['messages']:
+            for recipient in message['recipients']:
+                substitutions = recipient.get('substitutions') or {}
+                texts.append((recipient['to'][0], TOKEN_RE.sub(lambda match: substitutions[match.group(1)], message['text'])))
+        self.requests.append(texts)
+        results = super().handle_batch(data)
+        return [
+            {'status': 'rejected', 'error': '550 5.1.1 Mailbox unavailable', 'permanent': True} if to.startswith('bad@') else result
+            for (to, _), result in zip(texts, results)
+        ]
+
+
+class BatchAPIBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.server = RecordingBatchAPIServer(api_key='secret').start_in_thread()
+        self.addCleanup(self.server.stop_in_thread)
+        self.template = compile_template(
+            'Subject: Hi [first_name]\n\nHello [first_name] at [Company].\n', ['Company', 'first_name'],
+            headers='subject_line', key='batch-api-test',
+        )
+
+    def backend(self, **options):
+        options.setdefault('api_key', 'secret')
+        return BatchAPIEmailBackend(api_url=self.server.url, batch_size=2, timeout=5, **options)
+
+    def message(self, email, name):
+        context = {'first_name': name, 'Company': 'Acme'}
+        subject, html_body, text = self.template.render(context)
+        message = CampaignMessage(subject=subject, body=text, from_email='me@example.com', to=[email])
+        message.attach_alternative(html_body, 'text/html')
+        message.set_template(self.template, self.template.merge_values(context))
+        return message
+
+    def test_batches_by_size_and_counts_what_was_accepted(self):
+        messages = [self.message(f'{name.lower()}@example.com', name) for name in ('Ann', 'Bob', 'Cal', 'Dee')]
+        messages.insert(2, self.message('bad@example.com', 'Bad'))
+
+        sent = self.backend().send_messages(messages)
+
+        self.assertEqual(sent, 4)
+        self.assertEqual([len(request) for request in self.server.requests], [2, 2, 1])
+        # The template went over once per request, each recipient got their own text
+        received = dict(text for request in self.server.requests for text in request)
+        for message in messages:
+            self.assertEqual(received[message.to[0]], message.body)
+        self.assertEqual([message.send_result['status'] for message in messages], ['sent', 'sent', 'failed', 'sent', 'sent'])
+        self.assertEqual(messages[2].send_result['error'], '550 5.1.1 Mailbox unavailable')
+        self.assertTrue(messages[2].send_result['permanent'])
+        self.assertTrue(messages[0].send_result['id'].startswith('fake-'))
+        # One kept-alive connection for all three requests
+        self.assertEqual(self.server.stats['connections'], 1)
+
+    def test_failed_request_marks_its_messages(self):
+        messages = [self.message('ann@example.com', 'Ann'), self.message('bob@example.com', 'Bob')]
+        with self.assertRaises(BatchAPIError):
+            self.backend(api_key='wrong').send_messages(messages)
+        self.assertEqual(self.backend(api_key='wrong', fail_silently=True).send_messages(messages), 0)
+        for message in messages:
+            self.assertEqual(message.send_result['status'], 'failed')
+            self.assertIn('401', message.send_result['error'])
+
+
+class MetricsTests(TestCase):
+    @override_settings(METRICS_CACHE_SECONDS=0)
+    def test_outbox_backlog_counts_queued_messages(self):
+        campaign = EmailCampaign.objects.create(name='c', subject='s')
+        contacts = Contact.objects.bulk_create([Contact(email=f'm{i}@example.com') for i in range(3)])
+        for contact, status in zip(contacts, ['sent', EmailLog.PENDING, EmailLog.PENDING]):
+            EmailLog.objects.create(campaign=campaign, contact=contact, subject='s', status=status)
+
+        text = render_metrics()
+        self.assertIn('coldmail_outbox_backlog 2\n', text)
+        self.assertIn('coldmail_email_logs{status="pending"} 2\n', text)
+        self.assertIn('coldmail_email_logs{status="sent"} 1\n', text)
+
+    @override_settings(METRICS_TOKEN='', METRICS_ALLOWED_IPS=[])
+    def test_endpoint_is_off_unless_restricted(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='s3cret', METRICS_ALLOWED_IPS=[], METRICS_CACHE_SECONDS=0)
+    def test_token_is_required_when_set(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'coldmail_outbox_backlog', response.content)
+
+    @override_settings(METRICS_TOKEN='', METRICS_ALLOWED_IPS=['10.0.0.0/8', '127.0.0.1'], METRICS_CACHE_SECONDS=0)
+    def test_allowlist_checks_the_connecting_address(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_X_FORWARDED_FOR='127.0.0.1').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='s3cret', METRICS_ALLOWED_IPS=['127.0.0.1'], METRICS_CACHE_SECONDS=0)
+    def test_token_and_allowlist_must_both_match(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+
+
+class EnrichmentTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'ranges.csv'
+        path.write_text(f'81.2.69.0,81.2.69.255,AU,{"Region" * 30},{"City" * 40}\n')
+
+        self.enterContext(override_settings(GEOIP_DATABASE=str(path)))
+        enrichment._database = None
+        enrichment.lookup_ip.cache_clear()
+        self.addCleanup(enrichment.lookup_ip.cache_clear)
+        self.addCleanup(setattr, enrichment, '_database', None)
+
+    def test_long_location_names_are_truncated_to_the_columns(self):
+        buffer = EventBuffer(max_events=1000, flush_interval=3600)
+        buffer.add(uuid.uuid4(), TrackingEvent.OPEN, ip_address='81.2.69.142', user_agent='Mozilla/5.0 (Windows NT 10.0) Firefox/120.0')
+        self.assertEqual(buffer.flush(), 1)
+
+        event = TrackingEvent.objects.get()
+        self.assertEqual((event.country, event.client, event.device), ('AU', 'Firefox', 'desktop'))
+        self.assertEqual(event.region, ('Region' * 30)[:100])
+        self.assertEqual(event.city, ('City' * 40)[:100])
@@ -0,0 +1,258 @@
+import atexit
+import base64
+import hashlib
+import hmac
+import ipaddress
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import iri_to_uri
+
+from .enrichment import enrich_events, event_properties
+from .metrics import TRACKING_FLUSH, TRACKING_FLUSH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 1x1 transparent PNG served by the open tracker
+PIXEL_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+)
+
+
+class EventBuffer:
+    """
+    Write-behind buffer for open/click events.
+
+    Tracking requests only append to an in-memory list; a background thread
+    writes the list with one bulk_create every `flush_interval` seconds, or
+    sooner once `max_events` are waiting. Repeated hits for the same tracking
+    id (and URL) within `dedupe_window` seconds - Gmail's image proxy, link
+    scanners prefetching every URL - are dropped before they reach the DB.
+    """
+    def __init__(self, max_events=None, flush_interval=None, dedupe_window=None):
+        self.max_events = max_events or settings.TRACKING_BUFFER_SIZE
+        self.flush_interval = (flush_interval if flush_interval is not None else settings.TRACKING_FLUSH_INTERVAL_MS / 1000)
+        self.dedupe_window = dedupe_window if dedupe_window is not None else settings.TRACKING_DEDUPE_SECONDS
+
+        self.stats = {'received': 0, 'deduped': 0, 'written': 0, 'dropped': 0, 'flushes': 0}
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._seen = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, tracking_id, event_type, url='', ip_address=None, user_agent=''):
+        """
+        Queues an event. Returns False if it was a duplicate and got dropped.
+        """
+        from .models import TrackingEvent
+
+        now = time.monotonic()
+        key = (str(tracking_id), event_type, url)
+
+        with self._lock:
+            self.stats['received'] += 1
+            last_seen = self._seen.get(key)
+            if last_seen is not None and now - last_seen < self.dedupe_window:
+                self.stats['deduped'] += 1
+                return False
+            self._seen[key] = now
+
+            self._pending.append(TrackingEvent(
+                tracking_id=tracking_id,
+                event_type=event_type,
+                url=url,
+                ip_address=ip_address,
+                user_agent=user_agent[:1000],
+                occurred_at=timezone.now(),
+            ))
+            full = len(self._pending) >= self.max_events
+            self._ensure_thread()
+
+        if full:
+            self._wake.set()
+        return True
+
+    def pending(self):
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Writes everything pending in one bulk insert, then forwards it to analytics.
+        """
+        from .models import TrackingEvent
+
+        with self._lock:
+            batch, self._pending = self._pending, []
+            # Forget hits that are out of the dedupe window, so _seen stays small
+            cutoff = time.monotonic() - self.dedupe_window
+            self._seen = {key: seen for key, seen in self._seen.items() if seen >= cutoff}
+
+        if not batch:
+            return 0
+
+        try:
+            # Client and location lookups happen here, off the request path (cached, see emails/enrichment.py)
+            enrich_events(batch)
+        except Exception:
+            logger.exception("Tracking event enrichment failed, writing the events without it")
+
+        try:
+            with TRACKING_FLUSH.time(), transaction.atomic():
+                TrackingEvent.objects.bulk_create(batch, batch_size=self.max_events)
+            TRACKING_FLUSH_SIZE.observe(len(batch))
+        except Exception:
+            # Nothing was written (atomic); keep the rows that insert on their own
+            logger.exception("Bulk insert of %d tracking events failed, retrying them one at a time", len(batch))
+            batch = self._insert_each(batch)
+            if not batch:
+                return 0
+
+        self.stats['written'] += len(batch)
+        self.stats['flushes'] += 1
+        self._forward(batch)
+        return len(batch)
+
+    def _insert_each(self, batch):
+        """
+        Inserts events one by one, so a bad row only loses itself.
+        Returns the events that were written.
+        """
+        written = []
+        for event in batch:
+            try:
+                with transaction.atomic():
+                    event.save(force_insert=True)
+            except Exception as e:
+                self.stats['dropped'] += 1
+                logger.warning("Dropping tracking event %s %s: %s", event.event_type, event.tracking_id, e)
+            else:
+                written.append(event)
+        return written
+
+    def _forward(self, batch):
+        """
+        Sends the batch to Mixpanel, with one query for all the logs it refers to.
+        """
+        from .models import EmailLog, TrackingEvent
+        from .services import AnalyticsService
+
+        if AnalyticsService.get_instance() is None:
+            return
+
+        try:
+            logs = EmailLog.objects.select_related('contact', 'campaign').in_bulk({event.tracking_id for event in batch})
+            for event in batch:
+                email_log = logs.get(event.tracking_id)
+                if email_log is None:
+                    continue
+                if event.event_type == TrackingEvent.OPEN:
+                    AnalyticsService.track_open(email_log.contact, email_log.campaign.name, email_log.subject, event.tracking_id,
+                                                properties=event_properties(event))
+                else:
+                    AnalyticsService.track_click(email_log.contact, email_log.campaign.name, event.url, event.tracking_id,
+                                                 properties=event_properties(event))
+        except Exception:
+            logger.exception("Failed to forward tracking events to analytics")
+
+    def _ensure_thread(self):
+        # Called with the lock held
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='tracking-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        from django.db import close_old_connections
+
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Tracking flush failed")
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_event_buffer():
+    """
+    The process-wide buffer (created on first use, flushed at exit).
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = EventBuffer()
+                atexit.register(_buffer.flush)
+    return _buffer
+
+
+def client_ip(meta):
+    """
+    Client address from a WSGI environ / request.META (Render sits behind a proxy).
+    None unless it parses as an address: X-Forwarded-For is client-controlled
+    ("unknown", "1.2.3.4:5678"), and the column rejects anything else on Postgres.
+    """
+    forwarded = meta.get('HTTP_X_FORWARDED_FOR')
+    value = forwarded.split(',')[0].strip() if forwarded else meta.get('REMOTE_ADDR')
+    if not value:
+        return None
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return None
+
+
+# SECRET_KEY -> click signature key
+_click_keys = {}
+
+
+def click_signature(tracking_id, url):
+    """
+    Signature of a click-tracking link, over the tracking id and the target.
+    Added to each link when templates are compiled (emails/templating.py).
+    """
+    # Called for every link of every message rendered: the key is derived once
+    secret = settings.SECRET_KEY
+    key = _click_keys.get(secret)
+    if key is None:
+        key = _click_keys[secret] = hashlib.sha256(b'emails.tracking.click' + secret.encode('utf-8')).digest()
+    message = f'{tracking_id}:{iri_to_uri(url)}'.encode('utf-8')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:20]
+
+
+def click_target(query_string, tracking_id):
+    """
+    Target URL of a click-tracking link, or None if the link is malformed or
+    its signature doesn't match (anything else would be an open redirect).
+    The URL is percent-encoded after "url=" (links from before that carry it
+    unencoded, so everything after "url=" is taken as the target); "sig=" comes before it.
+    """
+    from urllib.parse import parse_qs, unquote
+
+    if 'url=' not in query_string:
+        return None
+    params, target = query_string.split('url=', 1)
+    if target.lower().startswith(('http%3a', 'https%3a')):
+        target = unquote(target)
+    if not target.startswith(('http://', 'https://')):
+        return None
+
+    signature = parse_qs(params).get('sig', [''])[0]
+    if not signature:
+        # Links in emails sent before clicks were signed
+        return target if settings.TRACKING_ALLOW_UNSIGNED_CLICKS else None
+    if not constant_time_compare(signature, click_signature(tracking_id, target)):
+        return None
+    return target
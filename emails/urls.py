@@ -7,4 +7,6 @@ urlpatterns = [
     path('', views.index, name='index'), 
     path('track/open/<uuid:tracking_id>/pixel.png', views.track_email_open, name='track_open'),
     path('track/click/<uuid:tracking_id>/', views.track_link_click, name='track_click'),
+    path('unsubscribe/<str:token>/', views.unsubscribe, name='unsubscribe'),
+    path('campaigns/<int:campaign_id>/export.csv', views.export_campaign, name='export_campaign'),
 ]
@@ -1,3 +1,118 @@
-from django.shortcuts import render
+import csv
+import html
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+
+from . import metrics
+from .metrics import TRACKING_LATENCY, TRACKING_REQUESTS
+from .models import EmailCampaign, Suppression, TrackingEvent
+from .services import EmailEngine
+from .suppression import read_unsubscribe_token
+from .tracking import PIXEL_PNG, click_target, client_ip, get_event_buffer
+
+
+def index(request):
+    return HttpResponse("Cold mailer is running.", content_type='text/plain')
+
+
+def track_email_open(request, tracking_id):
+    """
+    Serves the tracking pixel. The open is only queued in memory (see emails/tracking.py),
+    the request never waits on the database.
+    """
+    with TRACKING_LATENCY.time(TrackingEvent.OPEN):
+        queued = get_event_buffer().add(
+            tracking_id, TrackingEvent.OPEN,
+            ip_address=client_ip(request.META),
+            user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        )
+        TRACKING_REQUESTS.inc(TrackingEvent.OPEN, 'queued' if queued else 'deduped')
+        response = HttpResponse(PIXEL_PNG, content_type='image/png')
+        response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return response
+
+
+def track_link_click(request, tracking_id):
+    """
+    Queues the click and redirects to the original link (signed, see tracking.click_target).
+    """
+    with TRACKING_LATENCY.time(TrackingEvent.CLICK):
+        target = click_target(request.META.get('QUERY_STRING', ''), tracking_id)
+        if target is None:
+            TRACKING_REQUESTS.inc(TrackingEvent.CLICK, 'invalid')
+            return HttpResponseBadRequest("Invalid link")
+
+        queued = get_event_buffer().add(
+            tracking_id, TrackingEvent.CLICK, url=target,
+            ip_address=client_ip(request.META),
+            user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        )
+        TRACKING_REQUESTS.inc(TrackingEvent.CLICK, 'queued' if queued else 'deduped')
+        return HttpResponseRedirect(target)
+
+
+def metrics_view(request):
+    """
+    Prometheus text format. Not served unless METRICS_TOKEN and/or
+    METRICS_ALLOWED_IPS restrict it (see metrics.scrape_allowed).
+    """
+    allowed = metrics.scrape_allowed(request.META)
+    if allowed is None:
+        raise Http404
+    if not allowed:
+        return HttpResponseForbidden("Forbidden", content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+UNSUBSCRIBE_FORM = """<!doctype html>
+<title>Unsubscribe</title>
+<form method="post">
+  <p>Stop receiving emails at {email}?</p>
+  <button type="submit" name="List-Unsubscribe" value="One-Click">Unsubscribe</button>
+</form>
+"""
+
+
+@csrf_exempt
+def unsubscribe(request, token):
+    """
+    Unsubscribe link from the List-Unsubscribe header.
+    POST unsubscribes (mail clients' one-click, or the confirmation form);
+    GET only shows the form, since link scanners fetch every URL in a message.
+    """
+    email = read_unsubscribe_token(token)
+    if email is None:
+        return HttpResponseBadRequest("Invalid unsubscribe link")
+
+    if request.method == 'POST':
+        Suppression.suppress([email], Suppression.UNSUBSCRIBE, note='unsubscribe link')
+        return HttpResponse("You have been unsubscribed.", content_type='text/plain')
+
+    return HttpResponse(UNSUBSCRIBE_FORM.format(email=html.escape(email)))
+
+
+class Echo:
+    """File-like object that hands back what is written, so csv.writer can feed a stream"""
+    def write(self, value):
+        return value
+
+
+@staff_member_required
+def export_campaign(request, campaign_id):
+    """
+    Streams the campaign results as CSV. Bytes start flowing as soon as the
+    first rows come back from the database.
+    """
+    campaign = get_object_or_404(EmailCampaign, pk=campaign_id)
+    writer = csv.writer(Echo())
+
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in EmailEngine.iter_campaign_export(campaign)),
+        content_type='text/csv',
+    )
+    response['Content-Disposition'] = f'attachment; filename="campaign_{campaign.pk}.csv"'
+    return response